@@ -0,0 +1,96 @@
+"""
+Compares the schema-compiled flattener with the pandas json_normalize transform it replaced.
+
+    python -m benchmarks.flattener --games 200 --players 40
+"""
+import argparse
+import copy
+import time
+
+from nhldata.nhl.v1.crawler import Crawler
+from nhldata.nhl.v1.flattener import GAME_FLATTENER, time_on_ice_seconds
+from nhldata.nhl.v1.header import header, nullable_int_columns, time_on_ice_seconds_columns
+
+SKATER = {
+    'person': {'id': 8476826, 'fullName': 'Yanni Gourde', 'link': '/api/v1/people/8476826', 'firstName': 'Yanni',
+               'lastName': 'Gourde', 'primaryNumber': '37', 'birthDate': '1991-12-15', 'currentAge': 28,
+               'birthCity': 'Saint-Narcisse', 'birthStateProvince': 'QC', 'birthCountry': 'CAN', 'nationality': 'CAN',
+               'height': "5' 9''", 'weight': 175, 'active': True, 'alternateCaptain': False, 'captain': False,
+               'rookie': False, 'shootsCatches': 'L', 'rosterStatus': 'Y',
+               'currentTeam': {'id': 14, 'name': 'Tampa Bay Lightning', 'link': '/api/v1/teams/14'},
+               'primaryPosition': {'code': 'C', 'name': 'Center', 'type': 'Forward', 'abbreviation': 'C'}},
+    'jerseyNumber': '37',
+    'position': {'code': 'C', 'name': 'Center', 'type': 'Forward', 'abbreviation': 'C'},
+    'stats': {'skaterStats': {'timeOnIce': '15:14', 'assists': 2, 'goals': 0, 'shots': 2, 'hits': 1,
+                              'powerPlayGoals': 0, 'powerPlayAssists': 0, 'penaltyMinutes': 2, 'faceOffPct': 50,
+                              'faceOffWins': 6, 'faceoffTaken': 12, 'takeaways': 0, 'giveaways': 0,
+                              'shortHandedGoals': 0, 'shortHandedAssists': 0, 'blocked': 0, 'plusMinus': 1,
+                              'evenTimeOnIce': '13:10', 'powerPlayTimeOnIce': '1:01', 'shortHandedTimeOnIce': '1:03'}}}
+
+GOALIE = dict(SKATER, stats={'goalieStats': {
+    'timeOnIce': '60:00', 'assists': 1, 'goals': 0, 'pim': 0, 'shots': 27, 'saves': 26, 'powerPlaySaves': 4,
+    'shortHandedSaves': 0, 'evenSaves': 22, 'shortHandedShotsAgainst': 0, 'evenShotsAgainst': 23,
+    'powerPlayShotsAgainst': 4, 'decision': 'W', 'savePercentage': 96.29629629629629, 'powerPlaySavePercentage': 100,
+    'evenStrengthSavePercentage': 95.65217391304348}})
+
+
+def synthetic_game(players: int) -> dict:
+    """ builds a boxscore with half the players on each side and two goalies per side """
+    teams = {}
+    for side in ['home', 'away']:
+        roster = {}
+        for idx in range(players // 2):
+            player = copy.deepcopy(GOALIE if idx < 2 else SKATER)
+            player['person']['id'] += idx
+            roster[f'ID{player["person"]["id"]}'] = player
+        teams[side] = {'players': roster}
+    return {'teams': teams}
+
+
+def pandas_transform(records):
+    import pandas as pd
+    players = pd.json_normalize(records, sep='_').reindex(header, axis=1)
+    for column in nullable_int_columns:
+        players[column] = pd.array(players[column], dtype='Int64')
+    for column, source in time_on_ice_seconds_columns.items():
+        players[column] = pd.array([None if pd.isna(value) else time_on_ice_seconds(value)
+                                    for value in players[source]], dtype='Int64')
+    return players.to_csv(index=False)
+
+
+def timed(transform, games) -> float:
+    start = time.perf_counter()
+    for game in games:
+        transform(Crawler._extract_players(game.get('teams')))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--players', type=int, default=40)
+    args = parser.parse_args()
+
+    games = [synthetic_game(args.players) for _ in range(args.games)]
+    flattener_seconds = timed(GAME_FLATTENER.to_csv, games)
+    print(f'flattener: {flattener_seconds:.3f}s for {args.games} games')
+
+    try:
+        import_start = time.perf_counter()
+        import pandas  # noqa: F401
+        import_seconds = time.perf_counter() - import_start
+    except ImportError:
+        print('pandas is not installed, skipping the comparison')
+        return
+
+    pandas_seconds = timed(pandas_transform, games)
+    print(f'pandas:    {pandas_seconds:.3f}s for {args.games} games (+{import_seconds:.3f}s to import pandas)')
+    print(f'speedup:   {pandas_seconds / flattener_seconds:.1f}x')
+
+    identical = all(GAME_FLATTENER.to_csv(records) == pandas_transform(records)
+                    for records in (Crawler._extract_players(game.get('teams')) for game in games[:5]))
+    print(f'identical output: {identical}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+{% macro players_loaded_since(model) %}
+
+-- every player with a game_stats row loaded since the model's newest row, whatever the row now says: reloads can
+-- take a player's points away or move a game to another team, so their rows have to be worked out again too
+select nhl_player_id
+from {{ ref('player_game_stats') }}
+where loaded_at > coalesce((select max(loaded_at) from {{ model }}), '-infinity')
+
+{% endmacro %}
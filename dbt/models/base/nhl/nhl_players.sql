@@ -1,12 +1,33 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key='player_team_key',
+        pre_hook="{% if is_incremental() %}delete from {{ this }} where id in ({{ players_loaded_since(this) }}){% endif %}"
+    )
+}}
+
+with stats as (
+    select *
+    from {{ ref('player_game_stats') }}
+    where stats_goals + stats_assists > 0
+    and stats_time_on_ice_seconds is not Null
+{% if is_incremental() %}
+    -- only the players with games loaded since the last run, the pre_hook has deleted their rows and their tallies
+    -- are recounted from all their games, for every team they scored for
+    and nhl_player_id in ({{ players_loaded_since(this) }})
+{% endif %}
+)
+
 select
+    concat(nhl_player_id, '|', game_team_name) as player_team_key,
     nhl_player_id as id,
     full_name,
     game_team_name as team_name,
     SUM(stats_assists) as assists,
     SUM(stats_goals) as goals,
     SUM(stats_goals + stats_assists) as points,
-    SUM(concat('P0000-00-00T00:', lpad(stats_time_on_ice, 5, '0'))::INTERVAL) as time_on_ice
-from {{ ref('player_game_stats') }}
-where stats_goals + stats_assists > 0
-and stats_time_on_ice is not Null
-group by id, full_name, team_name
+    SUM(stats_time_on_ice_seconds) * INTERVAL '1 second' as time_on_ice,
+    SUM(stats_time_on_ice_seconds) as time_on_ice_seconds,
+    MAX(loaded_at) as loaded_at
+from stats
+group by player_team_key, id, full_name, team_name
@@ -1,4 +1,18 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key='player_game_key',
+        post_hook=[
+            'create unique index if not exists player_game_stats_key_idx on {{ this }} (player_game_key)',
+            'create index if not exists player_game_stats_player_idx on {{ this }} (nhl_player_id)',
+        ]
+    )
+}}
+
 select
+        concat(game_id, '-', player_person_id) player_game_key,
+        game_id,
+        game_date,
         player_person_id as nhl_player_id,
         side,
         player_person_fullName full_name,
@@ -68,7 +82,17 @@ select
         player_stats_goalieStats_savePercentage goalie_stats_save_percentage,
         player_stats_goalieStats_powerPlaySavePercentage goalie_stats_power_play_save_percentage,
         player_stats_goalieStats_evenStrengthSavePercentage goalie_stats_even_strenght_save_percentage,
-        player_stats_goalieStats_shortHandedSavePercentage goalie_stats_shorthanded_save_percentage
+        player_stats_goalieStats_shortHandedSavePercentage goalie_stats_shorthanded_save_percentage,
+        player_stats_skaterStats_timeOnIce_seconds stats_time_on_ice_seconds,
+        player_stats_skaterStats_evenTimeOnIce_seconds stats_even_time_on_ice_seconds,
+        player_stats_skaterStats_powerPlayTimeOnIce_seconds stats_power_play_time_on_ice_seconds,
+        player_stats_skaterStats_shortHandedTimeOnIce_seconds stats_shorthanded_time_on_ice_seconds,
+        player_stats_goalieStats_timeOnIce_seconds goalie_stats_time_on_ice_seconds,
+        loaded_at
   from {{ source('nhl', 'game_stats') }}
+{% if is_incremental() %}
+ -- the rows merged into game_stats since the last run, new games and reloaded ones alike
+ where loaded_at > (select max(loaded_at) from {{ this }})
+{% endif %}
 
 
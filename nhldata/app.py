@@ -1,6 +1,7 @@
 import logging
 import os
 import uuid
+from contextlib import contextmanager
 from dataclasses import asdict
 from datetime import datetime, timedelta
 
@@ -9,15 +10,37 @@ import click
 from botocore.config import Config
 
 from nhldata import __version__
+from nhldata.backfill import Backfill, CheckpointJournal, plan_chunks
+from nhldata.compaction import GRANULARITIES, Compactor
+from nhldata.concurrency import AIMDController
+from nhldata.httpcache import ResponseCache
+from nhldata.leases import LeaseManager
+from nhldata.loader import Loader
 from nhldata.metadata import JobMetadata
 from nhldata.nhl import AdapterFactory
-from nhldata.storage import Storage
+from nhldata.nhl.v1.crawler import SERIALIZERS
+from nhldata.nhl.v1.planner import SeasonPlanner
+from nhldata.ratelimit import FileTokenBucket, TokenBucket
+from nhldata.reprocess import Reprocessor
+from nhldata.retryhttp import JOB_DEADLINE, CircuitBreaker
+from nhldata.sharding import Shard
+from nhldata.storage import COMPRESSION_SUFFIXES, DEFAULT_MAX_CONNECTIONS, Storage
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 API_FACTORY = AdapterFactory()
 DATE_FORMATS = ['%Y-%m-%d']
 
 
+def build_storage(compression: str = None, max_connections: int = DEFAULT_MAX_CONNECTIONS) -> Storage:
+    """ builds storage over one S3 client, shared by every thread, with a connection for each concurrent upload """
+    bucket = os.environ.get('DEST_BUCKET', 'output')
+    jobs = os.environ.get('JOB_BUCKET', 'jobs')
+    max_connections = max(max_connections, DEFAULT_MAX_CONNECTIONS)
+    s3client = boto3.client('s3', config=Config(signature_version='s3v4', max_pool_connections=max_connections),
+                            endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    return Storage(bucket, jobs, s3client, compression)
+
+
 def splash(debug: bool):
     click.echo('\nNHLData v%s' % __version__)
     click.echo('NHLData log level is %s and higher\n' % ('DEBUG' if debug else 'INFO'))
@@ -33,17 +56,80 @@ def main(debug):
     splash(debug)
 
 
-@main.command()
-@click.option('--api-version', type=click.Choice(API_FACTORY.all_versions(), case_sensitive=False), default='v1',
-              help="NHL statsapi version to target", show_default=True)
-@click.option('--from-date', type=click.DateTime(formats=DATE_FORMATS),
-              default=(datetime.now() - timedelta(days=1)).strftime(DATE_FORMATS[0]),
-              help="Start date of retrieval window", show_default=True)
-@click.option('--to-date', type=click.DateTime(formats=DATE_FORMATS),
-              default=datetime.now().strftime((DATE_FORMATS[0])),
-              help="End date of retrieval window", show_default=True)
-def games(api_version, from_date, to_date):
-    meta = JobMetadata(
+def crawl_options(func):
+    """ applies the options shared by every command that crawls the NHL api """
+    options = [
+        click.option('--api-version', type=click.Choice(API_FACTORY.all_versions(), case_sensitive=False),
+                     default='v1', help="NHL statsapi version to target", show_default=True),
+        click.option('--max-workers', type=click.IntRange(min=1), default=1,
+                     help="Number of games to fetch concurrently", show_default=True),
+        click.option('--adaptive', is_flag=True, default=False,
+                     help="Adapt the number of games fetched at once to how the API is coping, up to --max-workers"),
+        click.option('--transform-processes', type=click.IntRange(min=0), default=0,
+                     help="Size of the process pool games are transformed in, 0 transforms them in-process",
+                     show_default=True),
+        click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+                     help="Directory for the on-disk API response cache, disabled when not set"),
+        click.option('--cache-max-mb', type=click.IntRange(min=1), default=512,
+                     help="Size of the API response cache before least recently used entries are evicted",
+                     show_default=True),
+        click.option('--rate-limit', type=click.FloatRange(min=0), default=None,
+                     help="Most requests per second to send to the API, unlimited when not set"),
+        click.option('--rate-burst', type=click.IntRange(min=1), default=1,
+                     help="Requests that can be sent back to back under the rate limit", show_default=True),
+        click.option('--rate-limit-file', type=click.Path(dir_okay=False), default=None,
+                     help="Share the rate limit with every process on this machine using the same file"),
+        click.option('--hedge-percentile', type=click.FloatRange(min=50, max=99.9), default=None,
+                     help="Send a duplicate boxscore request when one is slower than this latency percentile"),
+        click.option('--time-budget', type=click.FloatRange(min=0), default=None,
+                     help="Seconds the whole job may spend retrying failed API calls, unlimited when not set"),
+        click.option('--force', is_flag=True, default=False,
+                     help="Re-crawl Final games that are already in the data bucket"),
+        click.option('--output-format', type=click.Choice(SERIALIZERS.keys(), case_sensitive=False), default='csv',
+                     help="File format to store game data in", show_default=True),
+        click.option('--compression', type=click.Choice(COMPRESSION_SUFFIXES.keys(), case_sensitive=False),
+                     default=None, help="Compress game data with gzip or zstd"),
+        click.option('--archive-raw/--no-archive-raw', default=True,
+                     help="Archive the raw boxscore responses so games can be reprocessed later", show_default=True),
+        click.option('--shard-index', type=click.IntRange(min=0), default=0,
+                     help="Shard of the games this host crawls, from 0 to --shard-count - 1", show_default=True),
+        click.option('--shard-count', type=click.IntRange(min=1), default=1,
+                     help="Number of hosts the games are split between by gamePk", show_default=True),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+@contextmanager
+def build_crawler(storage: Storage, api_version: str, max_workers: int, adaptive: bool, transform_processes: int,
+                  cache_dir: str, cache_max_mb: int, rate_limit: float, rate_burst: int, rate_limit_file: str,
+                  hedge_percentile: float, time_budget: float, force: bool, output_format: str, archive_raw: bool,
+                  shard_index: int, shard_count: int, pool_size: int = None, season_index: str = None):
+    """ builds the api and crawler for the requested version, the api's connections are released on exit """
+    shard = Shard(shard_index, shard_count) if shard_count > 1 else None
+    JOB_DEADLINE.arm(time_budget)
+    api_adapters = API_FACTORY.adapter_for_version(api_version)
+    cache = ResponseCache(os.path.join(cache_dir, 'responses.sqlite'), cache_max_mb * 1024 * 1024) \
+        if cache_dir else None
+    rate_limiter = None
+    if rate_limit and rate_limit_file:
+        rate_limiter = FileTokenBucket(rate_limit_file, rate_limit, rate_burst)
+    elif rate_limit:
+        rate_limiter = TokenBucket(rate_limit, rate_burst)
+    pool_size = pool_size or max_workers
+    # with parallel backfill chunks the controller is shared, so it bounds the fetches of every chunk together
+    concurrency = AIMDController(min_limit=1, max_limit=pool_size, initial=max(1, pool_size // 2)) if adaptive else None
+    with api_adapters.api(pool_size=pool_size, cache=cache, rate_limiter=rate_limiter,
+                          hedge_percentile=hedge_percentile) as api:
+        planner = SeasonPlanner(api, season_index) if season_index else None
+        yield api_adapters.crawler(api, storage, max_workers=max_workers, incremental=not force,
+                                   output_format=output_format, transform_processes=transform_processes,
+                                   concurrency=concurrency, archive_raw=archive_raw, planner=planner, shard=shard)
+
+
+def new_job_metadata(from_date: datetime, to_date: datetime) -> JobMetadata:
+    return JobMetadata(
         id=str(uuid.uuid4()),
         app_version=__version__,
         execution_date=datetime.utcnow().strftime("%Y/%m/%d"),
@@ -53,25 +139,143 @@ def games(api_version, from_date, to_date):
         job_successful='True',
         job_exception=''
     )
-    bucket = os.environ.get('DEST_BUCKET', 'output')
-    jobs = os.environ.get('JOB_BUCKET', 'jobs')
-    s3client = boto3.client('s3', config=Config(signature_version='s3v4'),
-                            endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
-    storage = Storage(bucket, jobs, s3client)
+
+
+def store_job_metadata(storage: Storage, meta: JobMetadata) -> None:
+    meta_keys = ','.join(asdict(meta).keys())
+    meta_values = ','.join(asdict(meta).values())
+    storage_key = f'{meta.execution_date}/{meta.id}.csv'
+    csv_string = f'{meta_keys}\n{meta_values}'
+    storage.store_job(storage_key, csv_string)
+
+
+def breaker_state(api) -> str:
+    """ renders the state of the api's circuit breaker for the job metadata, empty if it doesn't have one """
+    breaker = getattr(api, 'circuit_breaker', None)
+    if not isinstance(breaker, CircuitBreaker):
+        return ''
+    return '%s (%s failures)' % (breaker.state, breaker.failures)
+
+
+def fail_job(meta: JobMetadata, e: Exception) -> None:
+    click.echo('JOB RUN FAILED')
+    click.echo(e)
+    # if it blows up, update the meta object
+    meta.job_successful = 'False'
+    meta.job_exception = e.__repr__().replace(',', ' ')
+
+
+@main.command()
+@click.option('--from-date', type=click.DateTime(formats=DATE_FORMATS),
+              default=(datetime.now() - timedelta(days=1)).strftime(DATE_FORMATS[0]),
+              help="Start date of retrieval window", show_default=True)
+@click.option('--to-date', type=click.DateTime(formats=DATE_FORMATS),
+              default=datetime.now().strftime((DATE_FORMATS[0])),
+              help="End date of retrieval window", show_default=True)
+@crawl_options
+def games(from_date, to_date, compression, **crawl_settings):
+    meta = new_job_metadata(from_date, to_date)
+    storage = build_storage(compression, crawl_settings['max_workers'])
+    try:
+        with build_crawler(storage, **crawl_settings) as crawler:
+            try:
+                crawler.crawl(from_date, to_date)
+            finally:
+                meta.circuit_breaker_state = breaker_state(crawler.api)
+    except Exception as e:
+        fail_job(meta, e)
+    finally:
+        store_job_metadata(storage, meta)
+
+
+@main.command()
+@click.option('--from-date', type=click.DateTime(formats=DATE_FORMATS), required=True,
+              help="Start date of the backfill")
+@click.option('--to-date', type=click.DateTime(formats=DATE_FORMATS), required=True,
+              help="End date of the backfill")
+@click.option('--chunk-days', type=click.IntRange(min=1), default=7,
+              help="Number of days crawled by each chunk", show_default=True)
+@click.option('--parallel-chunks', type=click.IntRange(min=1), default=2,
+              help="Number of chunks to crawl at the same time", show_default=True)
+@click.option('--backfill-id', default=None,
+              help="Checkpoint journal to resume, defaults to one named after the date range")
+@click.option('--season-index', type=click.Path(dir_okay=False), default=None,
+              help="Plan games from this local season index instead of calling the schedule for every chunk")
+@click.option('--lease-seconds', type=click.FloatRange(min=1), default=None,
+              help="Share the backfill with every host running it with the same id, chunks are claimed through "
+                   "leases in the jobs bucket that expire after this long without renewal")
+@crawl_options
+def backfill(from_date, to_date, chunk_days, parallel_chunks, backfill_id, season_index, lease_seconds, compression,
+             **crawl_settings):
+    meta = new_job_metadata(from_date, to_date)
+    storage = build_storage(compression, crawl_settings['max_workers'] * parallel_chunks)
     try:
-        api_adapters = API_FACTORY.adapter_for_version(api_version)
-        api = api_adapters.api()
-        crawler = api_adapters.crawler(api, storage)
-        crawler.crawl(from_date, to_date)
+        if not backfill_id:
+            backfill_id = f'{from_date.strftime(DATE_FORMATS[0])}_{to_date.strftime(DATE_FORMATS[0])}'
+            # every shard crawls every chunk, so each one needs checkpoints of its own
+            if crawl_settings['shard_count'] > 1:
+                backfill_id += f"_{Shard(crawl_settings['shard_index'], crawl_settings['shard_count']).name()}"
+        if lease_seconds and crawl_settings['shard_count'] > 1:
+            raise ValueError('Leases and shards split a backfill in different ways, use one or the other')
+        pool_size = crawl_settings['max_workers'] * parallel_chunks
+        with build_crawler(storage, pool_size=pool_size, season_index=season_index, **crawl_settings) as crawler:
+            journal = CheckpointJournal(storage, backfill_id)
+            leases = LeaseManager(storage, backfill_id, lease_seconds=lease_seconds) if lease_seconds else None
+            try:
+                crawled = Backfill(crawler, journal, parallel_chunks, leases).run(
+                    plan_chunks(from_date, to_date, chunk_days))
+            finally:
+                meta.circuit_breaker_state = breaker_state(crawler.api)
+            click.echo('Backfill %s crawled %s chunks' % (backfill_id, len(crawled)))
     except Exception as e:
-        click.echo('JOB RUN FAILED')
-        click.echo(e)
-        # if it blows up, update the meta object
-        meta.job_successful = 'False'
-        meta.job_exception = e.__repr__().replace(',', ' ')
+        fail_job(meta, e)
     finally:
-        meta_keys = ','.join(asdict(meta).keys())
-        meta_values = ','.join(asdict(meta).values())
-        storage_key = f'{meta.execution_date}/{meta.id}.csv'
-        csv_string = f'{meta_keys}\n{meta_values}'
-        storage.store_job(storage_key, csv_string)
+        store_job_metadata(storage, meta)
+
+
+@main.command()
+@click.option('--granularity', type=click.Choice(GRANULARITIES, case_sensitive=False), default='day',
+              help="Size of the compacted files", show_default=True)
+@click.option('--from-date', type=click.DateTime(formats=DATE_FORMATS),
+              default=(datetime.now() - timedelta(days=1)).strftime(DATE_FORMATS[0]),
+              help="Compact every period with a game on or after this date", show_default=True)
+@click.option('--to-date', type=click.DateTime(formats=DATE_FORMATS),
+              default=datetime.now().strftime((DATE_FORMATS[0])),
+              help="Compact every period with a game on or before this date", show_default=True)
+def compact(granularity, from_date, to_date):
+    compactor = Compactor(build_storage(), granularity)
+    for manifest in compactor.compact(from_date, to_date):
+        click.echo('Compacted %s games into %s' % (len(manifest['games']), manifest['key']))
+
+
+@main.command()
+@click.option('--from-date', type=click.DateTime(formats=DATE_FORMATS), default=None,
+              help="Reprocess games played on or after this date, the whole archive when not set")
+@click.option('--to-date', type=click.DateTime(formats=DATE_FORMATS), default=None,
+              help="Reprocess games played on or before this date, the whole archive when not set")
+@click.option('--output-format', type=click.Choice(SERIALIZERS.keys(), case_sensitive=False), default='csv',
+              help="File format to store game data in", show_default=True)
+@click.option('--compression', type=click.Choice(COMPRESSION_SUFFIXES.keys(), case_sensitive=False), default=None,
+              help="Compress game data with gzip or zstd")
+@click.option('--processes', type=click.IntRange(min=0), default=os.cpu_count(),
+              help="Size of the process pool games are rendered in, 0 renders them in-process", show_default=True)
+@click.option('--max-workers', type=click.IntRange(min=1), default=8,
+              help="Number of games to download, and to upload, concurrently", show_default=True)
+def reprocess(from_date, to_date, output_format, compression, processes, max_workers):
+    reprocessor = Reprocessor(build_storage(compression, max_workers), output_format, processes, max_workers)
+    click.echo('Reprocessed %s games' % reprocessor.run(from_date, to_date))
+
+
+@main.command()
+@click.option('--dsn', envvar='DATABASE_URL', required=True,
+              help="Postgres connection string to load into, defaults to $DATABASE_URL")
+@click.option('--streams', type=click.IntRange(min=1), default=4,
+              help="Number of COPY streams to load with in parallel", show_default=True)
+@click.option('--files-per-copy', type=click.IntRange(min=1), default=500,
+              help="Number of objects loaded by each batch", show_default=True)
+@click.option('--full', is_flag=True, default=False,
+              help="Load every object, not just those modified since the last load")
+def load(dsn, streams, files_per_copy, full):
+    loader = Loader(build_storage(max_connections=streams), dsn, streams, files_per_copy)
+    games_loaded = loader.load_games(full)
+    click.echo('Loaded %s game files and %s job files' % (games_loaded, loader.load_jobs(full)))
@@ -0,0 +1,156 @@
+"""
+Backfills long date ranges in chunks.
+
+A range is split into chunks of a few days that are crawled independently across a pool of workers.  Whenever a
+chunk finishes, a checkpoint is written to the jobs bucket under backfills/<backfill id>/, and a backfill that is
+started again with the same id skips every chunk that already has one.  A failure only costs the chunks that failed.
+"""
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from nhldata.leases import LeaseManager
+from nhldata.storage import Storage
+
+LOG = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = 'backfills/'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class BackfillError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Chunk:
+    start_date: datetime
+    end_date: datetime
+
+    def name(self) -> str:
+        return f'{self.start_date.strftime(DATE_FORMAT)}_{self.end_date.strftime(DATE_FORMAT)}'
+
+
+def plan_chunks(start_date: datetime, end_date: datetime, chunk_days: int = 7) -> [Chunk]:
+    """ splits the inclusive range between start_date and end_date into consecutive chunks of chunk_days """
+    if chunk_days < 1:
+        raise ValueError('chunk_days must be at least 1: got %s' % chunk_days)
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        chunks.append(Chunk(chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+class CheckpointJournal:
+    """
+    Records completed chunks as one small object each in the jobs bucket, objects are never rewritten so
+    concurrent workers can't clobber each other's checkpoints
+    """
+    def __init__(self, storage: Storage, backfill_id: str):
+        self.storage = storage
+        self.backfill_id = backfill_id
+        self.prefix = f'{CHECKPOINT_PREFIX}{backfill_id}/'
+
+    def _key(self, chunk: Chunk) -> str:
+        return f'{self.prefix}{chunk.name()}.json'
+
+    def completed(self) -> set:
+        """ returns the names of the chunks that have a checkpoint """
+        return {key[len(self.prefix):-len('.json')] for key in self.storage.list_jobs(self.prefix)
+                if key.endswith('.json')}
+
+    def is_completed(self, chunk: Chunk) -> bool:
+        return self._key(chunk) in self.storage.list_jobs(self._key(chunk))
+
+    def record(self, chunk: Chunk, **details) -> None:
+        checkpoint = {
+            'backfill_id': self.backfill_id,
+            'start_date': chunk.start_date.strftime(DATE_FORMAT),
+            'end_date': chunk.end_date.strftime(DATE_FORMAT),
+            'completed_ts': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+            **details,
+        }
+        self.storage.store_job(self._key(chunk), json.dumps(checkpoint))
+
+
+class Backfill:
+    def __init__(self, crawler, journal: CheckpointJournal, parallel_chunks: int = 1, leases: LeaseManager = None):
+        """
+        :param crawler: crawler shared by every chunk, it must be safe to call crawl() from several threads
+        :param journal: where completed chunks are checkpointed
+        :param parallel_chunks: number of chunks to crawl at the same time
+        :param leases: share the backfill with other workers, each chunk is crawled by the worker holding its lease
+        """
+        self.crawler = crawler
+        self.journal = journal
+        self.parallel_chunks = parallel_chunks
+        self.leases = leases
+
+    def _run_chunk(self, chunk: Chunk) -> bool:
+        """
+        Crawls and checkpoints a chunk
+
+        :return: False if the chunk was left to, or already done by, another worker
+        """
+        if self.leases is None:
+            self._crawl_chunk(chunk)
+            return True
+
+        lease = self.leases.claim(chunk.name())
+        if lease is None:
+            return False
+        with self.leases.hold(lease):
+            # another worker may have finished it after our list of pending chunks was made
+            if self.journal.is_completed(chunk):
+                return False
+            self._crawl_chunk(chunk)
+        return True
+
+    def _crawl_chunk(self, chunk: Chunk) -> None:
+        LOG.info('Backfilling %s' % chunk.name())
+        self.crawler.crawl(chunk.start_date, chunk.end_date)
+        self.journal.record(chunk)
+
+    def run(self, chunks: [Chunk]) -> [Chunk]:
+        """
+        Crawls every chunk that doesn't have a checkpoint yet, with leases it waits until chunks claimed by other
+        workers are checkpointed as well, and takes them over if their leases expire first
+
+        :return: the chunks that were crawled by this run
+        """
+        completed = self.journal.completed()
+        pending = [chunk for chunk in chunks if chunk.name() not in completed]
+        LOG.info('Backfill %s: %s of %s chunks already completed' % (self.journal.backfill_id,
+                                                                     len(chunks) - len(pending), len(chunks)))
+
+        crawled, failed = [], []
+        while pending:
+            elsewhere = []
+            with ThreadPoolExecutor(max_workers=self.parallel_chunks, thread_name_prefix='backfill') as executor:
+                futures = {executor.submit(self._run_chunk, chunk): chunk for chunk in pending}
+                for future, chunk in futures.items():
+                    try:
+                        (crawled if future.result() else elsewhere).append(chunk)
+                    except Exception as err:
+                        # keep going, everything that did finish is checkpointed and a re-run only retries the failures
+                        LOG.error('Backfill chunk %s failed: %r' % (chunk.name(), err))
+                        failed.append(chunk)
+
+            completed = self.journal.completed() if elsewhere else completed
+            pending = [chunk for chunk in elsewhere if chunk.name() not in completed]
+            if pending:
+                LOG.info('Backfill %s: waiting on %s chunks leased by other workers'
+                         % (self.journal.backfill_id, len(pending)))
+                time.sleep(self.leases.lease_seconds / 3)
+
+        if failed:
+            raise BackfillError('%s of %s chunks failed, re-run backfill %s to retry them: %s' % (
+                len(failed), len(crawled) + len(failed), self.journal.backfill_id,
+                ' '.join(chunk.name() for chunk in failed)))
+        return crawled
@@ -0,0 +1,294 @@
+"""
+Merges the per-game objects written by the crawler (YYYY/MM/DD/<gamePk>.<ext>) into larger per-day, per-month or
+per-season files, so loaders and listings don't pay per-object overhead on tens of thousands of tiny files.
+
+Every compacted file has a manifest next to it recording exactly which game objects (and which versions of them, by
+ETag) went into it:
+
+    compacted/<granularity>/<period>.<ext>.manifest.json
+    compacted/<granularity>/<period>.<content hash>.<ext>
+
+The data file name includes a hash of its contents, and the manifest is written last, so a reader never sees a
+manifest that points at a half written file.  Re-running a compaction whose manifest already matches the games in
+the bucket does nothing, and a period whose games changed is rewritten from scratch.
+
+A period whose games were written with different columns, some before and some after a header change, can't be
+merged into one file.  It is skipped and left for readers to take game by game, until the games are reprocessed
+with the current header.
+
+Compacted files keep the format and compression of the games that went into them.  They're written through a
+spooled temporary file, one game at a time, and streamed to the bucket so a season doesn't have to fit in memory.
+
+Readers should go through readable_keys(), which picks compacted files over the per-game objects they cover and
+ignores compacted files that have gone stale.  It only lists the year prefixes the games live under, never raw/, and
+reads manifests from compacted/manifests.json, an index of every manifest and its ETag that the Compactor keeps up to
+date.  A manifest the index doesn't have, or has an older version of, is read from the manifest itself.
+"""
+import hashlib
+import json
+import logging
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+from nhldata.storage import Storage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+LOG = logging.getLogger(__name__)
+
+# coarsest last, readers prefer the coarsest compacted file that is still valid
+GRANULARITIES = ['day', 'month', 'season']
+COMPACTED_PREFIX = 'compacted/'
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_INDEX = f'{COMPACTED_PREFIX}manifests.json'
+
+# merged files are spooled in memory up to this size before spilling over to disk
+SPOOL_BYTES = 16 * 1024 * 1024
+
+YEAR_PREFIX = re.compile(r'^\d{4}/$')
+GAME_KEY = re.compile(r'^(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/(?P<game_id>\d+)\.(?P<extension>[\w.]+)$')
+
+
+class MixedColumnsError(ValueError):
+    pass
+
+
+def parse_game_key(key: str):
+    """ returns the regex match for a per-game object key, or None for anything else in the bucket """
+    return GAME_KEY.match(key)
+
+
+def period_for(match, granularity: str) -> str:
+    """ renders the period a game belongs to, the first four digits of a gamePk are the season's starting year """
+    if granularity == 'day':
+        return '/'.join([match['year'], match['month'], match['day']])
+    if granularity == 'month':
+        return '/'.join([match['year'], match['month']])
+    return match['game_id'][:4]
+
+
+def manifest_key(granularity: str, period: str, extension: str) -> str:
+    return f'{COMPACTED_PREFIX}{granularity}/{period}.{extension}{MANIFEST_SUFFIX}'
+
+
+def _game_date(match) -> datetime:
+    return datetime(int(match['year']), int(match['month']), int(match['day']))
+
+
+def _listing_prefixes(granularity: str, start_date: datetime, end_date: datetime) -> [str]:
+    """ the smallest set of prefixes to list to see every game of every period that touches the window """
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    if granularity == 'day':
+        return sorted({day.strftime('%Y/%m/%d/') for day in days})
+    if granularity == 'month':
+        return sorted({day.strftime('%Y/%m/') for day in days})
+    # seasons straddle two calendar years
+    return sorted({f'{year}/' for day in days for year in (day.year - 1, day.year, day.year + 1)})
+
+
+def file_format(extension: str) -> str:
+    """ strips any compression suffix from an extension, 'csv.gz' -> 'csv' """
+    return extension.split('.')[0]
+
+
+def _manifest_is_current(manifest: dict, objects: dict, covered: set) -> bool:
+    return all(game['key'] not in covered and objects.get(game['key'], {}).get('ETag') == game['etag']
+               for game in manifest['games'])
+
+
+def _load_manifests(storage: Storage, compacted: dict) -> dict:
+    """
+    Returns manifest key -> manifest for every manifest in a listing of compacted/, taking them from the manifest
+    index when it has their current version
+    """
+    index = json.loads(storage.load_data(MANIFEST_INDEX)) if MANIFEST_INDEX in compacted else {}
+    manifests = {}
+    for key, obj in compacted.items():
+        if not key.endswith(MANIFEST_SUFFIX):
+            continue
+        entry = index.get(key)
+        if entry and entry['etag'] == obj['ETag']:
+            manifests[key] = entry['manifest']
+        else:
+            manifests[key] = json.loads(storage.load_data(key))
+    return manifests
+
+
+def index_manifests(storage: Storage) -> bool:
+    """
+    Rewrites the manifest index if it's missing any manifest, or has an outdated version of one
+
+    :return: whether the index was rewritten
+    """
+    compacted = {obj['Key']: obj for obj in storage.list_objects(COMPACTED_PREFIX)}
+    previous = json.loads(storage.load_data(MANIFEST_INDEX)) if MANIFEST_INDEX in compacted else {}
+    index = {key: {'etag': compacted[key]['ETag'], 'manifest': manifest}
+             for key, manifest in _load_manifests(storage, compacted).items()}
+    if index == previous:
+        return False
+    storage.store_data(MANIFEST_INDEX, json.dumps(index))
+    LOG.info('Indexed %s manifests' % len(index))
+    return True
+
+
+def readable_objects(storage: Storage, extension: str = 'csv') -> [dict]:
+    """
+    Returns the listing of the objects a reader should load to see every game in the bucket exactly once, preferring
+    compacted files
+
+    :param storage: the storage holding the game data
+    :param extension: only return objects in this format, whatever they're compressed with
+    """
+    objects = {}
+    for prefix in storage.list_prefixes():
+        # games live under their year, everything else in the bucket (raw/, compacted/) isn't listed game by game
+        if not YEAR_PREFIX.match(prefix):
+            continue
+        for obj in storage.list_objects(prefix):
+            match = parse_game_key(obj['Key'])
+            if match and file_format(match['extension']) == extension:
+                objects[obj['Key']] = obj
+
+    compacted = {obj['Key']: obj for obj in storage.list_objects(COMPACTED_PREFIX)}
+    manifests = [manifest for manifest in _load_manifests(storage, compacted).values()
+                 if file_format(manifest['extension']) == extension]
+    manifests.sort(key=lambda manifest: GRANULARITIES.index(manifest['granularity']), reverse=True)
+
+    readable = []
+    covered = set()
+    for manifest in manifests:
+        # a compacted file is only good while every game in it is unchanged and not already read from a coarser file
+        if manifest['key'] not in compacted or not _manifest_is_current(manifest, objects, covered):
+            LOG.debug('Ignoring stale compacted file %s' % manifest['key'])
+            continue
+        readable.append(compacted[manifest['key']])
+        covered.update(game['key'] for game in manifest['games'])
+
+    readable.extend(objects[key] for key in sorted(objects) if key not in covered)
+    return readable
+
+
+def readable_keys(storage: Storage, extension: str = 'csv') -> [str]:
+    """ returns the keys of the readable_objects """
+    return [obj['Key'] for obj in readable_objects(storage, extension)]
+
+
+class Compactor:
+    def __init__(self, storage: Storage, granularity: str = 'day'):
+        if granularity not in GRANULARITIES:
+            raise ValueError('Granularity %s is unsupported, please choose from [%s]' % (granularity, GRANULARITIES))
+        self.storage = storage
+        self.granularity = granularity
+
+    def plan(self, start_date: datetime, end_date: datetime) -> dict:
+        """ groups the game objects of every period that has a game inside the window, by (period, extension) """
+        groups = {}
+        in_window = set()
+        for prefix in _listing_prefixes(self.granularity, start_date, end_date):
+            for obj in self.storage.list_objects(prefix):
+                match = parse_game_key(obj['Key'])
+                if not match:
+                    continue
+                group = (period_for(match, self.granularity), match['extension'])
+                groups.setdefault(group, []).append(obj)
+                if start_date <= _game_date(match) <= end_date:
+                    in_window.add(group)
+        return {group: sorted(objs, key=lambda obj: obj['Key']) for group, objs in groups.items() if group in in_window}
+
+    def compact(self, start_date: datetime, end_date: datetime) -> [dict]:
+        """
+        Compacts every period that has a game inside the window
+
+        :return: the manifests that were written, periods that were already up to date are skipped
+        """
+        written = []
+        for (period, extension), objects in sorted(self.plan(start_date, end_date).items()):
+            try:
+                manifest = self._compact_period(period, extension, objects)
+            except MixedColumnsError as err:
+                LOG.warning('Skipping %s %s, %s. Reprocess its games to compact it' % (self.granularity, period, err))
+                continue
+            if manifest:
+                written.append(manifest)
+        LOG.info('Compacted %s %s periods' % (len(written), self.granularity))
+        # also catches up on manifests a compaction running alongside this one left out of the index
+        index_manifests(self.storage)
+        return written
+
+    def _load_manifest(self, key: str):
+        if not any(obj['Key'] == key for obj in self.storage.list_objects(key)):
+            return None
+        return json.loads(self.storage.load_data(key))
+
+    def _compact_period(self, period: str, extension: str, objects: [dict]):
+        games = [{'key': obj['Key'], 'etag': obj['ETag'], 'size': obj['Size']} for obj in objects]
+        key = manifest_key(self.granularity, period, extension)
+
+        previous = self._load_manifest(key)
+        if previous and previous['games'] == games:
+            LOG.debug('Compacted %s %s is up to date' % (self.granularity, period))
+            return None
+
+        digest = hashlib.sha1(json.dumps(games, sort_keys=True).encode()).hexdigest()[:12]
+        data_key = f'{COMPACTED_PREFIX}{self.granularity}/{period}.{digest}.{extension}'
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+            with self.storage.compressed_writer(spool, data_key) as writer:
+                self._merge(file_format(extension), [game['key'] for game in games], writer)
+            spool.seek(0)
+            self.storage.store_stream(data_key, spool)
+
+        manifest = {
+            'granularity': self.granularity,
+            'period': period,
+            'extension': extension,
+            'key': data_key,
+            'games': games,
+            'created_ts': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+        }
+        # the manifest is the commit point, only once it's written is the new data file visible to readers
+        self.storage.store_data(key, json.dumps(manifest, indent=2))
+        if previous and previous['key'] != data_key:
+            self.storage.delete_data(previous['key'])
+        LOG.info('Compacted %s games into %s' % (len(games), data_key))
+        return manifest
+
+    def _merge(self, extension: str, keys: [str], writer) -> None:
+        if extension == 'csv':
+            return self._merge_csv(keys, writer)
+        if extension == 'parquet':
+            return self._merge_parquet(keys, writer)
+        raise ValueError('Cannot compact %s files' % extension)
+
+    def _merge_csv(self, keys: [str], writer) -> None:
+        """ concatenates csv games, keeping a single header row """
+        header = None
+        for key in keys:
+            game_header, _, body = self.storage.load_data(key).partition(b'\n')
+            if header is None:
+                header = game_header
+                writer.write(header + b'\n')
+            elif game_header != header:
+                raise MixedColumnsError('the header of %s does not match the other games' % key)
+            writer.write(body)
+
+    def _merge_parquet(self, keys: [str], writer) -> None:
+        """ appends every game as its own row group """
+        if pa is None:
+            raise RuntimeError('Compacting parquet requires pyarrow, install it with `pip install nhldata[parquet]`')
+        parquet_writer = None
+        try:
+            for key in keys:
+                table = pq.read_table(pa.BufferReader(self.storage.load_data(key)))
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(writer, table.schema, compression='zstd', write_statistics=True)
+                elif not table.schema.equals(parquet_writer.schema, check_metadata=False):
+                    raise MixedColumnsError('the schema of %s does not match the other games' % key)
+                parquet_writer.write_table(table)
+        finally:
+            if parquet_writer is not None:
+                parquet_writer.close()
@@ -0,0 +1,137 @@
+"""
+Adaptive (AIMD) concurrency control for requests to the API.
+
+A fixed number of workers is either too timid or too aggressive depending on how the API is doing.  AIMDController
+works like TCP congestion control instead: every healthy response raises the limit on requests in flight by
+increase / limit, so it grows by about `increase` per round of requests, and every sign of overload (a 429, a 5xx, a
+connection failure or a response much slower than usual) cuts it by decrease_factor.  Cuts are at most one per
+cooldown, so a burst of failures from requests that were all in flight together only counts once.
+
+The controller hears about responses through the retry decorator (see retryhttp.observe_requests), which sees every
+attempt, including the ones it goes on to retry.  Callers take a slot() around each request; it blocks while the
+limit is reached.  Every change of the limit is logged, and kept in `trajectory` for tuning the bounds.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from nhldata.retryhttp import RETRYABLE_CODES
+
+LOG = logging.getLogger(__name__)
+
+
+class AIMDController:
+    def __init__(self, min_limit: int = 1, max_limit: int = 32, initial: int = None, increase: float = 1,
+                 decrease_factor: float = 0.5, latency_spike: float = 3, cooldown_seconds: float = 1):
+        """
+        :param min_limit: fewest requests allowed in flight, however badly the API is doing
+        :param max_limit: most requests allowed in flight, however well the API is doing
+        :param initial: limit to start from, defaults to min_limit
+        :param increase: how much the limit grows by per round of healthy responses
+        :param decrease_factor: what the limit is multiplied by on overload
+        :param latency_spike: a response this many times slower than the moving average counts as overload
+        :param cooldown_seconds: shortest time between two cuts
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError('limits must satisfy 1 <= min_limit <= max_limit: got %s, %s' % (min_limit, max_limit))
+        if not 0 < decrease_factor < 1:
+            raise ValueError('decrease_factor must be between 0 and 1: got %s' % decrease_factor)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_spike = latency_spike
+        self.cooldown_seconds = cooldown_seconds
+
+        self._limit = float(min(max(initial or min_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._average_latency = None
+        self._last_cut = 0.0
+        self._condition = threading.Condition()
+        self.trajectory = [(time.time(), self.limit)]
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def slot(self):
+        """ holds one of the limited in-flight slots, waiting for one to free up if they're all taken """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def observe(self, seconds: float, error: Exception = None) -> None:
+        """
+        Adjusts the limit after an attempt at a request
+
+        :param seconds: how long the attempt took
+        :param error: what the attempt raised, None if it succeeded
+        """
+        if self._is_overload(error):
+            self._cut(_describe(error))
+        # any other error means the API answered, it just didn't like the request, that says nothing about its load
+        elif error is None:
+            with self._condition:
+                average = self._average_latency
+                self._average_latency = seconds if average is None else 0.8 * average + 0.2 * seconds
+            if average is not None and seconds > self.latency_spike * average:
+                self._cut('latency spike %.2fs against %.2fs' % (seconds, average))
+            else:
+                self._grow()
+
+    @staticmethod
+    def _is_overload(error: Exception) -> bool:
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        return isinstance(error, requests.HTTPError) and error.response is not None and \
+            error.response.status_code in RETRYABLE_CODES
+
+    def _grow(self) -> None:
+        with self._condition:
+            before = self.limit
+            self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+            changed = self.limit != before
+            if changed:
+                self._condition.notify_all()
+        if changed:
+            self._record(before, 'healthy')
+
+    def _cut(self, reason: str) -> None:
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_cut < self.cooldown_seconds:
+                return
+            self._last_cut = now
+            before = self.limit
+            self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+        if self.limit != before:
+            self._record(before, reason)
+
+    def _record(self, before: int, reason: str) -> None:
+        self.trajectory.append((time.time(), self.limit))
+        LOG.info('Concurrency limit %s -> %s (%s)' % (before, self.limit, reason))
+
+    def summary(self) -> str:
+        """ renders the limits the controller went through, in order """
+        return 'concurrency trajectory: %s' % ' -> '.join(str(limit) for _, limit in self.trajectory)
+
+
+def _describe(error: Exception) -> str:
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return 'status_code %s' % error.response.status_code
+    return type(error).__name__
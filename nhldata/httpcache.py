@@ -0,0 +1,128 @@
+"""
+A small persistent cache for HTTP response bodies, backed by a sqlite database on local disk.
+
+Entries are keyed by endpoint and query params and carry an optional expiry.  An entry without an expiry is
+immutable and is only ever removed by eviction, which is least-recently-used and bounded by the total size of the
+cached bodies.  Expired entries are not thrown away straight away: if the server gave us an ETag or Last-Modified
+they can be revalidated with a conditional request, and a 304 just extends the entry's life.
+
+sqlite does the locking for us, so a cache file can be shared by several threads and by several processes.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlencode
+
+LOG = logging.getLogger(__name__)
+
+# pass as the ttl to cache a response forever
+IMMUTABLE = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expires_at REAL,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL
+)
+"""
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires_at: Optional[float]
+
+    def is_fresh(self, now: float = None) -> bool:
+        """ immutable entries are always fresh, everything else is fresh until it expires """
+        return self.expires_at is None or (now or time.time()) < self.expires_at
+
+    def validators(self) -> dict:
+        """ renders the conditional request headers we can revalidate this entry with """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        :param path: location of the sqlite cache file, parent directories are created if needed
+        :param max_bytes: total size of the cached bodies before the least recently used entries are evicted
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(SCHEMA)
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+
+    @staticmethod
+    def make_key(url: str, params: dict = None) -> str:
+        """ renders a stable cache key for an endpoint and its query params """
+        return f'{url}?{urlencode(sorted(params.items()))}' if params else url
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            row = self._db.execute('SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+        return CachedResponse(*row)
+
+    def put(self, key: str, body: bytes, etag: str = None, last_modified: str = None, ttl: float = IMMUTABLE) -> None:
+        """
+        Stores (or replaces) a response body
+
+        :param ttl: seconds the entry stays fresh for, IMMUTABLE to keep it until it's evicted
+        """
+        now = time.time()
+        expires_at = None if ttl is IMMUTABLE else now + ttl
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, body, etag, last_modified, expires_at, now, len(body)))
+            self._evict()
+
+    def refresh(self, key: str, ttl: float = IMMUTABLE) -> None:
+        """ extends the life of an entry that the server told us hasn't changed """
+        expires_at = None if ttl is IMMUTABLE else time.time() + ttl
+        with self._lock:
+            self._db.execute('UPDATE responses SET expires_at = ? WHERE key = ?', (expires_at, key))
+
+    def size(self) -> int:
+        """ returns the total size of the cached bodies in bytes """
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _evict(self) -> None:
+        """ drops least recently used entries until we're back under max_bytes, callers must hold the lock """
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        LOG.debug('Evicted %s cached responses' % evicted)
@@ -0,0 +1,137 @@
+"""
+Leases on units of work, kept in the jobs bucket so workers on different hosts can share a backfill.
+
+A lease is a small json object under leases/<scope>/<name>.json saying who holds it and until when.  It is claimed
+with a conditional write that only succeeds if the object doesn't exist yet, so when two workers race for the same
+unit only one of them gets it.  The holder renews the lease while it works, each renewal conditional on the lease
+still being the one it wrote, and releases it when it's done by overwriting it, under the same condition, with a
+lease that has already expired.  A lease that wasn't renewed in time belonged to a worker that stopped, and the next
+worker to come across it takes it over, with the same kind of conditional write.
+
+Expiry is judged on wall clock time across hosts, lease_seconds has to be well clear of any clock skew between them.
+Losing a lease while still working on it costs a unit being worked on twice, never a unit being skipped, and storing
+a game twice just overwrites it with the same data.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from nhldata.storage import ConditionFailed, Storage
+
+LOG = logging.getLogger(__name__)
+
+LEASE_PREFIX = 'leases/'
+
+
+class LeaseLost(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Lease:
+    name: str
+    owner: str
+    expires_at: float
+    etag: str
+
+
+def default_owner() -> str:
+    """ names this worker, unique even between processes on the same host """
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class LeaseManager:
+    def __init__(self, storage: Storage, scope: str, owner: str = None, lease_seconds: float = 300):
+        """
+        :param scope: name shared by every worker taking part, leases are kept under leases/<scope>/
+        :param owner: name of this worker, unique to it
+        :param lease_seconds: how long a lease lasts without being renewed, it's renewed every third of that
+        """
+        self.storage = storage
+        self.prefix = f'{LEASE_PREFIX}{scope}/'
+        self.owner = owner or default_owner()
+        self.lease_seconds = lease_seconds
+
+    def _key(self, name: str) -> str:
+        return f'{self.prefix}{name}.json'
+
+    def _write(self, name: str, etag: str = None, expires_at: float = None) -> Lease:
+        expires_at = time.time() + self.lease_seconds if expires_at is None else expires_at
+        body = json.dumps({'owner': self.owner, 'expires_at': expires_at})
+        return Lease(name, self.owner, expires_at, self.storage.store_job_if(self._key(name), body, etag))
+
+    def claim(self, name: str):
+        """
+        Takes the lease on a unit of work, taking it over if the worker holding it let it expire
+
+        :return: the Lease, or None if another worker holds it
+        """
+        try:
+            return self._write(name)
+        except ConditionFailed:
+            pass
+
+        body, etag = self.storage.load_job(self._key(name))
+        if body is None:
+            # released between the two calls, have another go at it next time round
+            return None
+        held = json.loads(body)
+        if held['expires_at'] > time.time():
+            return None
+        try:
+            lease = self._write(name, etag)
+        except ConditionFailed:
+            return None
+        LOG.warning('Took over the expired lease on %s from %s' % (name, held['owner']))
+        return lease
+
+    def renew(self, lease: Lease) -> Lease:
+        """
+        Extends a lease that's still held
+
+        :raises LeaseLost: when another worker has taken the lease over
+        """
+        try:
+            return self._write(lease.name, lease.etag)
+        except ConditionFailed:
+            raise LeaseLost('Lease on %s was taken over by another worker' % lease.name)
+
+    def release(self, lease: Lease) -> None:
+        """ gives up a lease, unless another worker has taken it over in the meantime """
+        # S3 can't delete on a condition, expiring the lease with a conditional write can't touch a takeover's lease
+        try:
+            self._write(lease.name, lease.etag, expires_at=0)
+        except ConditionFailed:
+            LOG.debug('Lease on %s was already taken over by another worker' % lease.name)
+
+    @contextmanager
+    def hold(self, lease: Lease):
+        """ keeps renewing a lease in the background for as long as the block runs, and releases it afterwards """
+        stopped = threading.Event()
+        current = [lease]
+
+        def keep_renewing():
+            while not stopped.wait(self.lease_seconds / 3):
+                try:
+                    current[0] = self.renew(current[0])
+                except LeaseLost as err:
+                    LOG.error('%s, it may be worked on twice' % err)
+                    return
+                except Exception as err:
+                    # keep trying, the lease is good until it expires
+                    LOG.warning('Failed to renew the lease on %s: %r' % (lease.name, err))
+
+        renewer = threading.Thread(target=keep_renewing, name=f'lease-{lease.name}', daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+            self.release(current[0])
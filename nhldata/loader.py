@@ -0,0 +1,342 @@
+"""
+Bulk loads the game data and the job metadata in the buckets into Postgres.
+
+Objects are streamed straight from the bucket into COPY ... FROM STDIN, many objects to a COPY.  The rows of
+consecutive objects that share a csv header are concatenated, headers dropped, into a single COPY naming the header's
+columns, so objects written before and after a change to the header can be loaded in the same batch.
+
+Several streams load at once, each with its own connection and its own temporary staging table.  A batch of objects
+is copied into the stream's staging table and merged into the target table in one transaction, so every batch is
+either loaded whole or not at all.  The merge upserts on the table's key, so loading an object twice leaves the table
+as loading it once did and a load can be rerun after a failure.
+
+Only the objects modified since the table's watermark in load_watermarks are loaded, less an overlap for uploads that
+were in flight while the last load listed the bucket.  The watermark moves up to the newest object loaded once every
+batch is in.
+
+Objects written before the crawler wrote time on ice in seconds don't have the *_seconds columns, the merge works
+them out from the mm:ss columns (DERIVED_COLUMNS) so every row has them whenever its object was written.
+
+game_stats is partitioned by season.  Before a batch is merged, the partitions of the seasons in its staging table
+are created if missing, one stream at a time and outside the batch's transaction, so a new season needs no ddl.
+
+Game data is read through compaction.readable_objects, so compacted files are loaded in place of the games they cover.
+"""
+import io
+import itertools
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Iterator, Optional
+
+from nhldata.compaction import readable_objects
+from nhldata.nhl.v1.header import time_on_ice_seconds_columns
+from nhldata.storage import Storage
+
+try:
+    import psycopg2
+except ImportError:  # pragma: no cover
+    psycopg2 = None
+
+LOG = logging.getLogger(__name__)
+
+GAME_TABLE = 'game_stats'
+JOB_TABLE = 'job_stats'
+WATERMARK_TABLE = 'load_watermarks'
+
+# the columns rows are merged on, matching each table's primary key
+MERGE_KEYS = {
+    GAME_TABLE: ('game_id', 'player_person_id'),
+    JOB_TABLE: ('id',),
+}
+
+# the column each season partitioned table is split on, gamePks start with the season's year: 2019020001
+SEASON_PARTITIONED = {
+    GAME_TABLE: 'game_id',
+}
+SEASON_WIDTH = 1000000
+
+# mm:ss as a number of seconds, NULL for anything else
+MMSS_SECONDS = ("CASE WHEN {0} ~ '^[0-9]+:[0-9]{{2}}$' "
+                "THEN split_part({0}, ':', 1)::int * 60 + split_part({0}, ':', 2)::int END")
+
+# column -> sql working it out from the staging table's other columns, for rows from objects written without it.
+# Names are lower case, the way the unquoted names in the ddl are stored
+DERIVED_COLUMNS = {
+    GAME_TABLE: {seconds.lower(): MMSS_SECONDS.format(column.lower())
+                 for seconds, column in time_on_ice_seconds_columns.items()},
+}
+
+# objects are listed by when their upload started, so one uploading while the last load listed can be older than it
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# job metadata is stored as <execution date>/<job id>.csv, the jobs bucket holds backfill checkpoints and leases too
+JOB_KEY = re.compile(r'^\d{4}/\d{2}/\d{2}/[^/]+\.csv$')
+
+# csv headers name the columns to copy into, they're checked against this before they go anywhere near the sql
+COLUMN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+READ_BYTES = 64 * 1024
+
+
+class LoadError(Exception):
+    pass
+
+
+class _ChunkStream(io.RawIOBase):
+    """ a readable file object over an iterator of byte strings """
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b''
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def _open_csv(key: str, open_object: Callable) -> tuple:
+    """ opens an object and reads its header, returns (header, what was read past the header, the open object) """
+    reader = open_object(key)
+    read = b''
+    while b'\n' not in read:
+        chunk = reader.read(READ_BYTES)
+        if not chunk:
+            break
+        read += chunk
+    header, _, rest = read.partition(b'\n')
+    return header.strip(), rest, reader
+
+
+def _rows(opened: Iterable[tuple]) -> Iterator[bytes]:
+    """ yields the rows of open csv objects, one after the other, making sure each ends on a new line """
+    for _, rest, reader in opened:
+        try:
+            last = rest
+            yield rest
+            for chunk in iter(lambda: reader.read(READ_BYTES), b''):
+                last = chunk
+                yield chunk
+            if last and not last.endswith(b'\n'):
+                yield b'\n'
+        finally:
+            reader.close()
+
+
+def csv_runs(keys: Iterable[str], open_object: Callable) -> Iterator[tuple]:
+    """
+    Groups consecutive csv objects that share a header
+
+    :param open_object: opens an object for reading, given its key
+    :return: yields (columns, file object reading the rows of the group), each file object has to be read to the end
+        before the next group is asked for, objects are only opened as the reading gets to them
+    """
+    opened = (_open_csv(key, open_object) for key in keys)
+    for header, group in itertools.groupby(opened, key=lambda item: item[0]):
+        columns = header.decode('utf-8').split(',') if header else []
+        invalid = [column for column in columns if not COLUMN.match(column)]
+        if invalid:
+            raise LoadError('Invalid column names in csv header: %s' % invalid)
+        yield columns, io.BufferedReader(_ChunkStream(_rows(group)), buffer_size=READ_BYTES)
+
+
+def partition_statement(table: str, season: int) -> str:
+    """ returns the ddl creating the partition of a season partitioned table that holds a season """
+    return (f'CREATE TABLE IF NOT EXISTS {table}_{season} PARTITION OF {table} '
+            f'FOR VALUES FROM ({season * SEASON_WIDTH}) TO ({(season + 1) * SEASON_WIDTH})')
+
+
+def _batches(keys: Iterable[str], size: int) -> Iterator[list]:
+    keys = iter(keys)
+    return iter(lambda: list(itertools.islice(keys, size)), [])
+
+
+class Loader:
+    def __init__(self, storage: Storage, dsn: str, streams: int = 4, files_per_copy: int = 500):
+        """
+        :param dsn: libpq connection string of the database to load into
+        :param streams: number of COPY streams to run in parallel, each on its own connection
+        :param files_per_copy: number of objects loaded by each batch
+        """
+        if psycopg2 is None:
+            raise RuntimeError('Loading requires psycopg2, install it with `pip install nhldata[postgres]`')
+        self.storage = storage
+        self.dsn = dsn
+        self.streams = streams
+        self.files_per_copy = files_per_copy
+        self._partitions = set()
+        self._partitions_lock = threading.Lock()
+
+    def load_games(self, full: bool = False) -> int:
+        """
+        loads the games added or changed since the last load into game_stats, returns the number of objects loaded
+
+        :param full: load every game in the data bucket, whatever the watermark
+        """
+        return self._load(GAME_TABLE, readable_objects(self.storage, 'csv'), self.storage.open_data, full)
+
+    def load_jobs(self, full: bool = False) -> int:
+        """
+        loads the metadata of the jobs run since the last load into job_stats, returns the number of objects loaded
+
+        :param full: load every job in the jobs bucket, whatever the watermark
+        """
+        objects = sorted((obj for obj in self.storage.list_job_objects() if JOB_KEY.match(obj['Key'])),
+                         key=lambda obj: obj['Key'])
+        return self._load(JOB_TABLE, objects, self.storage.open_job, full)
+
+    def _load(self, table: str, objects: Iterable[dict], open_object: Callable, full: bool) -> int:
+        """ merges the objects past the watermark in batches of files_per_copy, spread over the streams """
+        connection = psycopg2.connect(self.dsn)
+        try:
+            columns = self._table_columns(connection, table)
+            watermark = None if full else self._watermark(connection, table)
+        finally:
+            connection.close()
+        objects = list(objects)
+        if watermark is not None:
+            objects = [obj for obj in objects if obj['LastModified'] > watermark - WATERMARK_OVERLAP]
+        LOG.info('Loading %s objects into %s modified since %s' % (len(objects), table, watermark))
+
+        batches = _batches((obj['Key'] for obj in objects), self.files_per_copy)
+        lock = threading.Lock()
+        failed = threading.Event()
+        loaded = []
+
+        def stream(number: int) -> None:
+            connection = psycopg2.connect(self.dsn)
+            try:
+                staging = self._create_staging(connection, table, number)
+                while not failed.is_set():
+                    with lock:
+                        batch = next(batches, None)
+                    if batch is None:
+                        return
+                    self._load_batch(connection, table, columns, staging, batch, open_object)
+                    with lock:
+                        loaded.extend(batch)
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.streams, thread_name_prefix='loader') as executor:
+            futures = [executor.submit(stream, number) for number in range(self.streams)]
+            for future in futures:
+                future.result()
+        if objects:
+            self._record_watermark(table, max(obj['LastModified'] for obj in objects))
+        LOG.info('Loaded %s objects into %s' % (len(loaded), table))
+        return len(loaded)
+
+    def _create_partitions(self, table: str, seasons: Iterable[int]) -> None:
+        """
+        creates the partitions of the seasons on a connection of its own, a stream creating partitions while it held
+        a lock on the table could deadlock with the streams merging into it
+        """
+        with self._partitions_lock:
+            missing = sorted({(table, season) for season in seasons} - self._partitions)
+            if not missing:
+                return
+            connection = psycopg2.connect(self.dsn)
+            try:
+                for _, season in missing:
+                    with connection:
+                        with connection.cursor() as cursor:
+                            cursor.execute(partition_statement(table, season))
+                    LOG.info('Created the %s partition of %s' % (season, table))
+                    self._partitions.add((table, season))
+            finally:
+                connection.close()
+
+    @staticmethod
+    def _table_columns(connection, table: str) -> [str]:
+        """ returns the columns of the target table, in order """
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT column_name FROM information_schema.columns '
+                               'WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position',
+                               (table,))
+                columns = [row[0] for row in cursor.fetchall()]
+        if not columns:
+            raise LoadError('Table %s does not exist, create it with the ddl in utils/' % table)
+        return columns
+
+    @staticmethod
+    def _watermark(connection, table: str) -> Optional[datetime]:
+        """ returns when the newest object loaded into the table was modified, None if it was never loaded """
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT watermark FROM {WATERMARK_TABLE} WHERE source = %s', (table,))
+                row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _record_watermark(self, table: str, watermark: datetime) -> None:
+        connection = psycopg2.connect(self.dsn)
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'INSERT INTO {WATERMARK_TABLE} (source, watermark) VALUES (%s, %s) '
+                                   f'ON CONFLICT (source) DO UPDATE '
+                                   f'SET watermark = EXCLUDED.watermark, loaded_at = now()', (table, watermark))
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _create_staging(connection, table: str, number: int) -> str:
+        """ creates a staging table shaped like the target table that lives as long as the connection """
+        staging = f'{table}_staging_{number}'
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'CREATE TEMPORARY TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) '
+                               f'ON COMMIT DELETE ROWS')
+        return staging
+
+    @staticmethod
+    def _merge_statement(table: str, columns: [str], staging: str) -> str:
+        """
+        upserts the rows of the staging table into the target table, the last row of a key in a batch wins, and
+        DERIVED_COLUMNS are worked out for the rows that don't have them
+        """
+        keys = ', '.join(MERGE_KEYS[table])
+        updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns
+                            if column not in MERGE_KEYS[table])
+        derived = {column: sql for column, sql in DERIVED_COLUMNS.get(table, {}).items() if column in columns}
+        selected = ', '.join(f'COALESCE({column}, {derived[column]})' if column in derived else column
+                             for column in columns) if derived else '*'
+        return (f'INSERT INTO {table} SELECT DISTINCT ON ({keys}) {selected} FROM {staging} ORDER BY {keys} '
+                f'ON CONFLICT ({keys}) DO UPDATE SET {updates}')
+
+    def _load_batch(self, connection, table: str, table_columns: [str], staging: str, keys: [str],
+                    open_object: Callable) -> None:
+        """ copies a batch of objects into the staging table and merges them into the target table """
+        with connection:
+            with connection.cursor() as cursor:
+                for columns, rows in csv_runs(keys, open_object):
+                    if not columns:
+                        # empty objects, reading them to the end closes them
+                        rows.read()
+                        continue
+                    missing = set(MERGE_KEYS[table]) - {column.lower() for column in columns}
+                    if missing:
+                        raise LoadError('Objects in the batch starting at %s lack the %s columns %s is merged on, '
+                                        'rewrite them with `nhldata reprocess`' % (keys[0], sorted(missing), table))
+                    # unquoted, so they fold to lower case the same way the unquoted names in the ddl did
+                    cursor.copy_expert(f'COPY {staging} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', rows)
+                if table in SEASON_PARTITIONED:
+                    cursor.execute(f'SELECT DISTINCT {SEASON_PARTITIONED[table]} / {SEASON_WIDTH} FROM {staging}')
+                    self._create_partitions(table, [row[0] for row in cursor.fetchall()])
+                cursor.execute(self._merge_statement(table, table_columns, staging))
+        LOG.debug('Loaded %s objects into %s' % (len(keys), table))
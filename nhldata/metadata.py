@@ -12,3 +12,4 @@ class JobMetadata:
     query_stop_date: str
     job_successful: str
     job_exception: str
+    circuit_breaker_state: str = ''
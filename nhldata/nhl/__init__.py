@@ -2,6 +2,8 @@ from collections import namedtuple
 
 from nhldata.nhl.v1.api import NHLApi as NHLApiV1
 from nhldata.nhl.v1.crawler import Crawler as CrawlerV1
+from nhldata.nhl.v1_async.api import AsyncNHLApi as AsyncNHLApiV1
+from nhldata.nhl.v1_async.crawler import AsyncCrawler as AsyncCrawlerV1
 
 NHLAdapter = namedtuple('NHLAdapter', ['api', 'crawler'])
 
@@ -9,7 +11,8 @@ NHLAdapter = namedtuple('NHLAdapter', ['api', 'crawler'])
 class AdapterFactory:
     def __init__(self):
         self.api_versions = {
-            'v1': NHLAdapter(NHLApiV1, CrawlerV1)
+            'v1': NHLAdapter(NHLApiV1, CrawlerV1),
+            'v1-async': NHLAdapter(AsyncNHLApiV1, AsyncCrawlerV1),
         }
 
     def all_versions(self):
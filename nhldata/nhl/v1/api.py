@@ -1,18 +1,183 @@
+import json
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import date, datetime, timedelta
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 
-from nhldata.retryhttp import retry
+from nhldata.httpcache import IMMUTABLE, ResponseCache
+from nhldata.ratelimit import TokenBucket
+from nhldata.retryhttp import JOB_DEADLINE, CircuitBreaker, LatencyTracker, hedge, retry, retry_after_seconds
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
 
 LOG = logging.getLogger(__name__)
 
+# (connect, read) timeouts in seconds, connect is just over a multiple of 3s as recommended by the requests docs
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# how long to trust cached responses for games that aren't Final yet
+DEFAULT_LIVE_TTL = 300
+
+FINAL_GAME_STATE = 'Final'
+
+# shared by every call to the api, so an outage fails the whole crawl fast instead of retrying game by game
+API_BREAKER = CircuitBreaker(failure_threshold=10, recovery_timeout=30)
+
+# longest a single call can spend retrying before it gives up
+MAX_RETRY_SECONDS = 120
+
+# days of schedule asked for at a time when the schedule is read one day at a time
+SCHEDULE_WINDOW_DAYS = 31
+
 
-class NHLApi:
-    def __init__(self):
+def final_game_ids(days) -> set:
+    """ returns the gamePks of the games a schedule's dates say are Final """
+    return {str(game.get('gamePk')) for day in days for game in day.get('games', [])
+            if game.get('status', {}).get('abstractGameState') == FINAL_GAME_STATE}
+
+
+class NHLApiBase:
+    """
+    What the sync and async apis share: the endpoints, which games are known to be Final, how long each response is
+    cached for, and looking responses up in and storing them to the cache.  The cache calls block on sqlite, so the
+    async api runs them in an executor rather than on its event loop.
+    """
+    circuit_breaker = API_BREAKER
+
+    def __init__(self, timeout: tuple, fast_json: bool, cache: ResponseCache, live_ttl: float,
+                 rate_limiter: TokenBucket):
         self.endpoint = "https://statsapi.web.nhl.com/api/v1"
+        self.timeout = timeout
+        self.cache = cache
+        self.live_ttl = live_ttl
+        self.rate_limiter = rate_limiter
+        self._loads = orjson.loads if fast_json and orjson else json.loads
+
+        # gamePks that a schedule response, cached or not, told us are Final, their boxscores will never change again
+        self._final_games = set()
+
+    def is_final(self, game_id) -> bool:
+        """ tells whether the game is known to be Final, from a schedule or from mark_final """
+        return str(game_id) in self._final_games
+
+    def mark_final(self, game_ids) -> None:
+        """ records games known to be Final, so their boxscores are cached for good """
+        self._final_games.update(str(game_id) for game_id in game_ids)
+
+    def _schedule_params(self, start_date: datetime, end_date: datetime) -> dict:
+        return {'startDate': start_date.strftime('%Y-%m-%d'), 'endDate': end_date.strftime('%Y-%m-%d')}
 
-    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25)
+    def _schedule_ttl(self, end_date: datetime):
+        """ returns the ttl callable for a schedule response running up to end_date """
+        def ttl(game_schedule):
+            days = game_schedule.get('dates', [])
+            games = sum(len(day.get('games', [])) for day in days)
+            # a schedule for dates that are behind us with every game played out isn't going to change
+            return IMMUTABLE if end_date.date() < date.today() and len(final_game_ids(days)) == games \
+                else self.live_ttl
+        return ttl
+
+    def _boxscore_ttl(self, game_id):
+        """ returns the ttl callable for a game's boxscore response """
+        def ttl(_):
+            return IMMUTABLE if self.is_final(game_id) else self.live_ttl
+        return ttl
+
+    def _noted_schedule(self, game_schedule: dict) -> dict:
+        """ notes which games a schedule says are Final, whether it came from the network or the cache """
+        self.mark_final(final_game_ids(game_schedule.get('dates', [])))
+        return game_schedule
+
+    def _cache_lookup(self, url, params=None) -> tuple:
+        """
+        Looks a request up in the response cache
+
+        :return: the cache key, the cached entry or None, and whether the entry is fresh enough to use as it is
+        """
+        key = ResponseCache.make_key(url, params)
+        cached = self.cache.get(key)
+        fresh = bool(cached and cached.is_fresh())
+        if fresh:
+            LOG.debug('Cache hit for %s' % key)
+        return key, cached, fresh
+
+    def _cache_response(self, key, cached, response, ttl=None):
+        """
+        Decodes a response, or the cached copy a 304 told us is still good, and keeps it in the cache
+
+        :param cached: the entry the request was revalidating, if any
+        :param ttl: callable that takes the decoded response and returns how long to cache it for
+        """
+        if cached and response.status_code == requests.codes.not_modified:
+            LOG.debug('Cache revalidated for %s' % key)
+            data = self._loads(cached.body)
+            self.cache.refresh(key, ttl(data) if ttl else self.live_ttl)
+            return data
+
+        response.raise_for_status()
+        data = self._loads(response.content)
+        self.cache.put(key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                       ttl(data) if ttl else self.live_ttl)
+        return data
+
+    def _url(self, path):
+        return f'{self.endpoint}/{path}'
+
+
+class NHLApi(NHLApiBase):
+    def __init__(self, pool_size: int = 10, timeout: tuple = DEFAULT_TIMEOUT, fast_json: bool = True,
+                 cache: ResponseCache = None, live_ttl: float = DEFAULT_LIVE_TTL, rate_limiter: TokenBucket = None,
+                 hedge_percentile: float = None):
+        """
+        :param pool_size: number of keep-alive connections to hold open, should match the crawl concurrency
+        :param timeout: (connect, read) timeouts in seconds applied to every request
+        :param fast_json: decode responses with orjson when it is installed
+        :param cache: optional on-disk response cache
+        :param live_ttl: seconds to cache responses for games that aren't Final yet
+        :param rate_limiter: optional token bucket every request to the API has to take a token from
+        :param hedge_percentile: send a duplicate boxscore request when one is slower than this latency percentile
+        """
+        super().__init__(timeout, fast_json, cache, live_ttl, rate_limiter)
+
+        # hedges need their own threads and connections, so they don't queue up behind the requests they're racing
+        self._latency = LatencyTracker(hedge_percentile) if hedge_percentile else None
+        self._hedge_pool = ThreadPoolExecutor(max_workers=2 * pool_size, thread_name_prefix='nhlapi-hedge') \
+            if hedge_percentile else None
+        connections = 2 * pool_size if hedge_percentile else pool_size
+
+        # A single session shares its connection pool between threads, so concurrent crawler workers reuse warm
+        # TCP+TLS connections instead of handshaking on every call.  pool_block keeps us from opening (and then
+        # throwing away) extra connections when more threads than pool_size are making requests.
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=connections, pool_block=True))
+        self._session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """releases the pooled connections"""
+        if self._hedge_pool:
+            self._hedge_pool.shutdown(wait=True)
+        self._session.close()
+
+    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25, circuit_breaker=API_BREAKER,
+           max_elapsed_seconds=MAX_RETRY_SECONDS, deadline=JOB_DEADLINE)
     def schedule(self, start_date: datetime, end_date: datetime) -> dict:
         """
         returns a dict tree structure that is like
@@ -27,10 +192,56 @@ class NHLApi:
                 ...
             ]
         """
-        return self._get(self._url('schedule'), {'startDate': start_date.strftime('%Y-%m-%d'),
-                                                 'endDate': end_date.strftime('%Y-%m-%d')})
+        return self._noted_schedule(self._get(self._url('schedule'), self._schedule_params(start_date, end_date),
+                                              self._schedule_ttl(end_date)))
+
+    def schedule_days(self, start_date: datetime, end_date: datetime, window_days: int = SCHEDULE_WINDOW_DAYS):
+        """
+        yields the entries of schedule()['dates'] one at a time, asking for window_days of schedule at a time, so the
+        first games can be worked on while later windows are still to come.  Without a response cache, and with
+        ijson installed, each window's days are decoded as its body downloads rather than once all of it has
+        """
+        window_start = start_date
+        while window_start <= end_date:
+            window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+            # the response cache keeps whole bodies, so there's nothing to gain from streaming when there is one
+            if self.cache is None and ijson is not None:
+                for day in self._stream_schedule(window_start, window_end):
+                    self.mark_final(final_game_ids([day]))
+                    yield day
+            else:
+                yield from self.schedule(window_start, window_end).get('dates', [])
+            window_start = window_end + timedelta(days=1)
 
-    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25)
+    def _stream_schedule(self, start_date: datetime, end_date: datetime):
+        """
+        yields the schedule's dates as they're decoded from the body, while the rest of it is still downloading
+
+        The request is retried until the response comes back, a connection lost part way through the body raises
+        a ConnectionError like a failed request does.
+        """
+        response = self._open_schedule(start_date, end_date)
+        with closing(response):
+            try:
+                yield from ijson.items(response.raw, 'dates.item', use_float=True)
+            except urllib3.exceptions.HTTPError as err:
+                raise requests.ConnectionError(str(err)) from err
+
+    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25, circuit_breaker=API_BREAKER,
+           max_elapsed_seconds=MAX_RETRY_SECONDS, deadline=JOB_DEADLINE)
+    def _open_schedule(self, start_date: datetime, end_date: datetime) -> requests.Response:
+        """ sends a streamed schedule request, returning the response before its body has been read """
+        response = self._request(self._url('schedule'), self._schedule_params(start_date, end_date), stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response
+
+    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25, circuit_breaker=API_BREAKER,
+           max_elapsed_seconds=MAX_RETRY_SECONDS, deadline=JOB_DEADLINE)
     def boxscore(self, game_id):
         """
         returns a dict tree structure that is like
@@ -49,14 +260,38 @@ class NHLApi:
                 }
             }
         """
-        url = self._url(f'game/{game_id}/boxscore')
-        return self._get(url)
+        return self._get(self._url(f'game/{game_id}/boxscore'), ttl=self._boxscore_ttl(game_id), hedged=True)
 
-    @staticmethod
-    def _get(url, params=None):
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
+    def _get(self, url, params=None, ttl=None, hedged=False):
+        """
+        GETs and decodes a json response, going through the response cache when there is one
 
-    def _url(self, path):
-        return f'{self.endpoint}/{path}'
+        :param ttl: callable that takes the decoded response and returns how long to cache it for
+        :param hedged: race a duplicate request against a slow one, when hedging is turned on
+        """
+        request = self._hedged_request if hedged and self._latency else self._request
+        if self.cache is None:
+            response = request(url, params)
+            response.raise_for_status()
+            return self._loads(response.content)
+
+        key, cached, fresh = self._cache_lookup(url, params)
+        if fresh:
+            return self._loads(cached.body)
+
+        # if we have a stale copy, ask the server whether it has changed rather than pulling it down again
+        headers = cached.validators() if cached else None
+        return self._cache_response(key, cached, request(url, params, headers), ttl)
+
+    def _request(self, url, params=None, headers=None, stream=False):
+        """ sends a GET through the rate limiter, a 429 pauses the limiter for everybody sharing it """
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        response = self._session.get(url, params=params, headers=headers, timeout=self.timeout, stream=stream)
+        if self.rate_limiter and response.status_code == requests.codes.too_many_requests:
+            self.rate_limiter.pause(retry_after_seconds(response.headers.get('Retry-After')) or 1)
+        return response
+
+    def _hedged_request(self, url, params=None, headers=None):
+        """ sends a GET, and a duplicate if it's slow, both go through the rate limiter """
+        return hedge(lambda: self._request(url, params, headers), self._latency, self._hedge_pool)
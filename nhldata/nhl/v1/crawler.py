@@ -1,33 +1,96 @@
+import itertools
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from typing import Iterable, Iterator
 
-import pandas as pd
-
+from nhldata.concurrency import AIMDController
 from nhldata.nhl.v1.api import NHLApi
-from nhldata.nhl.v1.header import header
+from nhldata.nhl.v1.flattener import GAME_FLATTENER
+from nhldata.nhl.v1.parquet import to_parquet
+from nhldata.nhl.v1.planner import SeasonPlanner
+from nhldata.pipeline import Pipeline, Stage
+from nhldata.retryhttp import observe_requests
+from nhldata.sharding import Shard
 from nhldata.storage import Storage, StorageKey
 
 LOG = logging.getLogger(__name__)
 
+# output format -> function that renders a game's player records
+SERIALIZERS = {
+    'csv': GAME_FLATTENER.to_csv,
+    'parquet': to_parquet,
+}
+
+
+def validate_output_format(output_format: str) -> None:
+    """ raises a ValueError for an output format that isn't one of the SERIALIZERS """
+    if output_format not in SERIALIZERS:
+        raise ValueError('Output format %s is unsupported, please choose from [%s]'
+                         % (output_format, list(SERIALIZERS)))
+
+
+def render_game(key: StorageKey, game: dict, output_format: str):
+    """ renders a boxscore's player records in one of the SERIALIZERS formats, tagged with the game they're from """
+    lineage = {'id': int(key.game_id), 'date': '-'.join([key.game_year, key.game_month, key.game_day])}
+    records = [{**record, 'game': lineage} for record in Crawler._extract_players(game.get('teams'))]
+    return SERIALIZERS[output_format](records)
+
+
+def transform_game(item: tuple) -> tuple:
+    """
+    Renders a fetched game in the requested output format, lives at module level so it can run in a process pool
+
+    :param item: (StorageKey, boxscore dict, output format, whether to archive the raw boxscore)
+    :return: (StorageKey, rendered game, raw boxscore json or None)
+    """
+    key, game, output_format, archive_raw = item
+    raw = json.dumps(game, separators=(',', ':')).encode('utf-8') if archive_raw else None
+    return key, render_game(key, game, output_format), raw
+
 
 class Crawler:
     """
     Retrieves data from the NHL Data Api
     """
-    def __init__(self, api: NHLApi, storage: Storage):
+    def __init__(self, api: NHLApi, storage: Storage, max_workers: int = 1, incremental: bool = False,
+                 output_format: str = 'csv', transform_processes: int = 0, concurrency: AIMDController = None,
+                 archive_raw: bool = False, planner: SeasonPlanner = None, shard: Shard = None):
+        """
+        :param max_workers: number of games to fetch, and to upload, concurrently
+        :param incremental: skip games that are already in the data bucket and that the api knows are Final
+        :param output_format: one of SERIALIZERS, also used as the file extension
+        :param transform_processes: size of the process pool to transform games in, 0 transforms them in-process
+        :param concurrency: optional controller that adapts how many of the max_workers fetches are in flight
+        :param archive_raw: also store every raw boxscore response, so games can be reprocessed without the API
+        :param planner: optional season index to plan games from, instead of calling the schedule for every crawl
+        :param shard: only crawl the games of this shard, the other shards are left to other hosts
+        """
+        validate_output_format(output_format)
         self.api = api
         self.storage = storage
+        self.max_workers = max_workers
+        self.incremental = incremental
+        self.output_format = output_format
+        self.transform_processes = transform_processes
+        self.concurrency = concurrency
+        self.archive_raw = archive_raw
+        self.planner = planner
+        self.shard = shard
 
     @staticmethod
-    def _extract_game_keys(game_schedule: [dict]) -> [StorageKey]:
+    def _extract_game_keys(game_schedule: dict, extension: str = 'csv') -> Iterator[StorageKey]:
         """Extracts the game ids from a NHL Schedule response dictionary"""
-        storage_keys = []
-        for date in game_schedule.get('dates'):
-            for game in date.get('games'):
-                storage_keys.append(
-                    StorageKey(*(date.get('date').split('-')), str(game.get('gamePk')))
-                )
-        return storage_keys
+        return Crawler._extract_day_keys(game_schedule.get('dates'), extension)
+
+    @staticmethod
+    def _extract_day_keys(days: Iterable[dict], extension: str = 'csv') -> Iterator[StorageKey]:
+        """Extracts the game ids from the dates of a NHL Schedule response as they come"""
+        for day in days:
+            for game in day.get('games'):
+                yield StorageKey(*(day.get('date').split('-')), str(game.get('gamePk')), extension)
 
     @staticmethod
     def _extract_players(teams: dict):
@@ -36,34 +99,85 @@ class Crawler:
         away = [{'player': x, 'side': 'away'} for x in teams.get('away').get('players').values()]
         return home + away
 
+    def _missing_game_keys(self, game_keys: Iterable[StorageKey]) -> Iterator[StorageKey]:
+        """
+        Filters out the Final games that have already been stored, using one listing per game day, games stored
+        while they were still in Preview or Live are crawled again
+        """
+        # keys come in date order, so only the listing of the day being filtered needs to be kept
+        prefix, existing, skipped = None, set(), 0
+        for key in game_keys:
+            if key.prefix() != prefix:
+                prefix = key.prefix()
+                existing = set(self.storage.list_games(prefix))
+            if self.storage.object_key(key) in existing and self.api.is_final(key.game_id):
+                skipped += 1
+                continue
+            yield key
+        LOG.info('Skipped %s Final games that are already stored' % skipped)
+
+    def _fetch_game(self, key: StorageKey) -> tuple:
+        """Fetches the boxscore of a game"""
+        try:
+            with self.concurrency.slot() if self.concurrency else nullcontext():
+                return key, self.api.boxscore(key.game_id), self.output_format, self.archive_raw
+        except Exception:
+            LOG.error('Failed to fetch game %s' % key.game_id)
+            raise
+
+    def _store_game(self, item: tuple) -> None:
+        """Uploads a rendered game, and its raw boxscore if it's being archived"""
+        key, game_data, raw = item
+        try:
+            if raw is not None:
+                self.storage.store_raw_game(key, raw)
+            self.storage.store_game(key, game_data)
+        except Exception:
+            LOG.error('Failed to store game %s' % key.game_id)
+            raise
+
+    def _scheduled_game_keys(self, start_date: datetime, end_date: datetime) -> Iterator[StorageKey]:
+        """Yields the keys of the games played between start_date and end_date, from the planner if there is one"""
+        if self.planner:
+            game_keys = iter(self.planner.game_keys(start_date, end_date, self.output_format))
+        else:
+            game_keys = self._extract_day_keys(self.api.schedule_days(start_date, end_date), self.output_format)
+        return self._sharded(game_keys)
+
+    def _sharded(self, game_keys: Iterator[StorageKey]) -> Iterator[StorageKey]:
+        """Drops the games that belong to other shards"""
+        if self.shard is None:
+            return game_keys
+        return (key for key in game_keys if self.shard.owns(key.game_id))
+
     def crawl(self, start_date: datetime, end_date: datetime) -> None:
-        # get the schedule info
-        game_schedule = self.api.schedule(start_date, end_date)
+        # keys are yielded as the schedule comes in, so the first games are fetched while later dates are on the way
+        game_keys = self._scheduled_game_keys(start_date, end_date)
 
         # return if no games were played between the start_date and end_date
-        if game_schedule.get('totalGames') == 0:
+        first_key = next(game_keys, None)
+        if first_key is None:
             LOG.info('No NHL games found between %s and %s' % (start_date, end_date))
             return
+        game_keys = itertools.chain([first_key], game_keys)
 
-        game_keys = self._extract_game_keys(game_schedule)
-        for key in game_keys:
-            # get the boxscore data for each game within the start_date and end_date
-            game = self.api.boxscore(key.game_id)
-
-            # flatten the dictionary into a dataframe
-            players = pd.json_normalize(self._extract_players(game.get('teams')), sep='_')
-
-            # index based on our target schema
-            arranged_players = players.reindex(header, axis=1)
-
-            # The API occasionally returns integer fields with a null that Pandas will then cast to Floats in order
-            # to use NaN in the null integer fields.  When we attempt to load this game in the database it fails, which
-            # causes us to lose ALL the data in that game.  The Int64 datatype supports pandas <NaN> values in integer
-            # arrays, so we use that: https://pandas.pydata.org/pandas-docs/version/0.24.2/user_guide/integer_na.html
-            # TODO: either predefine a dataframe schema to handle integer fields with nulls or create a xform function
-            arranged_players['player_person_currentAge'] = \
-                pd.array(arranged_players.player_person_currentAge, dtype='Int64')
-            arranged_players['player_person_currentTeam_id'] = \
-                pd.array(arranged_players.player_person_currentTeam_id, dtype='Int64')
-
-            self.storage.store_game(key, arranged_players.to_csv(index=False))
+        if self.incremental:
+            game_keys = self._missing_game_keys(game_keys)
+
+        # fetch -> transform -> upload run as pipeline stages connected by bounded queues, so the network, the
+        # transform and S3 all stay busy at the same time while memory stays flat however large the window is
+        executor = ProcessPoolExecutor(max_workers=self.transform_processes) if self.transform_processes else None
+        try:
+            pipeline = Pipeline([
+                Stage('fetch', self._fetch_game, workers=self.max_workers),
+                Stage('transform', transform_game, workers=self.transform_processes or 1, executor=executor),
+                Stage('upload', self._store_game, workers=self.max_workers),
+            ])
+            # the controller hears about every boxscore attempt, retries included, through the retry decorator
+            with observe_requests(self.concurrency) if self.concurrency else nullcontext():
+                pipeline.run(game_keys)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if self.concurrency:
+                LOG.info(self.concurrency.summary())
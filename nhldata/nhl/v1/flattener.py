@@ -0,0 +1,109 @@
+"""
+Flattens boxscore player records into the rows described by header.py without going through pandas.
+
+Every header column is compiled once into the path of nested keys it was flattened from, so
+'player_person_currentTeam_id' is read from record['player']['person']['currentTeam']['id'].  The CSV output is
+byte-for-byte what pd.json_normalize(records, sep='_').reindex(header, axis=1).to_csv(index=False) produced, which
+means mimicking the column types pandas would have inferred:
+
+    * a numeric column with a missing value, or with any float in it, is written as floats (1 -> 1.0)
+    * a column of ints, or of bools, with nothing missing is written as is
+    * everything else is written with str()
+    * missing values are always written as an empty string
+
+nullable_int_columns are the exception, they're written as ints with missing values left empty (pandas' Int64).  So
+are the *_seconds columns, which pandas never produced: they're derived from the time on ice column they're named
+after rather than read from a path of their own.
+
+NOTE: paths are compiled by splitting the column name on the separator, so API keys that contain an underscore
+can't be addressed.  None of the fields we keep do.
+"""
+import csv
+import io
+
+from nhldata.nhl.v1.header import header, nullable_int_columns, time_on_ice_seconds_columns
+
+
+def time_on_ice_seconds(value: str):
+    """ converts a 'mm:ss' time on ice string into a number of seconds, minutes can run past 99 """
+    if value is None or value == '':
+        return None
+    minutes, _, seconds = str(value).partition(':')
+    return int(minutes) * 60 + int(seconds or 0)
+
+
+class Flattener:
+    def __init__(self, columns: [str], int_columns: [str] = (), sep: str = '_', derived: dict = None):
+        """
+        :param columns: the flattened column names to extract, in output order
+        :param int_columns: columns to write as nullable integers
+        :param sep: the separator between nested key names in a column name
+        :param derived: columns computed from another column, {column: (source column, function of a non null value)}
+        """
+        derived = derived or {}
+        self.columns = list(columns)
+        self._paths = [tuple(derived[column][0].split(sep) if column in derived else column.split(sep))
+                       for column in self.columns]
+        self._converters = [derived[column][1] if column in derived else None for column in self.columns]
+        self._int_columns = [column in int_columns for column in self.columns]
+
+    @staticmethod
+    def _extract(record: dict, path: tuple):
+        """ walks the path into the record, returning None when any part of it is missing """
+        value = record
+        for part in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        # a dict at the end of the path would have been flattened into deeper columns, not this one
+        return None if isinstance(value, dict) else value
+
+    def columnar(self, records: [dict]) -> [list]:
+        """ extracts the raw values for every column, one list per column with None for missing values """
+        columns = [[self._extract(record, path) for record in records] for path in self._paths]
+        return [column if convert is None else [None if value is None else convert(value) for value in column]
+                for column, convert in zip(columns, self._converters)]
+
+    def rows(self, records: [dict]) -> [list]:
+        """ extracts the raw values for every record, one list per record in column order """
+        return [list(row) for row in zip(*self.columnar(records))] if records else []
+
+    def to_csv(self, records: [dict]) -> str:
+        columns = self.columnar(records)
+        rendered = [self._render_int(column) if is_int else self._render(column)
+                    for column, is_int in zip(columns, self._int_columns)]
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(self.columns)
+        writer.writerows(zip(*rendered))
+        return buffer.getvalue()
+
+    @staticmethod
+    def _render_int(values: list) -> list:
+        return ['' if value is None else str(int(value)) for value in values]
+
+    @staticmethod
+    def _render(values: list) -> list:
+        missing = numeric = has_float = False
+        for value in values:
+            if value is None:
+                missing = True
+            elif isinstance(value, bool):
+                # bools never mix with anything else into a numeric column
+                return ['' if value is None else str(value) for value in values]
+            elif isinstance(value, float):
+                numeric = has_float = True
+            elif isinstance(value, int):
+                numeric = True
+            else:
+                return ['' if value is None else str(value) for value in values]
+
+        if numeric and (missing or has_float):
+            return ['' if value is None else repr(float(value)) for value in values]
+        return ['' if value is None else str(value) for value in values]
+
+
+GAME_FLATTENER = Flattener(header, nullable_int_columns + list(time_on_ice_seconds_columns),
+                           derived={column: (source, time_on_ice_seconds)
+                                    for column, source in time_on_ice_seconds_columns.items()})
@@ -3,9 +3,17 @@ The NHL API doesn't guarantee that all fields will be returned in a call.  This
 the field player_stats_goalieStats_shortHandedSavePercentage was not always present.
 
 The table schema should match this header list exactly.
+
+game_id and game_date aren't in the boxscore, every record is tagged with them (as record['game']['id'] and
+record['game']['date']) so rows can be traced back to their game, and merged on (game_id, player_person_id).
+
+The *_seconds columns aren't in the boxscore either, they're the 'mm:ss' time on ice columns converted to a number of
+seconds, so queries sum integers rather than parse strings.
 """
 
 header = [
+    'game_id',
+    'game_date',
     'player_person_id',
     'player_jerseyNumber',
     'player_person_active',
@@ -75,4 +83,58 @@ header = [
     'player_stats_skaterStats_shots',
     'player_stats_skaterStats_takeaways',
     'player_stats_skaterStats_timeOnIce',
-    'side']
+    'side',
+    'player_stats_goalieStats_timeOnIce_seconds',
+    'player_stats_skaterStats_evenTimeOnIce_seconds',
+    'player_stats_skaterStats_powerPlayTimeOnIce_seconds',
+    'player_stats_skaterStats_shortHandedTimeOnIce_seconds',
+    'player_stats_skaterStats_timeOnIce_seconds']
+
+# The API occasionally returns integer fields with a null.  A nullable integer column is written as an integer when the
+# value is there and left empty when it isn't, rather than being widened to a float like the other numeric columns.
+# When that happens to one of these the game fails to load in the database, which loses ALL the data in that game.
+nullable_int_columns = [
+    'player_person_currentAge',
+    'player_person_currentTeam_id',
+]
+
+# Column types for typed outputs (Parquet), these mirror the game_stats table definition.  Columns that aren't listed
+# are strings, so time on ice stays 'mm:ss' and its *_seconds columns are the ones to sum.
+int_columns = [
+    'game_id',
+    'player_person_id',
+    'player_jerseyNumber',
+    'player_person_currentAge',
+    'player_person_currentTeam_id',
+    'player_person_primaryNumber',
+    'player_person_weight',
+]
+
+bool_columns = [
+    'player_person_active',
+    'player_person_alternateCaptain',
+    'player_person_captain',
+    'player_person_rookie',
+]
+
+date_columns = [
+    'game_date',
+]
+
+time_on_ice_columns = [
+    'player_stats_goalieStats_timeOnIce',
+    'player_stats_skaterStats_evenTimeOnIce',
+    'player_stats_skaterStats_powerPlayTimeOnIce',
+    'player_stats_skaterStats_shortHandedTimeOnIce',
+    'player_stats_skaterStats_timeOnIce',
+]
+
+# <column>_seconds holds <column> converted to seconds, written as a nullable integer
+time_on_ice_seconds_columns = {f'{column}_seconds': column for column in time_on_ice_columns}
+
+float_columns = [
+    column for column in header
+    if column.startswith('player_stats_') and column not in time_on_ice_columns
+    and column not in time_on_ice_seconds_columns
+    and column != 'player_stats_goalieStats_decision'
+]
@@ -0,0 +1,57 @@
+"""
+Writes flattened boxscore players as Parquet with typed columns.
+
+Unlike the CSV output, ints stay ints, bools stay bools and stats are floats without the 1 -> 1.0 widening.  Time on
+ice is kept the way the CSV has it, 'mm:ss' strings in the API's columns and integer seconds in the *_seconds
+columns.  Column names and order are the same as header.py.
+
+pyarrow is an optional dependency, install it with `pip install nhldata[parquet]`.
+"""
+import io
+from datetime import date
+
+from nhldata.nhl.v1.flattener import GAME_FLATTENER
+from nhldata.nhl.v1.header import bool_columns, date_columns, float_columns, int_columns, time_on_ice_seconds_columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+DEFAULT_COMPRESSION = 'zstd'
+
+
+def _arrow_column(name: str, values: list):
+    """ converts a column of raw API values into a typed arrow array """
+    if name in time_on_ice_seconds_columns:
+        return pa.array(values, type=pa.int32())
+    if name in int_columns:
+        return pa.array([None if value in (None, '') else int(value) for value in values], type=pa.int64())
+    if name in date_columns:
+        return pa.array([None if value is None else date.fromisoformat(value) for value in values], type=pa.date32())
+    if name in bool_columns:
+        return pa.array([None if value is None else bool(value) for value in values], type=pa.bool_())
+    if name in float_columns:
+        return pa.array([None if value is None else float(value) for value in values], type=pa.float64())
+    return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+
+def to_parquet(records: [dict], compression: str = DEFAULT_COMPRESSION) -> bytes:
+    """
+    Renders the players of a game as a Parquet file
+
+    :param records: player records as returned by Crawler._extract_players
+    :param compression: parquet compression codec
+    :return: the parquet file contents
+    """
+    if pa is None:
+        raise RuntimeError('Parquet output requires pyarrow, install it with `pip install nhldata[parquet]`')
+
+    columns = GAME_FLATTENER.columnar(records)
+    table = pa.table([_arrow_column(name, values) for name, values in zip(GAME_FLATTENER.columns, columns)],
+                     names=GAME_FLATTENER.columns)
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression, write_statistics=True)
+    return buffer.getvalue()
@@ -0,0 +1,184 @@
+"""
+Plans backfills from game ids instead of schedule calls.
+
+A gamePk spells out the game it belongs to: 2019030314 is season 2019(-2020), type 03 (playoffs), round 3, series
+1, game 4, and regular season games are just numbered, 2019020001 onwards.  So every game a season could have can
+be enumerated up front, without asking the API.  What a gamePk doesn't say is the date the game was played on, which
+every storage key needs, so the planner keeps a local index of season -> gamePk -> date.
+
+Candidates the index doesn't know about yet are the gaps.  Alongside its games, each season records the date it is
+settled through: every game up to then is in the index and Final, so nothing before it can change.  A schedule call
+is only made when a crawl asks for dates past that, and only for the dates from there on.  A season that is over is
+asked for up to its end, in one call, and once it has been played out, candidates the schedule didn't have (unplayed
+playoff games, game numbers past the length of a shorter season) are recorded as never played, the season has no
+gaps left and is never asked for again.  A backfill over seasons that are in the index starts fetching boxscores
+without any schedule calls.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+from nhldata.nhl.v1.api import NHLApi, final_game_ids
+from nhldata.storage import StorageKey
+
+LOG = logging.getLogger(__name__)
+
+REGULAR_SEASON = '02'
+PLAYOFFS = '03'
+
+# 32 teams playing 82 games each, seasons with fewer teams leave the higher numbers unplayed
+MAX_REGULAR_SEASON_GAMES = 1312
+
+# a playoff gamePk ends in round, series and game: 4 rounds of best of 7 series, halving from 8 series
+PLAYOFF_ROUNDS = 4
+PLAYOFF_SERIES = 8
+PLAYOFF_GAMES = 7
+
+# seasons have started as early as September and finished as late as October of the following year
+SEASON_START = (7, 1)
+SEASON_END = (10, 31)
+
+
+def season_of(game_id: str) -> str:
+    """ returns the year the season of a gamePk started in """
+    return str(game_id)[:4]
+
+
+def candidate_game_ids(season: int) -> [str]:
+    """ enumerates the gamePk of every regular season and playoff game the season could have """
+    regular = ['%s%s%04d' % (season, REGULAR_SEASON, number) for number in range(1, MAX_REGULAR_SEASON_GAMES + 1)]
+    playoffs = ['%s%s0%s%s%s' % (season, PLAYOFFS, playoff_round, series, game)
+                for playoff_round in range(1, PLAYOFF_ROUNDS + 1)
+                for series in range(1, (PLAYOFF_SERIES >> (playoff_round - 1)) + 1)
+                for game in range(1, PLAYOFF_GAMES + 1)]
+    return regular + playoffs
+
+
+def season_dates(season: int) -> (date, date):
+    """ returns the first and last date the season could have games on """
+    return date(season, *SEASON_START), date(season + 1, *SEASON_END)
+
+
+def seasons_between(start_date: datetime, end_date: datetime) -> [int]:
+    """ returns the start year of every season that could have games between start_date and end_date """
+    first = start_date.year - 1 if (start_date.month, start_date.day) <= SEASON_END else start_date.year
+    last = end_date.year if (end_date.month, end_date.day) >= SEASON_START else end_date.year - 1
+    return list(range(first, last + 1))
+
+
+class SeasonPlanner:
+    def __init__(self, api: NHLApi, index_path: str):
+        """
+        :param api: used to fill the gaps in the index with schedule calls
+        :param index_path: json file the season -> gamePk -> date index, and how far each season is settled, is kept in
+        """
+        self.api = api
+        self.index_path = index_path
+        # backfill chunks plan in parallel, the lock keeps them from filling the same season twice
+        self._lock = threading.Lock()
+        self._index = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        # indexes written before seasons were settled by date hold their games directly, a season without gaps in
+        # them was played out
+        for season, entry in index.items():
+            if 'games' not in entry:
+                index[season] = {'games': entry, 'settled_through': None}
+                if not self.gaps(int(season), entry):
+                    index[season]['settled_through'] = season_dates(int(season))[1].isoformat()
+        return index
+
+    def _save(self) -> None:
+        # write a new file and swap it in, so a crash can't leave a half written index behind
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self._index, index_file, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def gaps(self, season: int, games: dict = None) -> [str]:
+        """ returns the candidate gamePks of a season the index doesn't know the date of, or absence of, yet """
+        known = games if games is not None else self._season(season)['games']
+        return [game_id for game_id in candidate_game_ids(season) if game_id not in known]
+
+    def settled_through(self, season: int):
+        """ returns the date up to which every game of the season is indexed and Final, None if there's none yet """
+        settled = self._season(season)['settled_through']
+        return date.fromisoformat(settled) if settled else None
+
+    def _season(self, season: int) -> dict:
+        return self._index.get(str(season), {'games': {}, 'settled_through': None})
+
+    def _needs_fill(self, season: int, end_date: date) -> bool:
+        """ tells whether a crawl up to end_date needs dates of the season the index hasn't settled yet """
+        if not self.gaps(season):
+            return False
+        settled = self.settled_through(season)
+        return settled is None or min(end_date, season_dates(season)[1]) > settled
+
+    def _fill(self, season: int, end_date: date) -> None:
+        """
+        asks the schedule for the season's games from the day after it is settled through, up to end_date or, once
+        the season is over, up to its end, and records them in the index
+        """
+        first, last = season_dates(season)
+        settled = self.settled_through(season)
+        fetch_start = settled + timedelta(days=1) if settled else first
+        fetch_end = last if last < date.today() else min(end_date, last)
+        game_schedule = self.api.schedule(datetime.combine(fetch_start, datetime.min.time()),
+                                          datetime.combine(fetch_end, datetime.min.time()))
+
+        entry = self._index.setdefault(str(season), {'games': {}, 'settled_through': None})
+        # games can be rescheduled, so anything the index has in the window is replaced by what the schedule says
+        games = {game_id: day for game_id, day in entry['games'].items()
+                 if not day or not fetch_start.isoformat() <= day <= fetch_end.isoformat()}
+        first_unsettled = min(date.today(), fetch_end + timedelta(days=1))
+        for day in game_schedule.get('dates', []):
+            final = final_game_ids([day])
+            for game in day.get('games', []):
+                # the window overlaps the seasons either side of it
+                if season_of(game.get('gamePk')) != str(season):
+                    continue
+                games[str(game.get('gamePk'))] = day.get('date')
+                if str(game.get('gamePk')) not in final:
+                    first_unsettled = min(first_unsettled, date.fromisoformat(day.get('date')))
+        entry['games'] = games
+        if first_unsettled > fetch_start:
+            entry['settled_through'] = (first_unsettled - timedelta(days=1)).isoformat()
+
+        # candidates missing from a played out season's schedule were never played, anything else may still be
+        if first_unsettled > last:
+            for game_id in candidate_game_ids(season):
+                games.setdefault(game_id, None)
+        LOG.info('Indexed %s games of the %s season, settled through %s'
+                 % (sum(1 for day in games.values() if day), season, entry['settled_through']))
+
+    def game_keys(self, start_date: datetime, end_date: datetime, extension: str = 'csv') -> [StorageKey]:
+        """
+        Returns the keys of every game played between start_date and end_date, only calling the schedule for
+        seasons whose dates up to end_date aren't settled in the index yet
+        """
+        seasons = seasons_between(start_date, end_date)
+        with self._lock:
+            filled = [season for season in seasons if self._needs_fill(season, end_date.date())]
+            for season in filled:
+                self._fill(season, end_date.date())
+            if filled:
+                self._save()
+
+            first, last = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+            played = sorted((day, game_id) for season in seasons
+                            for game_id, day in self._season(season)['games'].items()
+                            if day and first <= day <= last)
+            # every game up to where its season is settled is Final, the api caches their boxscores for good
+            settled = {str(season): self.settled_through(season) for season in seasons}
+            self.api.mark_final(game_id for day, game_id in played
+                                if settled[season_of(game_id)] and day <= settled[season_of(game_id)].isoformat())
+        return [StorageKey(*day.split('-'), game_id, extension) for day, game_id in played]
@@ -0,0 +1,147 @@
+"""
+An asyncio version of the v1 NHLApi, built on aiohttp.
+
+It talks to the same endpoints and shares the v1 api's circuit breaker, retry settings and caching rules (through
+NHLApiBase), but a single event loop can keep hundreds of requests in flight over one pooled client instead of needing
+a thread for each.
+
+aiohttp sessions belong to the event loop they were opened in, and every crawl runs its own loop (backfill chunks
+crawl in parallel threads), so the api keeps one session per loop.  The crawl closes its session with aclose().
+
+Responses are handed back as requests Responses, and failures raised as requests exceptions, so the retry decorator,
+the circuit breaker and everything calling the api treat both adapters the same way.
+
+The response cache and a FileTokenBucket block on sqlite and on a file lock, so they are run in the loop's default
+executor instead of on the loop itself.
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from nhldata.httpcache import ResponseCache
+from nhldata.nhl.v1.api import API_BREAKER, DEFAULT_LIVE_TTL, DEFAULT_TIMEOUT, MAX_RETRY_SECONDS, NHLApiBase
+from nhldata.ratelimit import TokenBucket
+from nhldata.retryhttp import JOB_DEADLINE, LatencyTracker, async_hedge, async_retry, retry_after_seconds
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncNHLApi(NHLApiBase):
+    def __init__(self, pool_size: int = 100, timeout: tuple = DEFAULT_TIMEOUT, fast_json: bool = True,
+                 cache: ResponseCache = None, live_ttl: float = DEFAULT_LIVE_TTL, rate_limiter: TokenBucket = None,
+                 hedge_percentile: float = None):
+        """
+        :param pool_size: most connections to hold open per event loop, should match the number of requests in flight
+        :param timeout: (connect, read) timeouts in seconds applied to every request
+        :param fast_json: decode responses with orjson when it is installed
+        :param cache: optional on-disk response cache
+        :param live_ttl: seconds to cache responses for games that aren't Final yet
+        :param rate_limiter: optional token bucket every request to the API has to take a token from
+        :param hedge_percentile: send a duplicate boxscore request when one is slower than this latency percentile
+        """
+        if aiohttp is None:
+            raise RuntimeError('The async api requires aiohttp, install it with `pip install nhldata[async]`')
+        super().__init__(timeout, fast_json, cache, live_ttl, rate_limiter)
+        self.pool_size = pool_size
+        self._latency = LatencyTracker(hedge_percentile) if hedge_percentile else None
+
+        # event loop -> the aiohttp session opened in it
+        self._sessions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """sessions can only be closed from their own event loop, crawls do that with aclose()"""
+        if self._sessions:
+            LOG.warning('%s aiohttp sessions were left open' % len(self._sessions))
+
+    async def aclose(self) -> None:
+        """releases the pooled connections of the running event loop"""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._sessions:
+            # hedges race the request they duplicate, so they get connections of their own
+            connections = 2 * self.pool_size if self._latency else self.pool_size
+            self._sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=connections),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+                headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'},
+            )
+        return self._sessions[loop]
+
+    @async_retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25, circuit_breaker=API_BREAKER,
+                 max_elapsed_seconds=MAX_RETRY_SECONDS, deadline=JOB_DEADLINE)
+    async def schedule(self, start_date: datetime, end_date: datetime) -> dict:
+        """ the same as NHLApi.schedule """
+        return self._noted_schedule(await self._get(self._url('schedule'), self._schedule_params(start_date, end_date),
+                                                    self._schedule_ttl(end_date)))
+
+    @async_retry(max_attempts=5, backoff_factor=1, max_jitter_pct=25, circuit_breaker=API_BREAKER,
+                 max_elapsed_seconds=MAX_RETRY_SECONDS, deadline=JOB_DEADLINE)
+    async def boxscore(self, game_id):
+        """ the same as NHLApi.boxscore """
+        return await self._get(self._url(f'game/{game_id}/boxscore'), ttl=self._boxscore_ttl(game_id), hedged=True)
+
+    async def _get(self, url, params=None, ttl=None, hedged=False):
+        """
+        GETs and decodes a json response, going through the response cache when there is one
+
+        :param ttl: callable that takes the decoded response and returns how long to cache it for
+        :param hedged: race a duplicate request against a slow one, when hedging is turned on
+        """
+        request = self._hedged_request if hedged and self._latency else self._request
+        if self.cache is None:
+            response = await request(url, params)
+            response.raise_for_status()
+            return self._loads(response.content)
+
+        loop = asyncio.get_running_loop()
+        key, cached, fresh = await loop.run_in_executor(None, self._cache_lookup, url, params)
+        if fresh:
+            return self._loads(cached.body)
+
+        # if we have a stale copy, ask the server whether it has changed rather than pulling it down again
+        headers = cached.validators() if cached else None
+        response = await request(url, params, headers)
+        return await loop.run_in_executor(None, self._cache_response, key, cached, response, ttl)
+
+    async def _request(self, url, params=None, headers=None) -> requests.Response:
+        """ sends a GET through the rate limiter, a 429 pauses the limiter for everybody sharing it """
+        if self.rate_limiter:
+            await self.rate_limiter.acquire_async()
+        try:
+            async with self._session().get(url, params=params, headers=headers) as reply:
+                response = requests.Response()
+                response.status_code = reply.status
+                response.reason = reply.reason
+                response.url = str(reply.url)
+                response.headers = CaseInsensitiveDict(reply.headers)
+                response._content = await reply.read()
+        except asyncio.TimeoutError as err:
+            raise requests.Timeout('Request to %s timed out' % url) from err
+        except aiohttp.ClientConnectionError as err:
+            raise requests.ConnectionError(str(err)) from err
+
+        if self.rate_limiter and response.status_code == requests.codes.too_many_requests:
+            await self.rate_limiter.pause_async(retry_after_seconds(response.headers.get('Retry-After')) or 1)
+        return response
+
+    async def _hedged_request(self, url, params=None, headers=None) -> requests.Response:
+        """ sends a GET, and a duplicate if it's slow, both go through the rate limiter """
+        return await async_hedge(lambda: self._request(url, params, headers), self._latency)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from nhldata.nhl.v1.crawler import Crawler, transform_game
+from nhldata.nhl.v1_async.api import AsyncNHLApi
+from nhldata.sharding import Shard
+from nhldata.storage import Storage, StorageKey
+
+LOG = logging.getLogger(__name__)
+
+# boto3 has no async client, uploads run on a thread pool of at most this many threads
+MAX_UPLOAD_THREADS = 32
+
+
+class AsyncCrawler(Crawler):
+    """
+    Retrieves data from the NHL Data Api, with every boxscore request in flight on a single event loop
+    """
+    def __init__(self, api: AsyncNHLApi, storage: Storage, max_workers: int = 1, incremental: bool = False,
+                 output_format: str = 'csv', transform_processes: int = 0, concurrency=None, archive_raw: bool = False,
+                 planner=None, shard: Shard = None):
+        """
+        :param max_workers: number of games in flight at once, cheap enough to be in the hundreds
+        :param concurrency: adaptive concurrency isn't supported, requests in flight are set by max_workers
+        :param planner: season planning isn't supported, its schedule calls are blocking
+        """
+        if concurrency is not None:
+            raise ValueError('Adaptive concurrency is not supported by the async crawler, use max_workers instead')
+        if planner is not None:
+            raise ValueError('Season planning is not supported by the async crawler, use the v1 api version instead')
+        super().__init__(api, storage, max_workers=max_workers, incremental=incremental, output_format=output_format,
+                         transform_processes=transform_processes, archive_raw=archive_raw, shard=shard)
+
+    def crawl(self, start_date: datetime, end_date: datetime) -> None:
+        asyncio.run(self.crawl_async(start_date, end_date))
+
+    async def crawl_async(self, start_date: datetime, end_date: datetime) -> None:
+        try:
+            # get the schedule info
+            game_schedule = await self.api.schedule(start_date, end_date)
+
+            # return if no games were played between the start_date and end_date
+            if game_schedule.get('totalGames') == 0:
+                LOG.info('No NHL games found between %s and %s' % (start_date, end_date))
+                return
+
+            game_keys = self._sharded(self._extract_game_keys(game_schedule, self.output_format))
+            if self.incremental:
+                # the filter lists the bucket as it goes, so it's run to completion away from the event loop
+                game_keys = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: list(self._missing_game_keys(game_keys)))
+            await self._crawl_games(game_keys)
+        finally:
+            await self.api.aclose()
+
+    async def _crawl_games(self, game_keys: [StorageKey]) -> None:
+        """
+        Fetches, transforms and uploads every game with max_workers games in flight
+
+        The first failure cancels the games still in flight and is re-raised.
+        """
+        loop = asyncio.get_running_loop()
+        transform_pool = ProcessPoolExecutor(max_workers=self.transform_processes) if self.transform_processes \
+            else None
+        upload_pool = ThreadPoolExecutor(max_workers=min(self.max_workers, MAX_UPLOAD_THREADS),
+                                         thread_name_prefix='nhldata-upload')
+        # every worker pulls the next game from the same iterator, so only max_workers games are ever in memory
+        pending = iter(game_keys)
+        crawled = []
+
+        async def worker():
+            for key in pending:
+                fetched = await self._fetch_game_async(key)
+                # without a process pool the transform runs on the loop's default thread pool
+                item = await loop.run_in_executor(transform_pool, transform_game, fetched)
+                await loop.run_in_executor(upload_pool, self._store_game, item)
+                crawled.append(key)
+
+        started = time.perf_counter()
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.max_workers)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        finally:
+            upload_pool.shutdown()
+            if transform_pool is not None:
+                transform_pool.shutdown()
+            LOG.info('Crawled %s games in %.2fs' % (len(crawled), time.perf_counter() - started))
+
+    async def _fetch_game_async(self, key: StorageKey) -> tuple:
+        """Fetches the boxscore of a game"""
+        try:
+            return key, await self.api.boxscore(key.game_id), self.output_format, self.archive_raw
+        except Exception:
+            LOG.error('Failed to fetch game %s' % key.game_id)
+            raise
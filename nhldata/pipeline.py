@@ -0,0 +1,158 @@
+"""
+A small staged pipeline: items flow through a chain of stages connected by bounded queues.
+
+Every stage runs its function on its own pool of worker threads, so I/O bound stages overlap with each other and with
+CPU bound ones.  A CPU bound stage can hand its work to a process pool instead, its threads then just wait on the
+processes.  The queues between stages are bounded, which gives us backpressure: when a downstream stage falls behind,
+the stages upstream of it block instead of piling results up in memory, however many items are fed in.
+
+The first exception raised by any stage stops the pipeline.  Items already in flight are drained without being
+processed, and the exception is re-raised from Pipeline.run().
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+LOG = logging.getLogger(__name__)
+
+# marks the end of a stage's input, one is sent per worker
+_DONE = object()
+
+
+@dataclass
+class StageStats:
+    """Class for keeping track of a stage's throughput"""
+    name: str
+    processed: int = 0
+    failed: int = 0
+    busy_seconds: float = 0
+    elapsed_seconds: float = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.busy_seconds += seconds
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+    def throughput(self) -> float:
+        """ items per second over the wall-clock life of the stage """
+        return self.processed / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def summary(self) -> str:
+        return '%s: %s items in %.2fs (%.2f/s), %.2fs busy, %s failed' % (
+            self.name, self.processed, self.elapsed_seconds, self.throughput(), self.busy_seconds, self.failed)
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable, workers: int = 1, executor: Executor = None):
+        """
+        :param name: name to report the stage's stats under
+        :param func: called with each item, its return value is passed on to the next stage
+        :param workers: number of threads running func, or waiting on the executor
+        :param executor: optional executor (e.g. a ProcessPoolExecutor) to run func in, func must then be picklable
+        """
+        if workers < 1:
+            raise ValueError('A stage needs at least one worker: got %s' % workers)
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.executor = executor
+
+    def __call__(self, item):
+        if self.executor is None:
+            return self.func(item)
+        return self.executor.submit(self.func, item).result()
+
+
+class Pipeline:
+    def __init__(self, stages: [Stage], queue_size: int = None):
+        """
+        :param stages: stages in the order items flow through them
+        :param queue_size: bound on each queue between stages, defaults to twice the consuming stage's workers
+        """
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items: Iterable) -> [StageStats]:
+        """
+        Pushes every item through the pipeline and waits for it to drain
+
+        :return: the stats of every stage
+        """
+        queues = [queue.Queue(maxsize=self.queue_size or 2 * stage.workers) for stage in self.stages]
+        stats = [StageStats(stage.name) for stage in self.stages]
+        abort = threading.Event()
+        errors = []
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+        started = time.perf_counter()
+
+        def fail(err):
+            with remaining_lock:
+                errors.append(err)
+            abort.set()
+
+        def work(idx):
+            stage = self.stages[idx]
+            outbox = queues[idx + 1] if idx + 1 < len(self.stages) else None
+            while True:
+                item = queues[idx].get()
+                if item is _DONE:
+                    break
+                # once something has failed we only drain the queue, so nothing upstream stays blocked on a put
+                if abort.is_set():
+                    continue
+                start = time.perf_counter()
+                try:
+                    result = stage(item)
+                except Exception as err:
+                    stats[idx].record(time.perf_counter() - start, False)
+                    LOG.error('Pipeline stage %s failed: %r' % (stage.name, err))
+                    fail(err)
+                    continue
+                stats[idx].record(time.perf_counter() - start, True)
+                if outbox is not None:
+                    outbox.put(result)
+
+            # the last worker out of a stage tells every worker of the next stage there's nothing more coming
+            with remaining_lock:
+                remaining[idx] -= 1
+                last = remaining[idx] == 0
+            if last:
+                stats[idx].elapsed_seconds = time.perf_counter() - started
+                if outbox is not None:
+                    for _ in range(self.stages[idx + 1].workers):
+                        outbox.put(_DONE)
+
+        threads = [threading.Thread(target=work, args=(idx,), name=f'pipeline-{stage.name}-{worker}', daemon=True)
+                   for idx, stage in enumerate(self.stages) for worker in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in items:
+                if abort.is_set():
+                    break
+                queues[0].put(item)
+        except Exception as err:
+            fail(err)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        for stage_stats in stats:
+            LOG.info(stage_stats.summary())
+        if errors:
+            raise errors[0]
+        return stats
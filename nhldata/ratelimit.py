@@ -0,0 +1,148 @@
+"""
+Token bucket rate limiting for outgoing API requests.
+
+The retry decorator only reacts once the API has started returning 429s.  A token bucket spaces requests out up front
+instead: tokens refill at `rate` per second up to `burst`, and every request takes one, waiting for a refill when the
+bucket is empty.  When the API does throttle us, pause() stops the whole bucket (every thread, and every process for
+FileTokenBucket) for the Retry-After period, rather than just the one caller that got the 429.
+
+acquire_async() and pause_async() are acquire() and pause() for coroutines, they wait without blocking the event
+loop.  FileTokenBucket's file lock can be held by another process for a while, so its state is read and written in
+the loop's default executor.
+
+TokenBucket is shared between the threads of a process.  FileTokenBucket keeps its state in a small file guarded by
+an advisory lock, so every process on the machine that points at the same file shares one budget.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class BucketState:
+    tokens: float
+    updated: float
+    paused_until: float = 0.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: sustained requests per second
+        :param burst: the most requests that can go out back to back after the bucket has been idle
+        """
+        if rate <= 0:
+            raise ValueError('rate must be greater than zero: got %s' % rate)
+        if burst < 1:
+            raise ValueError('burst must be at least 1: got %s' % burst)
+        self.rate = rate
+        self.burst = burst
+        # whether getting at the state can block for long enough that coroutines have to do it in an executor
+        self._blocking = False
+        self._lock = threading.Lock()
+        self._state = BucketState(tokens=burst, updated=time.time())
+
+    @contextmanager
+    def _locked_state(self):
+        """ yields the bucket state while nobody else can change it, changes are kept when the block exits """
+        with self._lock:
+            yield self._state
+
+    def _take(self, state: BucketState, now: float) -> float:
+        """ takes a token if there is one, otherwise returns how long to wait before trying again """
+        state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+        if now < state.paused_until:
+            return state.paused_until - now
+        if state.tokens >= 1:
+            state.tokens -= 1
+            return 0.0
+        return (1 - state.tokens) / self.rate
+
+    def _try_acquire(self) -> float:
+        """ takes a token if there is one, otherwise returns how long to wait before trying again """
+        with self._locked_state() as state:
+            return self._take(state, time.time())
+
+    def acquire(self) -> float:
+        """
+        Blocks until a request is allowed to go out
+
+        :return: the number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self) -> float:
+        """ the same as acquire, but waits without blocking the event loop """
+        waited = 0.0
+        while True:
+            wait = await self._run_async(self._try_acquire)
+            if wait <= 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float) -> None:
+        """ stops handing out tokens for the next `seconds`, for everybody sharing the bucket """
+        with self._locked_state() as state:
+            state.paused_until = max(state.paused_until, time.time() + seconds)
+            # start again from an empty bucket so we don't burst straight back into the limit
+            state.tokens = 0
+        LOG.info('Rate limiter paused for %ss' % seconds)
+
+    async def pause_async(self, seconds: float) -> None:
+        """ the same as pause, but without blocking the event loop """
+        await self._run_async(self.pause, seconds)
+
+    async def _run_async(self, call, *args):
+        """ runs a call that touches the state, in an executor when it might block """
+        if self._blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, call, *args)
+        return call(*args)
+
+
+class FileTokenBucket(TokenBucket):
+    _FORMAT = '3d'
+
+    def __init__(self, path: str, rate: float, burst: int = 1):
+        """
+        :param path: state file shared by every process using this bucket, created if it doesn't exist
+        """
+        super().__init__(rate, burst)
+        self._blocking = True
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def _locked_state(self):
+        # the thread lock serialises our own threads, flock serialises us with other processes
+        with self._lock, open(self.path, 'a+b') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                handle.seek(0)
+                raw = handle.read(struct.calcsize(self._FORMAT))
+                if len(raw) == struct.calcsize(self._FORMAT):
+                    state = BucketState(*struct.unpack(self._FORMAT, raw))
+                else:
+                    state = BucketState(tokens=self.burst, updated=time.time())
+                yield state
+                handle.seek(0)
+                handle.truncate()
+                handle.write(struct.pack(self._FORMAT, state.tokens, state.updated, state.paused_until))
+                handle.flush()
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
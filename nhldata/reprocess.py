@@ -0,0 +1,90 @@
+"""
+Re-renders games from the raw boxscore archive instead of the API.
+
+Crawls run with archive_raw keep every boxscore response under raw/ (see Storage.raw_key).  After a change to the
+header or to the transform, reprocessing downloads the archived responses, renders them again in a process pool and
+overwrites the stored games, so a full history reshape runs at local CPU speed instead of at API speed.
+
+It runs on the same fetch -> transform -> upload pipeline as the crawler, with S3 downloads in place of API calls.
+"""
+import json
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from nhldata.nhl.v1.crawler import render_game, validate_output_format
+from nhldata.pipeline import Pipeline, Stage
+from nhldata.storage import RAW_EXTENSION, RAW_PREFIX, Storage, StorageKey, decompress
+
+LOG = logging.getLogger(__name__)
+
+RAW_GAME_KEY = re.compile(r'^%s(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/(?P<game_id>\d+)\.%s$' % (
+    re.escape(RAW_PREFIX), re.escape(RAW_EXTENSION)))
+
+
+def rerender_game(item: tuple) -> tuple:
+    """
+    Renders an archived boxscore, lives at module level so it can run in a process pool
+
+    :param item: (StorageKey to store the game under, gzipped boxscore json)
+    :return: (StorageKey, rendered game)
+    """
+    key, raw = item
+    return key, render_game(key, json.loads(decompress(raw, 'gzip')), key.extension)
+
+
+class Reprocessor:
+    def __init__(self, storage: Storage, output_format: str = 'csv', processes: int = 0, max_workers: int = 4):
+        """
+        :param output_format: one of the crawler's SERIALIZERS to render the games in
+        :param processes: size of the process pool to render games in, 0 renders them in-process
+        :param max_workers: number of games to download, and to upload, concurrently
+        """
+        validate_output_format(output_format)
+        self.storage = storage
+        self.output_format = output_format
+        self.processes = processes
+        self.max_workers = max_workers
+
+    def archived_games(self, start_date: datetime = None, end_date: datetime = None):
+        """ yields the StorageKey of every archived game played inside the window, or of every archived game """
+        if start_date is None or end_date is None:
+            prefixes = [RAW_PREFIX]
+        else:
+            days = (end_date - start_date).days + 1
+            prefixes = [RAW_PREFIX + (start_date + timedelta(days=offset)).strftime('%Y/%m/%d/')
+                        for offset in range(days)]
+        for prefix in prefixes:
+            for obj in self.storage.list_objects(prefix):
+                match = RAW_GAME_KEY.match(obj['Key'])
+                if match:
+                    yield StorageKey(match['year'], match['month'], match['day'], match['game_id'],
+                                     self.output_format)
+
+    def _download(self, key: StorageKey) -> tuple:
+        # the body stays gzipped until it reaches the process pool, it's smaller to hand over that way
+        return key, self.storage.load_object(self.storage.raw_key(key))
+
+    def _upload(self, item: tuple) -> None:
+        key, game_data = item
+        self.storage.store_game(key, game_data)
+
+    def run(self, start_date: datetime = None, end_date: datetime = None) -> int:
+        """
+        Re-renders and stores every archived game inside the window, or the whole archive without one
+
+        :return: the number of games reprocessed
+        """
+        executor = ProcessPoolExecutor(max_workers=self.processes) if self.processes else None
+        try:
+            stats = Pipeline([
+                Stage('download', self._download, workers=self.max_workers),
+                Stage('transform', rerender_game, workers=self.processes or 1, executor=executor),
+                Stage('upload', self._upload, workers=self.max_workers),
+            ]).run(self.archived_games(start_date, end_date))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        LOG.info('Reprocessed %s archived games' % stats[-1].processed)
+        return stats[-1].processed
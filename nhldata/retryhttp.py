@@ -14,11 +14,33 @@ If the backoff factor is set to:
 
 Jitter is a good idea to add to any system that might be running a pool of workers hitting the same API
 in order to prevent a thundering herd: https://en.wikipedia.org/wiki/Thundering_herd_problem
+
+Retrying every call on its own is wasteful when the API is down for everybody: a crawl of N games would climb N full
+backoff ladders before giving up.  A CircuitBreaker shared by the decorated calls counts consecutive server failures,
+and once it opens every call fails straight away with CircuitOpenError.  After recovery_timeout it lets a single probe
+call through, which closes the breaker again if it succeeds.
+
+The total time spent retrying can be capped too, per call with max_elapsed_seconds and per job with a shared Deadline.
+When the next sleep would overrun either of them the decorator stops retrying and raises the first error.
+
+hedge() goes after tail latency rather than failures: when a request hasn't answered within a percentile of recent
+latencies (tracked by a LatencyTracker) one duplicate is sent, and whichever answers first is used.
+
+Anything that wants to watch how the API is coping (like the crawler's concurrency controller) can register with
+observe_requests() to hear about every attempt a decorated call makes, retried ones included.
 """
+import asyncio
 import functools
 import logging
+import math
 import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import requests
 
@@ -56,8 +78,334 @@ def get_backoff(attempt_num: int, backoff_factor: float, max_jitter_pct: int, ma
     return min(jittered_sleep, max_sleep_seconds) if max_sleep_seconds else jittered_sleep
 
 
+def retry_after_seconds(retry_after: str):
+    """
+    Parses a Retry-After header, which is either a number of seconds or an HTTP date
+
+    :param retry_after: the header value, possibly None
+    :return: the number of seconds to wait, or None if the header is missing or unreadable
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        LOG.warning('Ignoring unreadable Retry-After header: %s' % retry_after)
+        return None
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of making a request while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30):
+        """
+        :param failure_threshold: consecutive failures that open the breaker
+        :param recovery_timeout: seconds to fail fast for before letting a probe call through
+        """
+        if failure_threshold < 1:
+            raise ValueError('failure_threshold must be at least 1: got %s' % failure_threshold)
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def before_call(self) -> None:
+        """ raises CircuitOpenError unless the call is allowed through """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            waited = time.monotonic() - self._opened_at
+            if waited < self.recovery_timeout:
+                raise CircuitOpenError('Circuit breaker is %s after %s failures, retrying in %.1fs' % (
+                    self._state, self.failures, self.recovery_timeout - waited))
+            # let one probe through, if it never reports back another one goes after the next recovery_timeout
+            self._state = self.HALF_OPEN
+            self._opened_at = time.monotonic()
+        LOG.info('Circuit breaker half-open, probing')
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                LOG.info('Circuit breaker closed')
+            self._state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    LOG.warning('Circuit breaker opened after %s failures' % self.failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class Deadline:
+    def __init__(self, seconds: float = None):
+        """
+        :param seconds: time budget from now, None for no deadline
+        """
+        self.expires_at = None
+        self.arm(seconds)
+
+    def arm(self, seconds: float = None) -> None:
+        """ restarts the budget from now, None removes the deadline """
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """ returns the seconds left before the deadline, or None if there isn't one """
+        return None if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+
+
+# shared by every decorated call of a job, armed by whatever starts the job
+JOB_DEADLINE = Deadline()
+
+
+def _remaining_budget(started: float, max_elapsed_seconds: float = None, deadline: Deadline = None):
+    """ returns the seconds left before the per-call or per-job budget runs out, whichever comes first """
+    budgets = []
+    if max_elapsed_seconds is not None:
+        budgets.append(max_elapsed_seconds - (time.monotonic() - started))
+    if deadline is not None and deadline.remaining() is not None:
+        budgets.append(deadline.remaining())
+    return min(budgets) if budgets else None
+
+
+class LatencyTracker:
+    def __init__(self, percentile: float = 95, window: int = 200, min_samples: int = 20):
+        """
+        :param percentile: latency percentile to report as the hedging threshold
+        :param window: number of most recent latencies to keep
+        :param min_samples: latencies to see before reporting a threshold at all
+        """
+        if not 0 < percentile < 100:
+            raise ValueError('percentile must be between 0 and 100: got %s' % percentile)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def threshold(self):
+        """ returns the current latency percentile in seconds, or None until enough latencies have been recorded """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[math.ceil(self.percentile / 100 * len(samples)) - 1]
+
+
+def hedge(func, tracker: LatencyTracker, executor: Executor):
+    """
+    Calls func, and calls it a second time if the first call is slower than the tracker's threshold
+
+    Whichever call answers first wins.  A call that raised only wins if both did, in which case the first error is
+    raised.  A duplicate that hasn't started yet is cancelled, one that is already in flight can't be interrupted, so
+    its answer is simply dropped when it arrives.
+
+    :param func: callable taking no arguments, it has to be safe to call twice
+    :param tracker: records the latency of every call and decides when to hedge
+    :param executor: runs the calls, it needs room for two of them per concurrent hedge() call
+    :return: the first answer
+    """
+    def timed():
+        started = time.monotonic()
+        try:
+            return func()
+        finally:
+            tracker.record(time.monotonic() - started)
+
+    threshold = tracker.threshold()
+    futures = [executor.submit(timed)]
+    done, _ = wait(futures, timeout=threshold)
+    if not done:
+        LOG.debug('Hedging a request slower than %.3fs' % threshold)
+        futures.append(executor.submit(timed))
+
+    errors = []
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                return future.result()
+            errors.append(future.exception())
+    raise errors[0]
+
+
+async def async_hedge(func, tracker: LatencyTracker):
+    """
+    The same as hedge, for a coroutine function, except the call that loses the race is cancelled
+
+    :param func: coroutine function taking no arguments, it has to be safe to call twice
+    """
+    async def timed():
+        started = time.monotonic()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            tracker.record(time.monotonic() - started)
+            raise
+        tracker.record(time.monotonic() - started)
+        return result
+
+    threshold = tracker.threshold()
+    tasks = [asyncio.ensure_future(timed())]
+    done, _ = await asyncio.wait(tasks, timeout=threshold)
+    if not done:
+        LOG.debug('Hedging a request slower than %.3fs' % threshold)
+        tasks.append(asyncio.ensure_future(timed()))
+
+    errors = []
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+    finally:
+        for task in pending:
+            task.cancel()
+    raise errors[0]
+
+
+# observer -> number of times it's registered, every one is told about every attempt of every decorated call
+_OBSERVERS = {}
+_OBSERVERS_LOCK = threading.Lock()
+
+
+@contextmanager
+def observe_requests(observer):
+    """
+    Calls observer.observe(seconds, error) after every attempt of every decorated call made while the block runs
+
+    error is whatever the attempt raised, or None if it succeeded.  An observer can be registered more than once,
+    it's told about each attempt once and stays registered until the outermost block exits.
+    """
+    with _OBSERVERS_LOCK:
+        _OBSERVERS[observer] = _OBSERVERS.get(observer, 0) + 1
+    try:
+        yield observer
+    finally:
+        with _OBSERVERS_LOCK:
+            _OBSERVERS[observer] -= 1
+            if not _OBSERVERS[observer]:
+                del _OBSERVERS[observer]
+
+
+def _notify(started: float, error: Exception = None) -> None:
+    with _OBSERVERS_LOCK:
+        observers = list(_OBSERVERS)
+    for observer in observers:
+        observer.observe(time.monotonic() - started, error)
+
+
+class _RetryPolicy:
+    """The decisions shared by retry and async_retry, the decorators only differ in how they call and sleep"""
+    def __init__(self, max_attempts, backoff_factor, max_jitter_pct, max_sleep_seconds, circuit_breaker,
+                 max_elapsed_seconds, deadline):
+        self.max_attempts = max_attempts
+        self.backoff_factor = backoff_factor
+        self.max_jitter_pct = max_jitter_pct
+        self.max_sleep_seconds = max_sleep_seconds
+        self.circuit_breaker = circuit_breaker
+        self.max_elapsed_seconds = max_elapsed_seconds
+        self.deadline = deadline
+
+    def before_attempt(self) -> float:
+        """ fails fast if the circuit breaker is open, otherwise returns the time the attempt started """
+        if self.circuit_breaker:
+            self.circuit_breaker.before_call()
+        return time.monotonic()
+
+    def succeeded(self, attempt_started: float) -> None:
+        _notify(attempt_started)
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+
+    def connection_failed(self, attempt_started: float, err: Exception) -> None:
+        _notify(attempt_started, err)
+        if self.circuit_breaker:
+            self.circuit_breaker.record_failure()
+
+    def http_failed(self, attempt: int, started: float, attempt_started: float, err: requests.HTTPError,
+                    error_list: list):
+        """
+        Records a failed attempt, re-raising the error if it isn't worth retrying
+
+        :return: how long to sleep before the next attempt, or None to give up
+        """
+        _notify(attempt_started, err)
+        LOG.info('Request returned status_code [%s]' % err.response.status_code)
+        error_list.append(err)
+
+        # if it's not an error we consider worth retryable, re-raise the exception
+        if err.response.status_code not in RETRYABLE_CODES:
+            # the server is up and answering, it just didn't like this request
+            if self.circuit_breaker:
+                self.circuit_breaker.record_success()
+            raise err
+
+        # being throttled says nothing about the API's health, the rate limiter deals with that
+        if self.circuit_breaker and err.response.status_code != requests.codes.too_many_requests:
+            self.circuit_breaker.record_failure()
+
+        # if we got a 429, look for Retry-After in the header and use that for the sleep duration
+        # if Retry-After isn't set (sigh), just fall back to get_backoff
+        backoff = get_backoff(attempt, self.backoff_factor, self.max_jitter_pct, self.max_sleep_seconds)
+        if err.response.status_code == requests.codes.too_many_requests:
+            sleep_duration = retry_after_seconds(err.response.headers.get('Retry-After')) or backoff
+        else:
+            sleep_duration = backoff
+
+        budget = _remaining_budget(started, self.max_elapsed_seconds, self.deadline)
+        if budget is not None and float(sleep_duration) > budget:
+            LOG.warning('Giving up after %s attempts, sleeping %ss would exceed the time budget' % (
+                attempt + 1, float(sleep_duration)))
+            return None
+
+        LOG.info('Sleeping for: %ss' % float(sleep_duration))
+        return float(sleep_duration)
+
+    @staticmethod
+    def give_up(error_list: list):
+        # if we've made it this far, it's not happening, so just log the codes and re-raise the first error
+        for idx, error in enumerate(error_list):
+            status_code = error_list[idx].response.status_code
+            LOG.error('HTTP Retry Attempt [%s] returned status_code [%s]' % (idx, status_code))
+        LOG.error('Re-raising the first error encountered:')
+        raise error_list[0]
+
+
 # DECORATOR
-def retry(max_attempts: int = 5, backoff_factor: int = 0, max_jitter_pct: int = 25, max_sleep_seconds: float = None):
+def retry(max_attempts: int = 5, backoff_factor: int = 0, max_jitter_pct: int = 25, max_sleep_seconds: float = None,
+          circuit_breaker: CircuitBreaker = None, max_elapsed_seconds: float = None, deadline: Deadline = None):
     """
     Retries HTTP requests if a retryable failure status code is raised by Requests
 
@@ -65,43 +413,78 @@ def retry(max_attempts: int = 5, backoff_factor: int = 0, max_jitter_pct: int =
     :param backoff_factor: backoff factor to apply between attempts
     :param max_jitter_pct: the maximum percentage to randomly increase the sleep time by
     :param max_sleep_seconds: the maximum amount of time to wait between requests
+    :param circuit_breaker: optional breaker shared with other calls, server errors and connection failures trip it
+    :param max_elapsed_seconds: stop retrying once a call has taken this long, including its sleeps
+    :param deadline: stop retrying once this shared deadline has passed
     :return: None
     """
+    policy = _RetryPolicy(max_attempts, backoff_factor, max_jitter_pct, max_sleep_seconds, circuit_breaker,
+                          max_elapsed_seconds, deadline)
+
     def decorator_retry(func):
         @functools.wraps(func)
         def wrapper_retry(*args, **kwargs):
             # save the list of errors we receive for post-mortem analysis
             error_list = []
+            started = time.monotonic()
 
             for attempt in range(max_attempts):
+                attempt_started = policy.before_attempt()
                 # run the http request and catch HTTPErrors
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    policy.connection_failed(attempt_started, err)
+                    raise
                 except requests.HTTPError as err:
-                    LOG.info('Request returned status_code [%s]' % err.response.status_code)
-                    error_list.append(err)
+                    sleep_duration = policy.http_failed(attempt, started, attempt_started, err, error_list)
+                    if sleep_duration is None:
+                        break
+                    # sleep before trying again
+                    time.sleep(sleep_duration)
+                else:
+                    policy.succeeded(attempt_started)
+                    return result
 
-                    # if it's not an error we consider worth retryable, re-raise the exception
-                    if err.response.status_code not in RETRYABLE_CODES:
-                        raise err
+            policy.give_up(error_list)
+        return wrapper_retry
+    return decorator_retry
 
-                    # if we got a 429, look for Retry-After in the header and use that for the sleep duration
-                    # if Retry-After isn't set (sigh), just fall back to get_backoff
-                    if err.response.status_code == requests.codes.too_many_requests:
-                        sleep_duration = err.response.headers.get('Retry-After') or \
-                                         get_backoff(attempt, backoff_factor, max_jitter_pct, max_sleep_seconds)
-                    else:
-                        sleep_duration = get_backoff(attempt, backoff_factor, max_jitter_pct, max_sleep_seconds)
 
-                    # sleep before trying again
-                    LOG.info('Sleeping for: %ss' % float(sleep_duration))
-                    time.sleep(float(sleep_duration))
-
-            # if we've made it this far, it's not happening, so just log the codes and re-raise the first error
-            for idx, error in enumerate(error_list):
-                status_code = error_list[idx].response.status_code
-                LOG.error('HTTP Retry Attempt [%s] returned status_code [%s]' % (idx, status_code))
-            LOG.error('Re-raising the first error encountered:')
-            raise error_list[0]
+def async_retry(max_attempts: int = 5, backoff_factor: int = 0, max_jitter_pct: int = 25,
+                max_sleep_seconds: float = None, circuit_breaker: CircuitBreaker = None,
+                max_elapsed_seconds: float = None, deadline: Deadline = None):
+    """
+    The same as retry, for coroutine functions: sleeps between attempts without blocking the event loop
+
+    The decorated coroutine has to raise requests exceptions, an HTTPError for a failed response like raise_for_status
+    does, and ConnectionError or Timeout when it couldn't get a response at all.
+    """
+    policy = _RetryPolicy(max_attempts, backoff_factor, max_jitter_pct, max_sleep_seconds, circuit_breaker,
+                          max_elapsed_seconds, deadline)
+
+    def decorator_retry(func):
+        @functools.wraps(func)
+        async def wrapper_retry(*args, **kwargs):
+            error_list = []
+            started = time.monotonic()
+
+            for attempt in range(max_attempts):
+                attempt_started = policy.before_attempt()
+                try:
+                    result = await func(*args, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    policy.connection_failed(attempt_started, err)
+                    raise
+                except requests.HTTPError as err:
+                    sleep_duration = policy.http_failed(attempt, started, attempt_started, err, error_list)
+                    if sleep_duration is None:
+                        break
+                    await asyncio.sleep(sleep_duration)
+                else:
+                    policy.succeeded(attempt_started)
+                    return result
+
+            policy.give_up(error_list)
         return wrapper_retry
     return decorator_retry
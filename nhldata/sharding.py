@@ -0,0 +1,26 @@
+"""
+Static partitioning of games across hosts.
+
+Every host crawls the same window with the same shard count and its own shard index, and keeps only the games that
+hash to its index.  The hash is a crc32 of the gamePk, so the split is the same on every host and every run, and
+spreads each day's games evenly whatever the window.
+"""
+import zlib
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if not 0 <= self.index < self.count:
+            raise ValueError('shard index must satisfy 0 <= index < count: got %s, %s' % (self.index, self.count))
+
+    def owns(self, game_id: str) -> bool:
+        """ tells whether a game belongs to this shard """
+        return zlib.crc32(str(game_id).encode('utf-8')) % self.count == self.index
+
+    def name(self) -> str:
+        return f'shard{self.index}of{self.count}'
@@ -1,5 +1,94 @@
+"""
+Object storage for game and job data.
+
+Game objects can be stored compressed.  The compression is part of the key (2020/09/13/2019030314.csv.gz) and is
+also set as the object's Content-Encoding, so anything reading the bucket can tell how to decode an object from its
+key alone.  Every method that takes a raw key compresses or decompresses based on the key's suffix.
+
+The raw boxscore responses the games were rendered from are archived as gzipped JSON under RAW_PREFIX, in the same
+layout as the games (raw/2020/09/13/2019030314.json.gz), so games can be re-rendered without going back to the API.
+
+Job objects can be written conditionally (store_job_if), with S3's If-None-Match and If-Match, so workers on several
+hosts can coordinate through the jobs bucket without anything else to share.
+
+A Storage, and the boto3 client under it, can be shared by any number of threads.  boto3 clients keep a pool of
+connections that should be at least as large as the number of threads uploading at once, past that threads queue up
+for connections and urllib3 throws the extra ones away.  The crawler's and the reprocessor's upload stages run one
+thread per concurrent upload over that pool.
+
+Large bodies, like compacted files, are streamed from a file object through boto3's managed transfer, which switches
+to a multipart upload once a body is bigger than MULTIPART_THRESHOLD.
+"""
+import gzip
+import io
+import logging
+from contextlib import contextmanager
 from dataclasses import dataclass
 
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# botocore's own default size for a client's connection pool
+DEFAULT_MAX_CONNECTIONS = 10
+
+# error codes S3 answers a conditional write with when the condition doesn't hold, or loses to a concurrent write
+CONDITION_FAILED_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+RAW_PREFIX = 'raw/'
+RAW_EXTENSION = 'json.gz'
+
+# compression name -> key suffix, the name is also the Content-Encoding
+COMPRESSION_SUFFIXES = {
+    'gzip': 'gz',
+    'zstd': 'zst',
+}
+
+
+def compression_for_key(key: str):
+    """ returns the compression an object was stored with, judging by its key, or None """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if key.endswith(f'.{suffix}'):
+            return compression
+    return None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('zstd compression requires zstandard, install it with `pip install nhldata[zstd]`')
+
+
+def compress(data: [str, bytes], compression: str) -> bytes:
+    data = data.encode('utf-8') if isinstance(data, str) else data
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        _require_zstandard()
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    return data
+
+
+class ConditionFailed(Exception):
+    """ raised when a conditional write finds the object isn't in the state it was expected to be in """
+    pass
+
 
 @dataclass
 class StorageKey:
@@ -7,22 +96,171 @@ class StorageKey:
     game_month: str
     game_day: str
     game_id: str
+    extension: str = 'csv'
 
     def key(self):
         """ renders the s3 key for the given set of properties """
-        return '/'.join([self.game_year, self.game_month, self.game_day, f'{self.game_id}.csv'])
+        return '/'.join([self.game_year, self.game_month, self.game_day, f'{self.game_id}.{self.extension}'])
+
+    def prefix(self):
+        """ renders the s3 prefix shared by every game played on the same day """
+        return '/'.join([self.game_year, self.game_month, self.game_day, ''])
 
 
 class Storage:
-    def __init__(self, data_bucket, jobs_bucket, s3_client):
+    def __init__(self, data_bucket, jobs_bucket, s3_client, compression: str = None):
+        """
+        :param compression: compress game objects with gzip or zstd, None to store them as is
+        """
+        if compression is not None and compression not in COMPRESSION_SUFFIXES:
+            raise ValueError('Compression %s is unsupported, please choose from [%s]'
+                             % (compression, list(COMPRESSION_SUFFIXES)))
         self._s3_client = s3_client
         self.data_bucket = data_bucket
         self.jobs_bucket = jobs_bucket
+        self.compression = compression
 
-    def store_game(self, key: StorageKey, game_data: str) -> bool:
-        self._s3_client.put_object(Bucket=self.data_bucket, Key=key.key(), Body=game_data)
+    def object_key(self, key: StorageKey) -> str:
+        """ renders the key a game is actually stored under, including the compression suffix """
+        return f'{key.key()}.{COMPRESSION_SUFFIXES[self.compression]}' if self.compression else key.key()
+
+    def store_game(self, key: StorageKey, game_data: [str, bytes]) -> bool:
+        return self.store_data(self.object_key(key), game_data)
+
+    @staticmethod
+    def raw_key(key: StorageKey) -> str:
+        """ renders the key a game's raw boxscore is archived under, whatever format the game itself is stored in """
+        return RAW_PREFIX + StorageKey(key.game_year, key.game_month, key.game_day, key.game_id, RAW_EXTENSION).key()
+
+    def store_raw_game(self, key: StorageKey, raw_json: bytes) -> bool:
+        """ archives a game's raw boxscore response, gzipped """
+        return self.store_data(self.raw_key(key), raw_json)
+
+    def list_games(self, prefix: str) -> set:
+        """ returns the keys of every game object stored under the given prefix """
+        return {obj['Key'] for obj in self.list_objects(prefix)}
+
+    def list_objects(self, prefix: str = ''):
+        """ yields the listing (Key, ETag, Size, LastModified) of every object in the data bucket under a prefix """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.data_bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def list_prefixes(self, prefix: str = '') -> [str]:
+        """ returns the prefixes one level below a prefix in the data bucket, '2020/' or 'raw/' at the top """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        return [common['Prefix'] for page in paginator.paginate(Bucket=self.data_bucket, Prefix=prefix, Delimiter='/')
+                for common in page.get('CommonPrefixes', [])]
+
+    def store_data(self, key: str, data: [str, bytes]) -> bool:
+        """ stores a body held in memory, compressing it if the key asks for it """
+        compression = compression_for_key(key)
+        if compression is None:
+            self._s3_client.put_object(Bucket=self.data_bucket, Key=key, Body=data)
+        else:
+            self._s3_client.put_object(Bucket=self.data_bucket, Key=key, Body=compress(data, compression),
+                                       ContentEncoding=compression)
+        return True
+
+    @contextmanager
+    def compressed_writer(self, fileobj, key: str):
+        """
+        Wraps a binary file object so that everything written to it is compressed the way the key asks for
+
+        The file object itself is left open so it can be handed to store_stream afterwards.
+        """
+        compression = compression_for_key(key)
+        if compression == 'gzip':
+            with gzip.GzipFile(fileobj=fileobj, mode='wb') as writer:
+                yield writer
+        elif compression == 'zstd':
+            _require_zstandard()
+            with zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False) as writer:
+                yield writer
+        else:
+            yield fileobj
+
+    def store_stream(self, key: str, fileobj) -> bool:
+        """
+        Uploads an already encoded body from a file object without holding it in memory, using a multipart upload
+        once it is larger than MULTIPART_THRESHOLD
+        """
+        compression = compression_for_key(key)
+        extra_args = {'ContentEncoding': compression} if compression else None
+        config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_THRESHOLD)
+        self._s3_client.upload_fileobj(fileobj, self.data_bucket, key, ExtraArgs=extra_args, Config=config)
+        return True
+
+    def load_data(self, key: str) -> bytes:
+        """ returns the decoded body of an object, decompressing it if its key says it's compressed """
+        return decompress(self.load_object(key), compression_for_key(key))
+
+    def open_data(self, key: str):
+        """ returns a file object that reads the decoded body of an object as it downloads """
+        body = self._s3_client.get_object(Bucket=self.data_bucket, Key=key)['Body']
+        compression = compression_for_key(key)
+        if compression == 'gzip':
+            return gzip.GzipFile(fileobj=body, mode='rb')
+        if compression == 'zstd':
+            _require_zstandard()
+            return zstandard.ZstdDecompressor().stream_reader(body)
+        return body
+
+    def load_object(self, key: str) -> bytes:
+        """ returns the body of an object as it's stored, still compressed if it was stored compressed """
+        return self._s3_client.get_object(Bucket=self.data_bucket, Key=key)['Body'].read()
+
+    def delete_data(self, key: str) -> bool:
+        self._s3_client.delete_object(Bucket=self.data_bucket, Key=key)
         return True
 
     def store_job(self, key: str, job_data: str) -> bool:
         self._s3_client.put_object(Bucket=self.jobs_bucket, Key=key, Body=job_data)
         return True
+
+    def store_job_if(self, key: str, job_data: str, etag: str = None) -> str:
+        """
+        Stores a job object only if nobody else has written it since it was read
+
+        :param etag: the ETag the object must still have, None if it must not exist yet
+        :return: the ETag of the stored object
+        :raises ConditionFailed: when the object has changed, or already exists
+        """
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = self._s3_client.put_object(Bucket=self.jobs_bucket, Key=key, Body=job_data, **condition)
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') in CONDITION_FAILED_CODES:
+                raise ConditionFailed(key) from err
+            raise
+        return response['ETag']
+
+    def load_job(self, key: str) -> tuple:
+        """ returns the body of a job object and its ETag, (None, None) if there isn't one """
+        try:
+            response = self._s3_client.get_object(Bucket=self.jobs_bucket, Key=key)
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') == 'NoSuchKey':
+                return None, None
+            raise
+        return response['Body'].read().decode('utf-8'), response['ETag']
+
+    def open_job(self, key: str):
+        """ returns a file object that reads the body of a job object as it downloads """
+        return self._s3_client.get_object(Bucket=self.jobs_bucket, Key=key)['Body']
+
+    def delete_job(self, key: str) -> bool:
+        self._s3_client.delete_object(Bucket=self.jobs_bucket, Key=key)
+        return True
+
+    def list_job_objects(self, prefix: str = ''):
+        """ yields the listing (Key, ETag, Size, LastModified) of every object in the jobs bucket under a prefix """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.jobs_bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def list_jobs(self, prefix: str) -> set:
+        """ returns the keys of every object in the jobs bucket under the given prefix """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        return {obj['Key'] for page in paginator.paginate(Bucket=self.jobs_bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])}
@@ -7,10 +7,17 @@ setup(
     packages=find_packages(),
     install_requires=[
         'requests>=2.24.0,<=2.25.0',
-        'pandas>=1.1.0,<=1.2.0',
-        'boto3>=1.14.38,<=1.15.0',
+        'boto3>=1.36.0,<2.0.0',
         'click>=7.1.2,<=7.2.0'
     ],
+    extras_require={
+        'fast': ['orjson>=3.4.0'],
+        'parquet': ['pyarrow>=2.0.0'],
+        'zstd': ['zstandard>=0.15.0'],
+        'async': ['aiohttp>=3.7.0'],
+        'stream': ['ijson>=3.1.0'],
+        'postgres': ['psycopg2-binary>=2.8.6'],
+    },
     entry_points={
         'console_scripts': [
             'nhldata = nhldata.app:main'
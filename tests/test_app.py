@@ -3,7 +3,7 @@ from unittest.mock import patch
 from click.testing import CliRunner
 
 from nhldata import __version__
-from nhldata.app import main, splash
+from nhldata.app import build_storage, main, splash
 
 
 def test_splash_with_debug_on(capsys):
@@ -60,3 +60,32 @@ def test_cli_main_with_exception(mock_factory, monkeypatch, data_bucket, job_buc
     assert result.exit_code == 0
     assert __version__ in result.output
     assert 'log level is INFO and higher' in result.output
+
+
+@patch('nhldata.app.API_FACTORY')
+def test_cli_backfill(mock_factory, monkeypatch, data_bucket, job_bucket):
+    monkeypatch.setenv("DEST_BUCKET", 'testdatabucket')
+    monkeypatch.setenv("JOB_BUCKET", 'testjobbucket')
+
+    runner = CliRunner()
+    result = runner.invoke(main, ['backfill', '--from-date', '2020-01-01', '--to-date', '2020-01-10'])
+
+    assert result.exit_code == 0
+    assert 'Backfill 2020-01-01_2020-01-10 crawled 2 chunks' in result.output
+
+
+def test_cli_reprocess(monkeypatch, data_bucket):
+    monkeypatch.setenv("DEST_BUCKET", 'testdatabucket')
+    monkeypatch.setenv("JOB_BUCKET", 'testjobbucket')
+    runner = CliRunner()
+    result = runner.invoke(main, ['reprocess', '--processes', '0'])
+
+    assert result.exit_code == 0
+    assert 'Reprocessed 0 games' in result.output
+
+
+def test_build_storage_sizes_the_connection_pool():
+    storage = build_storage(max_connections=32)
+
+    assert storage._s3_client.meta.config.max_pool_connections == 32
+    assert build_storage(max_connections=1)._s3_client.meta.config.max_pool_connections == 10
@@ -0,0 +1,122 @@
+from contextlib import nullcontext
+from datetime import datetime
+from unittest.mock import Mock, patch
+
+import boto3
+import pytest
+
+from nhldata.backfill import Backfill, BackfillError, CheckpointJournal, Chunk, plan_chunks
+from nhldata.storage import Storage
+
+
+@pytest.fixture
+def journal(job_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+    yield CheckpointJournal(storage, 'test-backfill')
+
+
+def test_plan_chunks():
+    result = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 17), chunk_days=7)
+
+    assert result == [
+        Chunk(datetime(2020, 1, 1), datetime(2020, 1, 7)),
+        Chunk(datetime(2020, 1, 8), datetime(2020, 1, 14)),
+        Chunk(datetime(2020, 1, 15), datetime(2020, 1, 17)),
+    ]
+
+
+def test_plan_chunks_single_day():
+    result = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 1))
+
+    assert result == [Chunk(datetime(2020, 1, 1), datetime(2020, 1, 1))]
+
+
+def test_plan_chunks_invalid_size():
+    with pytest.raises(ValueError):
+        plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 2), chunk_days=0)
+
+
+def test_chunk_name():
+    assert Chunk(datetime(2020, 1, 1), datetime(2020, 1, 7)).name() == '2020-01-01_2020-01-07'
+
+
+def test_journal_records_completed_chunks(journal, job_bucket):
+    journal.record(Chunk(datetime(2020, 1, 1), datetime(2020, 1, 7)))
+
+    assert journal.completed() == {'2020-01-01_2020-01-07'}
+    assert [obj.key for obj in job_bucket.objects.all()] == ['backfills/test-backfill/2020-01-01_2020-01-07.json']
+
+
+def test_backfill_resumes_from_checkpoint(journal):
+    chunks = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 21), chunk_days=7)
+    journal.record(chunks[0])
+    crawler = Mock()
+
+    result = Backfill(crawler, journal, parallel_chunks=2).run(chunks)
+
+    assert result == chunks[1:]
+    assert crawler.crawl.call_count == 2
+    assert journal.completed() == {chunk.name() for chunk in chunks}
+
+
+def test_backfill_checkpoints_successful_chunks_when_others_fail(journal):
+    chunks = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 21), chunk_days=7)
+
+    def crawl(start_date, end_date):
+        if start_date == chunks[1].start_date:
+            raise ValueError('boom')
+
+    crawler = Mock()
+    crawler.crawl.side_effect = crawl
+
+    with pytest.raises(BackfillError):
+        Backfill(crawler, journal).run(chunks)
+
+    assert journal.completed() == {chunks[0].name(), chunks[2].name()}
+
+
+@patch('nhldata.backfill.time.sleep')
+def test_backfill_waits_for_chunks_leased_elsewhere(mock_sleep, journal):
+    chunks = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 21), chunk_days=7)
+    leases = Mock(lease_seconds=30)
+    leases.claim.side_effect = lambda name: None if name == chunks[1].name() else Mock()
+    leases.hold.return_value = nullcontext()
+    # the worker holding the second chunk finishes it while this one waits
+    mock_sleep.side_effect = lambda seconds: journal.record(chunks[1])
+    crawler = Mock()
+
+    result = Backfill(crawler, journal, leases=leases).run(chunks)
+
+    assert result == [chunks[0], chunks[2]]
+    assert crawler.crawl.call_count == 2
+    mock_sleep.assert_called_once_with(10)
+    assert journal.completed() == {chunk.name() for chunk in chunks}
+
+
+@patch('nhldata.backfill.time.sleep')
+def test_backfill_takes_over_expired_leases(mock_sleep, journal):
+    chunks = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 7), chunk_days=7)
+    leases = Mock(lease_seconds=30)
+    # held by a worker that stopped, until its lease runs out
+    leases.claim.side_effect = [None, Mock()]
+    leases.hold.return_value = nullcontext()
+    crawler = Mock()
+
+    result = Backfill(crawler, journal, leases=leases).run(chunks)
+
+    assert result == chunks
+    assert mock_sleep.call_count == 1
+    assert journal.completed() == {chunks[0].name()}
+
+
+def test_backfill_skips_chunks_completed_while_claiming(journal):
+    chunks = plan_chunks(datetime(2020, 1, 1), datetime(2020, 1, 7), chunk_days=7)
+    leases = Mock(lease_seconds=30)
+    leases.hold.return_value = nullcontext()
+    crawler = Mock()
+
+    backfill = Backfill(crawler, journal, leases=leases)
+    journal.record(chunks[0])
+
+    assert backfill._run_chunk(chunks[0]) is False
+    crawler.crawl.assert_not_called()
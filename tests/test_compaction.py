@@ -0,0 +1,166 @@
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+import boto3
+import pytest
+
+from nhldata.compaction import MANIFEST_INDEX, Compactor, readable_keys
+from nhldata.storage import Storage
+
+HEADER = b'player_person_id,side\n'
+
+
+@pytest.fixture
+def storage(data_bucket):
+    data_bucket.put_object(Key='2020/09/13/2019030314.csv', Body=HEADER + b'1,home\n2,away\n')
+    data_bucket.put_object(Key='2020/09/13/2019030315.csv', Body=HEADER + b'3,home\n')
+    data_bucket.put_object(Key='2020/09/14/2019030325.csv', Body=HEADER + b'4,away\n')
+    yield Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+
+
+def test_compactor_rejects_unknown_granularity():
+    with pytest.raises(ValueError):
+        Compactor(None, 'decade')
+
+
+def test_compact_day(storage):
+    compactor = Compactor(storage, 'day')
+
+    manifests = compactor.compact(datetime(2020, 9, 13), datetime(2020, 9, 13))
+
+    assert len(manifests) == 1
+    assert manifests[0]['period'] == '2020/09/13'
+    assert [game['key'] for game in manifests[0]['games']] == ['2020/09/13/2019030314.csv',
+                                                               '2020/09/13/2019030315.csv']
+    assert storage.load_data(manifests[0]['key']) == HEADER + b'1,home\n2,away\n3,home\n'
+    stored = json.loads(storage.load_data('compacted/day/2020/09/13.csv.manifest.json'))
+    assert stored['key'] == manifests[0]['key']
+
+
+def test_compact_is_idempotent(storage):
+    compactor = Compactor(storage, 'day')
+    compactor.compact(datetime(2020, 9, 13), datetime(2020, 9, 14))
+
+    result = compactor.compact(datetime(2020, 9, 13), datetime(2020, 9, 14))
+
+    assert result == []
+
+
+def test_compact_rewrites_changed_period(storage):
+    compactor = Compactor(storage, 'day')
+    first = compactor.compact(datetime(2020, 9, 13), datetime(2020, 9, 13))[0]
+    storage.store_data('2020/09/13/2019030315.csv', HEADER + b'5,home\n')
+
+    second = compactor.compact(datetime(2020, 9, 13), datetime(2020, 9, 13))[0]
+
+    assert second['key'] != first['key']
+    assert storage.load_data(second['key']) == HEADER + b'1,home\n2,away\n5,home\n'
+    assert first['key'] not in storage.list_games('compacted/')
+
+
+def test_compact_season(storage):
+    manifests = Compactor(storage, 'season').compact(datetime(2020, 9, 14), datetime(2020, 9, 14))
+
+    assert len(manifests) == 1
+    assert manifests[0]['period'] == '2019'
+    assert len(manifests[0]['games']) == 3
+
+
+def test_readable_keys_prefers_compacted_files(storage):
+    manifest = Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 13))[0]
+
+    result = readable_keys(storage)
+
+    assert result == [manifest['key'], '2020/09/14/2019030325.csv']
+
+
+def test_readable_keys_ignores_raw_archive(storage):
+    storage.store_data('raw/2020/09/13/2019030314.json.gz', b'{"teams": {}}')
+
+    result = readable_keys(storage)
+
+    assert result == ['2020/09/13/2019030314.csv', '2020/09/13/2019030315.csv', '2020/09/14/2019030325.csv']
+
+
+def test_readable_keys_only_lists_game_and_compacted_prefixes(storage):
+    storage.store_data('raw/2020/09/13/2019030314.json.gz', b'{"teams": {}}')
+
+    with patch.object(storage, 'list_objects', wraps=storage.list_objects) as list_objects:
+        readable_keys(storage)
+
+    assert sorted(call.args[0] for call in list_objects.call_args_list) == ['2020/', 'compacted/']
+
+
+def test_readable_keys_reads_manifests_from_the_index(storage):
+    manifest = Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 14))[0]
+
+    with patch.object(storage, 'load_data', wraps=storage.load_data) as load_data:
+        result = readable_keys(storage)
+
+    assert result[0] == manifest['key']
+    load_data.assert_called_once_with(MANIFEST_INDEX)
+
+
+def test_readable_keys_reads_manifests_the_index_is_missing(storage):
+    Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 13))
+    storage.delete_data(MANIFEST_INDEX)
+    manifest = Compactor(storage, 'season').compact(datetime(2020, 9, 13), datetime(2020, 9, 13))[0]
+    # a compaction running alongside this one overwrote the index without the season's manifest
+    storage.store_data(MANIFEST_INDEX, '{}')
+
+    result = readable_keys(storage)
+
+    assert result == [manifest['key']]
+
+
+def test_readable_keys_ignores_stale_compacted_files(storage):
+    Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 13))
+    storage.store_data('2020/09/13/2019030315.csv', HEADER + b'5,home\n')
+
+    result = readable_keys(storage)
+
+    assert result == ['2020/09/13/2019030314.csv', '2020/09/13/2019030315.csv', '2020/09/14/2019030325.csv']
+
+
+def test_readable_keys_prefers_coarsest_file(storage):
+    Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 14))
+    season = Compactor(storage, 'season').compact(datetime(2020, 9, 13), datetime(2020, 9, 14))[0]
+
+    result = readable_keys(storage)
+
+    assert result == [season['key']]
+
+
+def test_compact_keeps_compression(storage):
+    gzip_storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'), compression='gzip')
+    gzip_storage.store_data('2020/09/15/2019030330.csv.gz', HEADER + b'6,home\n')
+    gzip_storage.store_data('2020/09/15/2019030331.csv.gz', HEADER + b'7,away\n')
+
+    manifest = Compactor(gzip_storage, 'day').compact(datetime(2020, 9, 15), datetime(2020, 9, 15))[0]
+
+    assert manifest['key'].endswith('.csv.gz')
+    assert gzip_storage.load_data(manifest['key']) == HEADER + b'6,home\n7,away\n'
+
+
+def test_compact_skips_periods_with_mixed_headers(storage):
+    # written after a column was added to the header
+    storage.store_data('2020/09/13/2019030316.csv', b'player_person_id,side,game_id\n8,home,2019030316\n')
+
+    manifests = Compactor(storage, 'day').compact(datetime(2020, 9, 13), datetime(2020, 9, 14))
+
+    assert [manifest['period'] for manifest in manifests] == ['2020/09/14']
+    assert readable_keys(storage) == [manifests[0]['key'], '2020/09/13/2019030314.csv', '2020/09/13/2019030315.csv',
+                                      '2020/09/13/2019030316.csv']
+
+
+def test_compact_skips_parquet_periods_with_mixed_schemas(storage):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    for game_id, table in [('2019030340', pa.table({'player_person_id': [1]})),
+                           ('2019030341', pa.table({'player_person_id': [2], 'game_id': [2019030341]}))]:
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink)
+        storage.store_data(f'2020/09/20/{game_id}.parquet', sink.getvalue().to_pybytes())
+
+    assert Compactor(storage, 'day').compact(datetime(2020, 9, 20), datetime(2020, 9, 20)) == []
@@ -0,0 +1,113 @@
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from nhldata.concurrency import AIMDController
+from nhldata.retryhttp import observe_requests, retry
+
+
+def http_error(status_code):
+    return requests.HTTPError(response=Mock(status_code=status_code))
+
+
+def test_controller_rejects_invalid_settings():
+    with pytest.raises(ValueError):
+        AIMDController(min_limit=0)
+    with pytest.raises(ValueError):
+        AIMDController(min_limit=4, max_limit=2)
+    with pytest.raises(ValueError):
+        AIMDController(decrease_factor=1)
+
+
+def test_controller_increases_additively():
+    controller = AIMDController(min_limit=1, max_limit=3)
+    controller.observe(0.1)
+    assert controller.limit == 2
+    # from 2, each healthy response only adds 1 / limit, so it takes a few more of them to get to 3
+    controller.observe(0.1)
+    controller.observe(0.1)
+    assert controller.limit == 2
+    controller.observe(0.1)
+    assert controller.limit == 3
+    for _ in range(10):
+        controller.observe(0.1)
+    assert controller.limit == 3
+
+
+@pytest.mark.parametrize('error', [http_error(429), http_error(503), requests.ConnectionError()])
+def test_controller_decreases_multiplicatively_on_overload(error):
+    controller = AIMDController(min_limit=1, max_limit=16, initial=16, cooldown_seconds=0)
+    controller.observe(0.1, error)
+    assert controller.limit == 8
+    controller.observe(0.1, error)
+    assert controller.limit == 4
+
+
+def test_controller_ignores_client_errors():
+    controller = AIMDController(min_limit=1, max_limit=16, initial=8)
+    controller.observe(0.1, http_error(404))
+    assert controller.limit == 8
+
+
+def test_controller_decreases_on_latency_spike():
+    controller = AIMDController(min_limit=1, max_limit=16, initial=8, latency_spike=3, cooldown_seconds=0)
+    controller.observe(0.1)
+    controller.observe(1.0)
+    assert controller.limit == 4
+
+
+@patch('nhldata.concurrency.time.monotonic')
+def test_controller_cuts_once_per_cooldown(mock_monotonic):
+    mock_monotonic.return_value = 100
+    controller = AIMDController(min_limit=1, max_limit=16, initial=16, cooldown_seconds=1)
+    controller.observe(0.1, http_error(503))
+    controller.observe(0.1, http_error(503))
+    assert controller.limit == 8
+
+    mock_monotonic.return_value = 101.5
+    controller.observe(0.1, http_error(503))
+    assert controller.limit == 4
+    assert controller.summary() == 'concurrency trajectory: 16 -> 8 -> 4'
+
+
+def test_controller_slot_blocks_at_the_limit():
+    controller = AIMDController(min_limit=1, max_limit=2)
+    entered = threading.Event()
+
+    def take_slot():
+        with controller.slot():
+            entered.set()
+
+    with controller.slot():
+        thread = threading.Thread(target=take_slot)
+        thread.start()
+        assert not entered.wait(0.1)
+        assert controller.in_flight == 1
+    thread.join(1)
+    assert entered.is_set()
+    assert controller.in_flight == 0
+
+
+def test_controller_observes_retried_requests():
+    controller = AIMDController(min_limit=1, max_limit=16, initial=8, cooldown_seconds=0)
+    responses = iter([http_error(503), 'ok'])
+
+    @retry(max_attempts=2, backoff_factor=0, max_jitter_pct=0)
+    def call():
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    with observe_requests(controller):
+        assert call() == 'ok'
+    # halved by the 503, then nudged back up by the success
+    assert controller.limit == 4
+    assert controller.trajectory[-1][1] == 4
+
+    # nothing is observed once the block has exited
+    responses = iter([http_error(503), 'ok'])
+    call()
+    assert controller.limit == 4
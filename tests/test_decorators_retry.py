@@ -1,10 +1,15 @@
-from unittest.mock import call, patch
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, call, patch
 
 import pytest
 import requests
 import requests_mock
 
-from nhldata.retryhttp import get_backoff, retry
+from nhldata.retryhttp import (CircuitBreaker, CircuitOpenError, Deadline, LatencyTracker, async_hedge, async_retry,
+                               get_backoff, hedge, retry, retry_after_seconds)
 
 SOME_URL = 'http://some.url'
 
@@ -194,3 +199,217 @@ def test_retry_429_uses_backoff_if_header_not_available(mock_sleep):
         assert m.call_count == 2
         assert mock_sleep.call_count == 1
         mock_sleep.assert_called_once_with(0.5)
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('42') == 42
+    assert retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert retry_after_seconds('soon') is None
+    assert retry_after_seconds(None) is None
+
+
+def test_circuit_breaker_opens_and_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+
+    @retry(max_attempts=5, backoff_factor=0, max_jitter_pct=0, circuit_breaker=breaker)
+    def get_with_breaker(url):
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.status_code
+
+    with requests_mock.Mocker() as m:
+        m.get(SOME_URL, status_code=503)
+        with pytest.raises(CircuitOpenError):
+            get_with_breaker(SOME_URL)
+        assert m.call_count == 2
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # later calls don't reach the api at all
+        with pytest.raises(CircuitOpenError):
+            get_with_breaker(SOME_URL)
+        assert m.call_count == 2
+
+
+@patch('nhldata.retryhttp.time.monotonic')
+def test_circuit_breaker_half_open_probe(mock_monotonic):
+    mock_monotonic.return_value = 100
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    mock_monotonic.return_value = 131
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # only the probe goes through
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # a failed probe opens the breaker again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    mock_monotonic.return_value = 162
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_circuit_breaker_ignores_client_errors():
+    breaker = CircuitBreaker(failure_threshold=1)
+
+    @retry(max_attempts=5, backoff_factor=0, max_jitter_pct=0, circuit_breaker=breaker)
+    def get_with_breaker(url):
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.status_code
+
+    with requests_mock.Mocker() as m:
+        m.get(SOME_URL, status_code=404)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_with_breaker(SOME_URL)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@patch('time.sleep', return_value=None)
+def test_retry_stops_at_max_elapsed_seconds(mock_sleep):
+    @retry(max_attempts=10, backoff_factor=1, max_jitter_pct=0, max_elapsed_seconds=1)
+    def get_with_budget(url):
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.status_code
+
+    with requests_mock.Mocker() as m:
+        m.get(SOME_URL, status_code=500)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_with_budget(SOME_URL)
+        # sleeps of 0.5 then 1 would take us past the second we're allowed
+        assert m.call_count == 2
+        mock_sleep.assert_called_once_with(0.5)
+
+
+@patch('time.sleep', return_value=None)
+def test_retry_stops_at_deadline(mock_sleep):
+    deadline = Deadline(0)
+
+    @retry(max_attempts=5, backoff_factor=1, max_jitter_pct=0, deadline=deadline)
+    def get_with_deadline(url):
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.status_code
+
+    with requests_mock.Mocker() as m:
+        m.get(SOME_URL, status_code=500)
+        with pytest.raises(requests.exceptions.HTTPError):
+            get_with_deadline(SOME_URL)
+        assert m.call_count == 1
+        assert mock_sleep.call_count == 0
+
+    deadline.arm(None)
+    assert deadline.remaining() is None
+
+
+def test_latency_tracker_percentile():
+    tracker = LatencyTracker(percentile=90, window=10, min_samples=5)
+    for seconds in range(4):
+        tracker.record(seconds)
+    assert tracker.threshold() is None
+
+    for seconds in range(4, 20):
+        tracker.record(seconds)
+    # only the last 10 latencies, 10..19, are kept
+    assert tracker.threshold() == 18
+
+
+def test_hedge_fast_call_is_not_duplicated():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(1)
+    calls = []
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert hedge(lambda: calls.append(1) or 'answer', tracker, executor) == 'answer'
+    assert len(calls) == 1
+
+
+def test_hedge_slow_call_uses_the_first_answer():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(0.01)
+    release = threading.Event()
+    answers = iter(['slow', 'fast'])
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            answer = next(answers)
+        if answer == 'slow':
+            release.wait(5)
+        return answer
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert hedge(call, tracker, executor) == 'fast'
+        release.set()
+
+
+def test_hedge_raises_when_every_call_fails():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(0.01)
+
+    def call():
+        time.sleep(0.05)
+        raise ValueError('nope')
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError):
+            hedge(call, tracker, executor)
+
+
+def test_async_retry_sleeps_without_blocking():
+    statuses = iter([500, 503, 200])
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    @async_retry(max_attempts=5, backoff_factor=1, max_jitter_pct=0)
+    async def get_status():
+        status_code = next(statuses)
+        if status_code != 200:
+            raise requests.HTTPError(response=Mock(status_code=status_code))
+        return status_code
+
+    with patch('nhldata.retryhttp.asyncio.sleep', fake_sleep):
+        assert asyncio.run(get_status()) == 200
+    assert sleeps == [0.5, 1.0]
+
+
+def test_async_retry_unsupported_code():
+    attempts = []
+
+    @async_retry(max_attempts=5, backoff_factor=0, max_jitter_pct=0)
+    async def get_status():
+        attempts.append(1)
+        raise requests.HTTPError(response=Mock(status_code=404))
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        asyncio.run(get_status())
+    assert len(attempts) == 1
+
+
+def test_async_hedge_cancels_the_slow_call():
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(0.01)
+    started = []
+    cancelled = []
+
+    async def get_answer():
+        started.append(1)
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return 'slow'
+        return 'fast'
+
+    assert asyncio.run(async_hedge(get_answer, tracker)) == 'fast'
+    assert cancelled == [1]
@@ -0,0 +1,57 @@
+import time
+
+from nhldata.httpcache import IMMUTABLE, CachedResponse, ResponseCache
+
+
+def test_make_key_sorts_params():
+    a = ResponseCache.make_key('http://some.url', {'b': 2, 'a': 1})
+    b = ResponseCache.make_key('http://some.url', {'a': 1, 'b': 2})
+
+    assert a == b == 'http://some.url?a=1&b=2'
+    assert ResponseCache.make_key('http://some.url') == 'http://some.url'
+
+
+def test_cache_put_get(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    cache.put('foo', b'{"bar": 1}', etag='"abc"', ttl=IMMUTABLE)
+
+    result = cache.get('foo')
+
+    assert result.body == b'{"bar": 1}'
+    assert result.etag == '"abc"'
+    assert result.is_fresh()
+    assert cache.get('missing') is None
+
+
+def test_cache_entry_expires(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    cache.put('foo', b'{}', ttl=-1)
+
+    assert not cache.get('foo').is_fresh()
+
+    cache.refresh('foo', ttl=60)
+
+    assert cache.get('foo').is_fresh()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_bytes=10)
+    cache.put('first', b'12345')
+    time.sleep(0.01)
+    cache.put('second', b'12345')
+    time.sleep(0.01)
+    # touch the first entry so the second one becomes the least recently used
+    cache.get('first')
+    time.sleep(0.01)
+    cache.put('third', b'12345')
+
+    assert cache.get('first') is not None
+    assert cache.get('second') is None
+    assert cache.get('third') is not None
+    assert cache.size() == 10
+
+
+def test_cached_response_validators():
+    response = CachedResponse(b'', '"abc"', 'Wed, 21 Oct 2015 07:28:00 GMT', None)
+
+    assert response.validators() == {'If-None-Match': '"abc"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
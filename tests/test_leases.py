@@ -0,0 +1,136 @@
+import itertools
+import json
+import threading
+from unittest.mock import patch
+
+import boto3
+import pytest
+
+from nhldata.leases import LeaseLost, LeaseManager
+from nhldata.storage import ConditionFailed, Storage
+
+
+class ConditionalJobs:
+    """ holds job objects in memory and enforces the write conditions, which moto doesn't """
+    def __init__(self):
+        self.objects = {}
+        self._etags = itertools.count()
+        self._lock = threading.Lock()
+
+    def store_job_if(self, key, job_data, etag=None):
+        with self._lock:
+            current = self.objects.get(key)
+            if (etag is None and current is not None) or (etag is not None and (current or (None,))[-1] != etag):
+                raise ConditionFailed(key)
+            self.objects[key] = (job_data, f'"{next(self._etags)}"')
+            return self.objects[key][1]
+
+    def load_job(self, key):
+        return self.objects.get(key, (None, None))
+
+    def delete_job(self, key):
+        self.objects.pop(key, None)
+        return True
+
+
+@pytest.fixture
+def jobs():
+    yield ConditionalJobs()
+
+
+def test_claim_is_exclusive(jobs):
+    first = LeaseManager(jobs, 'backfill', owner='first')
+    second = LeaseManager(jobs, 'backfill', owner='second')
+
+    lease = first.claim('chunk')
+
+    assert lease.owner == 'first'
+    assert second.claim('chunk') is None
+    assert json.loads(jobs.objects['leases/backfill/chunk.json'][0])['owner'] == 'first'
+
+
+@patch('nhldata.leases.time.time')
+def test_expired_lease_is_taken_over(mock_time, jobs):
+    mock_time.return_value = 1000
+    first = LeaseManager(jobs, 'backfill', owner='first', lease_seconds=60)
+    second = LeaseManager(jobs, 'backfill', owner='second', lease_seconds=60)
+    lease = first.claim('chunk')
+
+    mock_time.return_value = 1059
+    assert second.claim('chunk') is None
+
+    mock_time.return_value = 1061
+    taken_over = second.claim('chunk')
+    assert taken_over.owner == 'second'
+
+    # the first worker finds out when it next renews, and leaves the lease alone when it releases
+    with pytest.raises(LeaseLost):
+        first.renew(lease)
+    first.release(lease)
+    assert json.loads(jobs.objects['leases/backfill/chunk.json'][0])['owner'] == 'second'
+
+
+def test_renew_and_release(jobs):
+    manager = LeaseManager(jobs, 'backfill', owner='first')
+    lease = manager.claim('chunk')
+
+    renewed = manager.renew(lease)
+
+    assert renewed.etag != lease.etag
+    assert renewed.expires_at >= lease.expires_at
+    manager.release(renewed)
+    assert json.loads(jobs.objects['leases/backfill/chunk.json'][0])['expires_at'] == 0
+    assert LeaseManager(jobs, 'backfill', owner='second').claim('chunk') is not None
+
+
+def test_hold_renews_in_the_background(jobs):
+    manager = LeaseManager(jobs, 'backfill', owner='first', lease_seconds=0.06)
+    lease = manager.claim('chunk')
+    renewed = threading.Event()
+    renew = manager.renew
+
+    def renew_and_signal(held):
+        renewed.set()
+        return renew(held)
+
+    with patch.object(manager, 'renew', side_effect=renew_and_signal):
+        with manager.hold(lease):
+            assert renewed.wait(1)
+
+    assert json.loads(jobs.objects['leases/backfill/chunk.json'][0])['expires_at'] == 0
+
+
+@patch('nhldata.leases.time.time')
+def test_release_leaves_a_lease_taken_over_just_before_it_alone(mock_time, jobs):
+    mock_time.return_value = 1000
+    first = LeaseManager(jobs, 'backfill', owner='first', lease_seconds=60)
+    second = LeaseManager(jobs, 'backfill', owner='second', lease_seconds=60)
+    lease = first.claim('chunk')
+    mock_time.return_value = 1061
+    unpatched = {'store_job_if': jobs.store_job_if, 'delete_job': jobs.delete_job}
+
+    def taken_over_first(method):
+        def write(*args, **kwargs):
+            # the lease expires and the second worker takes it over right as the first one gets round to releasing it
+            vars(jobs).update(unpatched)
+            assert second.claim('chunk') is not None
+            return unpatched[method](*args, **kwargs)
+        return write
+
+    vars(jobs).update({method: taken_over_first(method) for method in unpatched})
+    first.release(lease)
+
+    held = json.loads(jobs.objects['leases/backfill/chunk.json'][0])
+    assert held == {'owner': 'second', 'expires_at': 1121}
+
+
+def test_claim_against_s3(job_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+    manager = LeaseManager(storage, 'backfill', owner='first')
+
+    lease = manager.claim('chunk')
+    with manager.hold(lease):
+        assert [obj.key for obj in job_bucket.objects.all()] == ['leases/backfill/chunk.json']
+
+    body, _ = storage.load_job('leases/backfill/chunk.json')
+    assert json.loads(body)['expires_at'] == 0
@@ -0,0 +1,200 @@
+import gzip
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import boto3
+import pytest
+
+from nhldata.loader import Loader, LoadError, csv_runs
+from nhldata.storage import Storage
+
+
+@pytest.fixture
+def storage(data_bucket):
+    yield Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+
+
+class FakeConnection(MagicMock):
+    """
+    records what every COPY read and every statement executed, shared by every connection, queries return the target
+    table's columns, the watermark and the seasons in the staging table
+    """
+    copied = []
+    executed = []
+    columns = []
+    watermark = None
+    seasons = []
+    lock = threading.Lock()
+
+    def cursor(self):
+        cursor = MagicMock()
+        cursor.__enter__.return_value = cursor
+        cursor.copy_expert.side_effect = self._copy
+        cursor.execute.side_effect = lambda statement, parameters=None: self._execute(cursor, statement, parameters)
+        cursor.fetchall.side_effect = lambda: [(season,) for season in self.seasons] \
+            if cursor.statement.startswith('SELECT DISTINCT') else [(column,) for column in self.columns]
+        cursor.fetchone.side_effect = lambda: None if self.watermark is None else (self.watermark,)
+        return cursor
+
+    def _copy(self, statement, rows):
+        with self.lock:
+            self.copied.append((statement, rows.read()))
+
+    def _execute(self, cursor, statement, parameters):
+        cursor.statement = statement
+        with self.lock:
+            self.executed.append((statement, parameters))
+
+
+@pytest.fixture
+def connection():
+    FakeConnection.copied = []
+    FakeConnection.executed = []
+    FakeConnection.columns = ['game_id', 'player_person_id', 'goals', 'loaded_at']
+    FakeConnection.watermark = None
+    FakeConnection.seasons = [2019]
+    with patch('nhldata.loader.psycopg2') as mock_psycopg2:
+        mock_psycopg2.connect.side_effect = lambda dsn: FakeConnection()
+        yield FakeConnection
+
+
+def test_csv_runs_groups_objects_by_header(storage, data_bucket):
+    data_bucket.put_object(Key='2020/01/01/1.csv', Body=b'a,b\n1,2\n')
+    data_bucket.put_object(Key='2020/01/01/2.csv.gz', Body=gzip.compress(b'a,b\n3,4'), ContentEncoding='gzip')
+    data_bucket.put_object(Key='2020/01/01/3.csv', Body=b'a,b,c\n5,6,7\n')
+
+    runs = [(columns, rows.read()) for columns, rows in
+            csv_runs(['2020/01/01/1.csv', '2020/01/01/2.csv.gz', '2020/01/01/3.csv'], storage.open_data)]
+
+    assert runs == [(['a', 'b'], b'1,2\n3,4\n'), (['a', 'b', 'c'], b'5,6,7\n')]
+
+
+def test_csv_runs_rejects_invalid_columns(storage, data_bucket):
+    data_bucket.put_object(Key='2020/01/01/1.csv', Body=b'a,b); drop table game_stats; --\n1,2\n')
+
+    with pytest.raises(LoadError):
+        list(csv_runs(['2020/01/01/1.csv'], storage.open_data))
+
+
+def executed(connection, prefix):
+    return [(statement, parameters) for statement, parameters in connection.executed if statement.startswith(prefix)]
+
+
+def test_loader_merges_batches_through_staging_tables(storage, data_bucket, connection):
+    for game_id in range(5):
+        data_bucket.put_object(Key=f'2020/01/01/{game_id}.csv',
+                               Body=f'game_id,player_person_id,goals\n{game_id},8471214,1\n'.encode())
+
+    loaded = Loader(storage, 'dbname=test', streams=2, files_per_copy=2).load_games()
+
+    assert loaded == 5
+    # three batches of at most two files, each one COPY into the staging table of its stream
+    assert len(connection.copied) == 3
+    assert all(statement.startswith('COPY game_stats_staging_') and
+               '(game_id, player_person_id, goals) FROM STDIN' in statement for statement, _ in connection.copied)
+    assert sorted(row for _, rows in connection.copied for row in rows.decode().splitlines()) == \
+        [f'{game_id},8471214,1' for game_id in range(5)]
+    assert len(executed(connection, 'CREATE TEMPORARY TABLE')) == 2
+    merges = executed(connection, 'INSERT INTO game_stats SELECT')
+    assert len(merges) == 3
+    assert {statement for statement, _ in merges} <= {
+        f'INSERT INTO game_stats SELECT DISTINCT ON (game_id, player_person_id) * FROM game_stats_staging_{number} '
+        f'ORDER BY game_id, player_person_id ON CONFLICT (game_id, player_person_id) '
+        f'DO UPDATE SET goals = EXCLUDED.goals, loaded_at = EXCLUDED.loaded_at' for number in range(2)}
+
+
+def test_loader_works_out_time_on_ice_seconds_for_objects_without_them(storage, data_bucket, connection):
+    connection.columns = ['game_id', 'player_person_id', 'player_stats_skaterstats_timeonice',
+                          'player_stats_skaterstats_timeonice_seconds']
+    data_bucket.put_object(Key='2020/01/01/1.csv',
+                           Body=b'game_id,player_person_id,player_stats_skaterStats_timeOnIce\n1,8471214,12:34\n')
+
+    Loader(storage, 'dbname=test', streams=1).load_games()
+
+    [(statement, _)] = executed(connection, 'INSERT INTO game_stats SELECT')
+    assert statement.startswith(
+        "INSERT INTO game_stats SELECT DISTINCT ON (game_id, player_person_id) game_id, player_person_id, "
+        "player_stats_skaterstats_timeonice, COALESCE(player_stats_skaterstats_timeonice_seconds, "
+        "CASE WHEN player_stats_skaterstats_timeonice ~ '^[0-9]+:[0-9]{2}$' "
+        "THEN split_part(player_stats_skaterstats_timeonice, ':', 1)::int * 60 "
+        "+ split_part(player_stats_skaterstats_timeonice, ':', 2)::int END) FROM game_stats_staging_0 ")
+
+
+def test_loader_creates_partitions_once_per_season(storage, data_bucket, connection):
+    connection.seasons = [2019, 2020]
+    for game_id in range(4):
+        data_bucket.put_object(Key=f'2020/01/01/{game_id}.csv', Body=f'game_id,player_person_id\n{game_id},1\n'.encode())
+
+    Loader(storage, 'dbname=test', streams=2, files_per_copy=1).load_games()
+
+    assert [statement for statement, _ in executed(connection, 'CREATE TABLE')] == [
+        'CREATE TABLE IF NOT EXISTS game_stats_2019 PARTITION OF game_stats FOR VALUES FROM (2019000000) TO (2020000000)',
+        'CREATE TABLE IF NOT EXISTS game_stats_2020 PARTITION OF game_stats FOR VALUES FROM (2020000000) TO (2021000000)',
+    ]
+    assert executed(connection, 'SELECT DISTINCT game_id / 1000000 FROM game_stats_staging_')
+
+
+def test_loader_rejects_objects_without_the_merge_keys(storage, data_bucket, connection):
+    data_bucket.put_object(Key='2020/01/01/1.csv', Body=b'player_person_id,goals\n8471214,1\n')
+
+    with pytest.raises(LoadError, match='game_id'):
+        Loader(storage, 'dbname=test', streams=1).load_games()
+
+    assert connection.copied == []
+
+
+def test_loader_requires_the_target_table(storage, data_bucket, connection):
+    connection.columns = []
+
+    with pytest.raises(LoadError, match='game_stats'):
+        Loader(storage, 'dbname=test', streams=1).load_games()
+
+
+def test_loader_only_loads_objects_past_the_watermark(storage, data_bucket, connection):
+    data_bucket.put_object(Key='2020/01/01/1.csv', Body=b'game_id,player_person_id\n1,8471214\n')
+    modified = next(storage.list_objects())['LastModified']
+
+    # modified well before the watermark, skipped
+    connection.watermark = modified + timedelta(hours=1)
+    assert Loader(storage, 'dbname=test', streams=1).load_games() == 0
+    assert executed(connection, 'INSERT INTO load_watermarks') == []
+
+    # modified inside the overlap, loaded again and the watermark recorded
+    connection.watermark = modified + timedelta(minutes=1)
+    assert Loader(storage, 'dbname=test', streams=1).load_games() == 1
+    (_, parameters), = executed(connection, 'INSERT INTO load_watermarks')
+    assert parameters == ('game_stats', modified)
+
+    # a full load ignores the watermark
+    connection.watermark = datetime.now(timezone.utc) + timedelta(days=1)
+    assert Loader(storage, 'dbname=test', streams=1).load_games(full=True) == 1
+
+
+def test_loader_only_loads_job_metadata(storage, job_bucket, connection):
+    connection.columns = ['id', 'app_version']
+    storage.store_job('2020/01/01/job.csv', 'id,app_version\njob,0.0.1')
+    storage.store_job('backfills/2020-01-01_2020-01-07/2020-01-01_2020-01-07.json', '{}')
+
+    loaded = Loader(storage, 'dbname=test', streams=1).load_jobs()
+
+    assert loaded == 1
+    assert connection.copied == [('COPY job_stats_staging_0 (id, app_version) FROM STDIN WITH (FORMAT csv)',
+                                  b'job,0.0.1\n')]
+    (statement, _), = executed(connection, 'INSERT INTO job_stats')
+    assert statement.endswith('ON CONFLICT (id) DO UPDATE SET app_version = EXCLUDED.app_version')
+    assert executed(connection, 'INSERT INTO load_watermarks')[0][1][0] == 'job_stats'
+
+
+def test_loader_raises_the_first_failure(storage, data_bucket, connection):
+    data_bucket.put_object(Key='2020/01/01/1.csv', Body=b'game_id,player_person_id\n1,2\n')
+
+    with patch.object(FakeConnection, '_copy', side_effect=ValueError('boom')):
+        with pytest.raises(ValueError):
+            Loader(storage, 'dbname=test', streams=2).load_games()
+
+
+@patch('nhldata.loader.psycopg2', None)
+def test_loader_requires_psycopg2(storage):
+    with pytest.raises(RuntimeError):
+        Loader(storage, 'dbname=test')
@@ -10,8 +10,9 @@ def test_adapter_factory_returns_available_versions():
 
     result = factory.all_versions()
 
-    assert len(result) == 1
+    assert len(result) == 2
     assert 'v1' in result
+    assert 'v1-async' in result
 
 
 def test_adapter_for_version_supported_version():
@@ -29,3 +30,14 @@ def test_adapter_for_version_unsupported_version():
     factory = AdapterFactory()
     with pytest.raises(ValueError):
         _ = factory.adapter_for_version('v2')
+
+
+def test_adapter_for_version_async_version():
+    pytest.importorskip('aiohttp')
+    from nhldata.nhl.v1_async.api import AsyncNHLApi
+    from nhldata.nhl.v1_async.crawler import AsyncCrawler
+
+    result = AdapterFactory().adapter_for_version('v1-async')
+
+    assert isinstance(result.api(), AsyncNHLApi)
+    assert isinstance(result.crawler(None, None), AsyncCrawler)
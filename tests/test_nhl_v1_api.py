@@ -1,14 +1,23 @@
+import io
+import json
+import threading
+import time
 from datetime import datetime
+from unittest.mock import Mock, patch
 
+import pytest
+import requests
 import requests_mock
+import urllib3
 
+from nhldata.httpcache import ResponseCache
 from nhldata.nhl.v1.api import NHLApi
 
 
 def test_NHLApi_schedule_with_200():
     endpoint = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
     with requests_mock.Mocker() as m:
-        m.get(endpoint, json='{}', status_code=200)
+        m.get(endpoint, json={'dates': []}, status_code=200)
 
         api = NHLApi()
         api.schedule(datetime(2020, 1, 1), datetime(2020, 1, 2))
@@ -16,6 +25,84 @@ def test_NHLApi_schedule_with_200():
         assert m.call_count == 1
 
 
+def test_NHLApi_schedule_days_asks_for_one_window_at_a_time(schedule_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule'
+    with requests_mock.Mocker() as m:
+        m.get(f'{schedule}?startDate=2020-01-01&endDate=2020-01-31', json=schedule_data, status_code=200)
+        m.get(f'{schedule}?startDate=2020-02-01&endDate=2020-02-10', json={'dates': []}, status_code=200)
+
+        api = NHLApi()
+        days = api.schedule_days(datetime(2020, 1, 1), datetime(2020, 2, 10), window_days=31)
+
+        # nothing is asked for until the first day is
+        assert m.call_count == 0
+        assert next(days)['date'] == '2020-09-13'
+        assert m.call_count == 1
+        assert [day['date'] for day in days] == ['2020-09-14']
+        assert m.call_count == 2
+
+
+class TrackedBody(io.BytesIO):
+    """ a response body that fails instead of returning anything past fail_at """
+    def __init__(self, body, fail_at=None):
+        super().__init__(body)
+        self.fail_at = fail_at
+
+    def _check(self):
+        if self.fail_at is not None and self.tell() >= self.fail_at:
+            raise urllib3.exceptions.ProtocolError('Connection broken')
+
+    def read(self, size=-1):
+        self._check()
+        return super().read(size)
+
+    def readinto(self, buffer):
+        self._check()
+        return super().readinto(buffer)
+
+
+def streamed_schedule(days, fail_at=None):
+    body = json.dumps({'dates': [{'date': f'2020-01-{day:02d}', 'games': [], 'padding': 'x' * 65536}
+                                 for day in range(1, days + 1)]}).encode()
+    response = Mock(status_code=200, raw=TrackedBody(body, fail_at))
+    return body, response
+
+
+def test_NHLApi_schedule_days_decodes_days_as_the_body_downloads():
+    body, response = streamed_schedule(20)
+    api = NHLApi()
+
+    with patch.object(api, '_request', return_value=response):
+        days = api.schedule_days(datetime(2020, 1, 1), datetime(2020, 1, 20))
+        assert next(days)['date'] == '2020-01-01'
+
+        # the first day is handed over long before the rest of the window has been read
+        assert response.raw.tell() < len(body) / 2
+        assert len(list(days)) == 19
+    response.close.assert_called_once()
+
+
+def test_NHLApi_schedule_days_raises_a_connection_error_for_a_broken_body():
+    body, response = streamed_schedule(20, fail_at=65536 * 5)
+    api = NHLApi()
+
+    with patch.object(api, '_request', return_value=response):
+        days = api.schedule_days(datetime(2020, 1, 1), datetime(2020, 1, 20))
+        with pytest.raises(requests.ConnectionError):
+            list(days)
+
+
+@patch('nhldata.nhl.v1.api.ijson', None)
+def test_NHLApi_schedule_days_without_ijson(schedule_data):
+    endpoint = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    with requests_mock.Mocker() as m:
+        m.get(endpoint, json=schedule_data, status_code=200)
+
+        days = list(NHLApi().schedule_days(datetime(2020, 1, 1), datetime(2020, 1, 2)))
+
+        assert days == schedule_data['dates']
+
+
 def test_NHLApi_boxscore_with_200():
     game_id = 'foo123bar'
     endpoint = f'https://statsapi.web.nhl.com/api/v1/game/{game_id}/boxscore'
@@ -25,4 +112,126 @@ def test_NHLApi_boxscore_with_200():
         api = NHLApi()
         api.boxscore(game_id)
 
-        assert m.call_count == 1
\ No newline at end of file
+        assert m.call_count == 1
+
+def test_NHLApi_sends_timeout_and_compression_headers():
+    game_id = 'foo123bar'
+    endpoint = f'https://statsapi.web.nhl.com/api/v1/game/{game_id}/boxscore'
+    with requests_mock.Mocker() as m:
+        m.get(endpoint, json={'teams': {}}, status_code=200)
+
+        with NHLApi(timeout=(1, 2)) as api:
+            result = api.boxscore(game_id)
+
+        assert result == {'teams': {}}
+        assert m.last_request.timeout == (1, 2)
+        assert 'gzip' in m.last_request.headers.get('Accept-Encoding')
+
+
+def test_NHLApi_reuses_session_between_calls():
+    game_id = 'foo123bar'
+    endpoint = f'https://statsapi.web.nhl.com/api/v1/game/{game_id}/boxscore'
+    with requests_mock.Mocker() as m:
+        m.get(endpoint, json={'teams': {}}, status_code=200)
+
+        api = NHLApi(fast_json=False)
+        session = api._session
+        api.boxscore(game_id)
+        api.boxscore(game_id)
+
+        assert api._session is session
+        assert m.call_count == 2
+
+
+def test_NHLApi_caches_final_games(tmp_path, schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore, json=game_2019030314_data, status_code=200)
+
+        api = NHLApi(cache=ResponseCache(str(tmp_path / 'cache.sqlite')))
+        for _ in range(2):
+            api.schedule(datetime(2020, 1, 1), datetime(2020, 1, 2))
+            result = api.boxscore('2019030314')
+
+        assert result == game_2019030314_data
+        assert m.call_count == 2
+
+
+def test_NHLApi_knows_final_games_from_a_cached_schedule(tmp_path, schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-09-13&endDate=2020-09-14'
+    boxscore = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore, json=game_2019030314_data, status_code=200)
+
+        # the first run only gets as far as the schedule, the next one reads it back from the cache
+        NHLApi(cache=cache).schedule(datetime(2020, 9, 13), datetime(2020, 9, 14))
+        api = NHLApi(cache=cache)
+        api.schedule(datetime(2020, 9, 13), datetime(2020, 9, 14))
+        api.boxscore('2019030314')
+
+        assert m.call_count == 2
+        assert api.is_final('2019030314')
+        assert cache.get(boxscore).expires_at is None
+
+
+def test_NHLApi_revalidates_stale_cache_entries(tmp_path):
+    game_id = 'foo123bar'
+    endpoint = f'https://statsapi.web.nhl.com/api/v1/game/{game_id}/boxscore'
+    with requests_mock.Mocker() as m:
+        m.get(endpoint, [
+            {'json': {'teams': {}}, 'status_code': 200, 'headers': {'ETag': '"v1"'}},
+            {'status_code': 304},
+        ])
+
+        # a game we haven't seen go Final is only cached for live_ttl seconds
+        api = NHLApi(cache=ResponseCache(str(tmp_path / 'cache.sqlite')), live_ttl=-1)
+        api.boxscore(game_id)
+        result = api.boxscore(game_id)
+
+        assert result == {'teams': {}}
+        assert m.call_count == 2
+        assert m.last_request.headers.get('If-None-Match') == '"v1"'
+
+
+@patch('time.sleep', return_value=None)
+def test_NHLApi_takes_rate_limiter_token_and_pauses_on_429(mock_sleep):
+    game_id = 'foo123bar'
+    endpoint = f'https://statsapi.web.nhl.com/api/v1/game/{game_id}/boxscore'
+    with requests_mock.Mocker() as m:
+        m.get(endpoint, [
+            {'status_code': 429, 'headers': {'Retry-After': '7'}},
+            {'json': {'teams': {}}, 'status_code': 200},
+        ])
+
+        limiter = Mock()
+        api = NHLApi(rate_limiter=limiter)
+        api.boxscore(game_id)
+
+        assert limiter.acquire.call_count == 2
+        limiter.pause.assert_called_once_with(7)
+
+
+def test_NHLApi_hedges_slow_boxscore_requests():
+    calls = []
+    lock = threading.Lock()
+
+    def request(url, params=None, headers=None):
+        # the hedge can get going before the original request does, whichever is first is the slow one
+        with lock:
+            calls.append(url)
+            slow = len(calls) == 1
+        if slow:
+            time.sleep(0.5)
+        return Mock(content=b'{"teams": {"%s": {}}}' % (b'slow' if slow else b'fast'))
+
+    with NHLApi(hedge_percentile=95) as api:
+        for _ in range(api._latency.min_samples):
+            api._latency.record(0.01)
+        with patch.object(api, '_request', side_effect=request):
+            assert api.boxscore('foo123bar') == {'teams': {'fast': {}}}
+
+    assert calls == ['https://statsapi.web.nhl.com/api/v1/game/foo123bar/boxscore'] * 2
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+from datetime import datetime
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+from nhldata.httpcache import ResponseCache
+from nhldata.nhl.v1_async.api import AsyncNHLApi
+
+aioresponses = pytest.importorskip('aioresponses').aioresponses
+
+
+def run(api, coroutine_function, *args):
+    """ runs an api call on its own event loop, closing the loop's session afterwards """
+    async def call():
+        try:
+            return await coroutine_function(*args)
+        finally:
+            await api.aclose()
+    return asyncio.run(call())
+
+
+def test_AsyncNHLApi_schedule_with_200():
+    endpoint = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    with aioresponses() as m:
+        m.get(endpoint, payload={}, status=200)
+        api = AsyncNHLApi()
+        result = run(api, api.schedule, datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        assert result == {}
+    assert api._sessions == {}
+
+
+def test_AsyncNHLApi_boxscore_raises_http_errors():
+    endpoint = 'https://statsapi.web.nhl.com/api/v1/game/foo123bar/boxscore'
+    with aioresponses() as m:
+        m.get(endpoint, status=404)
+        api = AsyncNHLApi()
+        with pytest.raises(requests.HTTPError) as err:
+            run(api, api.boxscore, 'foo123bar')
+
+        assert err.value.response.status_code == 404
+
+
+def test_AsyncNHLApi_retries_and_pauses_rate_limiter_on_429():
+    endpoint = 'https://statsapi.web.nhl.com/api/v1/game/foo123bar/boxscore'
+    with aioresponses() as m:
+        m.get(endpoint, status=429, headers={'Retry-After': '0'})
+        m.get(endpoint, payload={'teams': {}}, status=200)
+
+        limiter = Mock()
+        limiter.acquire_async.side_effect = lambda: asyncio.sleep(0)
+        limiter.pause_async.side_effect = lambda seconds: asyncio.sleep(0)
+        api = AsyncNHLApi(rate_limiter=limiter)
+
+        assert run(api, api.boxscore, 'foo123bar') == {'teams': {}}
+        assert limiter.acquire_async.call_count == 2
+        limiter.pause_async.assert_called_once_with(1)
+
+
+def test_AsyncNHLApi_caches_final_games(tmp_path, schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-09-13&endDate=2020-09-14'
+    boxscore = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    with aioresponses() as m:
+        m.get(schedule, payload=schedule_data, status=200)
+        m.get(boxscore, payload=game_2019030314_data, status=200)
+
+        api = AsyncNHLApi(cache=ResponseCache(str(tmp_path / 'cache.sqlite')))
+        run(api, api.schedule, datetime(2020, 9, 13), datetime(2020, 9, 14))
+        assert run(api, api.boxscore, 2019030314) == game_2019030314_data
+        # served from the cache, aioresponses would raise a connection error for an unmatched request
+        assert run(api, api.boxscore, 2019030314) == game_2019030314_data
+
+
+def test_AsyncNHLApi_knows_final_games_from_a_cached_schedule(tmp_path, schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-09-13&endDate=2020-09-14'
+    boxscore = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    with aioresponses() as m:
+        m.get(schedule, payload=schedule_data, status=200)
+        m.get(boxscore, payload=game_2019030314_data, status=200)
+
+        first = AsyncNHLApi(cache=cache)
+        run(first, first.schedule, datetime(2020, 9, 13), datetime(2020, 9, 14))
+        # only the boxscore is mocked once more, the schedule has to come from the cache
+        api = AsyncNHLApi(cache=cache)
+        run(api, api.schedule, datetime(2020, 9, 13), datetime(2020, 9, 14))
+        run(api, api.boxscore, 2019030314)
+
+        assert api.is_final(2019030314)
+        assert cache.get(boxscore).expires_at is None
+
+
+def test_AsyncNHLApi_uses_the_cache_off_the_event_loop(tmp_path, game_2019030314_data):
+    boxscore = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    cache_threads = []
+
+    class RecordingCache(ResponseCache):
+        def get(self, key):
+            cache_threads.append(threading.get_ident())
+            return super().get(key)
+
+        def put(self, *args, **kwargs):
+            cache_threads.append(threading.get_ident())
+            super().put(*args, **kwargs)
+
+    async def boxscore_and_loop_thread():
+        try:
+            return await api.boxscore(2019030314), threading.get_ident()
+        finally:
+            await api.aclose()
+
+    with aioresponses() as m:
+        m.get(boxscore, payload=game_2019030314_data, status=200)
+        api = AsyncNHLApi(cache=RecordingCache(str(tmp_path / 'cache.sqlite')))
+
+        data, loop_thread = asyncio.run(boxscore_and_loop_thread())
+
+    assert data == game_2019030314_data
+    assert len(cache_threads) == 2
+    assert loop_thread not in cache_threads
+
+
+def test_AsyncNHLApi_connection_errors_are_requests_errors():
+    with aioresponses():
+        api = AsyncNHLApi()
+        with pytest.raises(requests.ConnectionError):
+            run(api, api.boxscore, 'unmatched')
@@ -0,0 +1,59 @@
+from datetime import datetime
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+from nhldata.concurrency import AIMDController
+from nhldata.nhl.v1.header import header
+from nhldata.nhl.v1_async.api import AsyncNHLApi
+from nhldata.nhl.v1_async.crawler import AsyncCrawler
+from nhldata.storage import Storage
+
+aioresponses = pytest.importorskip('aioresponses').aioresponses
+
+
+def test_async_crawl(schedule_data, game_2019030314_data):
+    game_1_id = '2019030314'
+    game_2_id = '2019030325'
+
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = f'https://statsapi.web.nhl.com/api/v1/game/{game_1_id}/boxscore'
+    boxscore_2 = f'https://statsapi.web.nhl.com/api/v1/game/{game_2_id}/boxscore'
+
+    with aioresponses() as m:
+        m.get(schedule, payload=schedule_data, status=200)
+        m.get(boxscore_1, payload=game_2019030314_data, status=200)
+        m.get(boxscore_2, payload=game_2019030314_data, status=200)
+
+        s3_mock = Mock()
+        storage = Storage('testdatabucket', 'testjobbucket', s3_mock)
+
+        crawler = AsyncCrawler(AsyncNHLApi(), storage, max_workers=8)
+        crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        assert s3_mock.put_object.call_count == 2
+        keys = sorted(c.kwargs.get('Key') for c in s3_mock.put_object.call_args_list)
+        assert keys == [f'2020/09/13/{game_1_id}.csv', f'2020/09/14/{game_2_id}.csv']
+        assert ','.join(header) in s3_mock.put_object.call_args.kwargs.get('Body')
+
+
+def test_async_crawl_raises_failed_game(schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    boxscore_2 = 'https://statsapi.web.nhl.com/api/v1/game/2019030325/boxscore'
+
+    with aioresponses() as m:
+        m.get(schedule, payload=schedule_data, status=200)
+        m.get(boxscore_1, payload=game_2019030314_data, status=200)
+        m.get(boxscore_2, status=404)
+
+        crawler = AsyncCrawler(AsyncNHLApi(), Storage('testdatabucket', 'testjobbucket', Mock()), max_workers=2)
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+
+def test_async_crawler_rejects_adaptive_concurrency():
+    with pytest.raises(ValueError):
+        AsyncCrawler(None, None, concurrency=AIMDController())
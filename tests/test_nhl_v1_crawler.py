@@ -1,11 +1,17 @@
+import gzip
+import json
 from datetime import datetime
 from unittest.mock import Mock
 
+import pytest
+import requests
 import requests_mock
 
+from nhldata.concurrency import AIMDController
 from nhldata.nhl.v1.api import NHLApi
 from nhldata.nhl.v1.crawler import Crawler
 from nhldata.nhl.v1.header import header
+from nhldata.sharding import Shard
 from nhldata.storage import Storage, StorageKey
 
 
@@ -14,7 +20,7 @@ def test_extract_game_keys(schedule_data):
         StorageKey(game_year='2020', game_month='09', game_day='13', game_id='2019030314'),
         StorageKey(game_year='2020', game_month='09', game_day='14', game_id='2019030325'),
     ]
-    result = Crawler._extract_game_keys(schedule_data)
+    result = list(Crawler._extract_game_keys(schedule_data))
 
     assert expect == result
 
@@ -59,6 +65,11 @@ def test_crawl(schedule_data, game_2019030314_data):
 
         assert header_string in call_01_kwargs.get('Body')
         assert header_string in call_02_kwargs.get('Body')
+        # every row is tagged with the game it came from
+        assert all(row.startswith(f'{game_1_id},2020-09-13,')
+                   for row in call_01_kwargs.get('Body').splitlines()[1:])
+        assert all(row.startswith(f'{game_2_id},2020-09-14,')
+                   for row in call_02_kwargs.get('Body').splitlines()[1:])
 
 
 def test_crawl_no_games():
@@ -76,3 +87,168 @@ def test_crawl_no_games():
         crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
 
         assert s3_mock.put_object.call_count == 0
+
+
+def test_crawl_with_max_workers(schedule_data, game_2019030314_data):
+    databucket = 'testdatabucket'
+    jobbucket = 'testjobbucket'
+    game_1_id = '2019030314'
+    game_2_id = '2019030325'
+
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = f'https://statsapi.web.nhl.com/api/v1/game/{game_1_id}/boxscore'
+    boxscore_2 = f'https://statsapi.web.nhl.com/api/v1/game/{game_2_id}/boxscore'
+
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore_1, json=game_2019030314_data, status_code=200)
+        m.get(boxscore_2, json=game_2019030314_data, status_code=200)
+
+        s3_mock = Mock()
+        storage = Storage(databucket, jobbucket, s3_mock)
+        api = NHLApi()
+
+        crawler = Crawler(api, storage, max_workers=4)
+        crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        assert s3_mock.put_object.call_count == 2
+        keys = sorted(c.kwargs.get('Key') for c in s3_mock.put_object.call_args_list)
+        assert keys == [f'2020/09/13/{game_1_id}.csv', f'2020/09/14/{game_2_id}.csv']
+
+
+def test_crawl_with_max_workers_raises_failed_game(schedule_data, game_2019030314_data):
+    game_1_id = '2019030314'
+    game_2_id = '2019030325'
+
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = f'https://statsapi.web.nhl.com/api/v1/game/{game_1_id}/boxscore'
+    boxscore_2 = f'https://statsapi.web.nhl.com/api/v1/game/{game_2_id}/boxscore'
+
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore_1, json=game_2019030314_data, status_code=200)
+        m.get(boxscore_2, status_code=404)
+
+        storage = Storage('testdatabucket', 'testjobbucket', Mock())
+        crawler = Crawler(NHLApi(), storage, max_workers=2)
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+
+def test_crawl_incremental_refetches_games_stored_before_they_were_final(schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get('https://statsapi.web.nhl.com/api/v1/game/2019030325/boxscore', json=game_2019030314_data,
+              status_code=200)
+
+        # both games were stored by an earlier run, while 2019030325 was still Live
+        s3_mock = Mock()
+        s3_mock.get_paginator.return_value.paginate.side_effect = [
+            [{'Contents': [{'Key': '2020/09/13/2019030314.csv'}]}],
+            [{'Contents': [{'Key': '2020/09/14/2019030325.csv'}]}],
+        ]
+        storage = Storage('testdatabucket', 'testjobbucket', s3_mock)
+
+        Crawler(NHLApi(), storage, incremental=True).crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        # the schedule still doesn't have it as Final, so it's fetched and stored over the Live copy
+        assert [call.kwargs.get('Key') for call in s3_mock.put_object.call_args_list] == ['2020/09/14/2019030325.csv']
+
+
+def test_crawl_incremental_skips_stored_games(schedule_data, game_2019030314_data):
+    game_1_id = '2019030314'
+    game_2_id = '2019030325'
+
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = f'https://statsapi.web.nhl.com/api/v1/game/{game_1_id}/boxscore'
+    boxscore_2 = f'https://statsapi.web.nhl.com/api/v1/game/{game_2_id}/boxscore'
+
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore_1, json=game_2019030314_data, status_code=200)
+        m.get(boxscore_2, json=game_2019030314_data, status_code=200)
+
+        s3_mock = Mock()
+        s3_mock.get_paginator.return_value.paginate.side_effect = [
+            [{'Contents': [{'Key': f'2020/09/13/{game_1_id}.csv'}]}],
+            [{}],
+        ]
+        storage = Storage('testdatabucket', 'testjobbucket', s3_mock)
+
+        crawler = Crawler(NHLApi(), storage, incremental=True)
+        crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        assert s3_mock.get_paginator.return_value.paginate.call_count == 2
+        assert s3_mock.put_object.call_count == 1
+        assert s3_mock.put_object.call_args.kwargs.get('Key') == f'2020/09/14/{game_2_id}.csv'
+        assert m.call_count == 2
+
+
+def test_crawl_with_adaptive_concurrency(schedule_data, game_2019030314_data):
+    game_1_id = '2019030314'
+    game_2_id = '2019030325'
+
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = f'https://statsapi.web.nhl.com/api/v1/game/{game_1_id}/boxscore'
+    boxscore_2 = f'https://statsapi.web.nhl.com/api/v1/game/{game_2_id}/boxscore'
+
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore_1, json=game_2019030314_data, status_code=200)
+        m.get(boxscore_2, json=game_2019030314_data, status_code=200)
+
+        s3_mock = Mock()
+        storage = Storage('testdatabucket', 'testjobbucket', s3_mock)
+        controller = AIMDController(min_limit=1, max_limit=4, initial=1, latency_spike=1000)
+
+        crawler = Crawler(NHLApi(), storage, max_workers=4, concurrency=controller)
+        crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        assert s3_mock.put_object.call_count == 2
+        # only the boxscores are observed, the first healthy one takes the limit from 1 to 2
+        assert controller.limit == 2
+        assert controller.in_flight == 0
+
+
+def test_crawl_archives_raw_boxscores(schedule_data, game_2019030314_data):
+    schedule = 'https://statsapi.web.nhl.com/api/v1/schedule?startDate=2020-01-01&endDate=2020-01-02'
+    boxscore_1 = 'https://statsapi.web.nhl.com/api/v1/game/2019030314/boxscore'
+    boxscore_2 = 'https://statsapi.web.nhl.com/api/v1/game/2019030325/boxscore'
+
+    with requests_mock.Mocker() as m:
+        m.get(schedule, json=schedule_data, status_code=200)
+        m.get(boxscore_1, json=game_2019030314_data, status_code=200)
+        m.get(boxscore_2, json=game_2019030314_data, status_code=200)
+
+        s3_mock = Mock()
+        storage = Storage('testdatabucket', 'testjobbucket', s3_mock)
+
+        crawler = Crawler(NHLApi(), storage, archive_raw=True)
+        crawler.crawl(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+        puts = {c.kwargs.get('Key'): c.kwargs for c in s3_mock.put_object.call_args_list}
+        assert sorted(puts) == ['2020/09/13/2019030314.csv', '2020/09/14/2019030325.csv',
+                                'raw/2020/09/13/2019030314.json.gz', 'raw/2020/09/14/2019030325.json.gz']
+        raw = puts['raw/2020/09/13/2019030314.json.gz']
+        assert raw.get('ContentEncoding') == 'gzip'
+        assert json.loads(gzip.decompress(raw.get('Body'))) == game_2019030314_data
+
+
+def test_crawler_rejects_unknown_output_format():
+    with pytest.raises(ValueError):
+        Crawler(None, None, output_format='xml')
+
+
+def test_crawler_only_keeps_its_shard(schedule_data):
+    api = Mock()
+    game_ids = []
+    for index in range(2):
+        api.schedule_days.return_value = iter(schedule_data['dates'])
+        crawler = Crawler(api, Mock(), shard=Shard(index, 2))
+        game_ids.append([key.game_id for key in crawler._scheduled_game_keys(datetime(2020, 1, 1),
+                                                                            datetime(2020, 1, 2))])
+
+    assert sorted(game_ids[0] + game_ids[1]) == ['2019030314', '2019030325']
+    assert not set(game_ids[0]) & set(game_ids[1])
@@ -0,0 +1,68 @@
+import pandas as pd
+
+from nhldata.nhl.v1.crawler import Crawler
+from nhldata.nhl.v1.flattener import GAME_FLATTENER, Flattener, time_on_ice_seconds
+from nhldata.nhl.v1.header import header, time_on_ice_seconds_columns
+
+
+def pandas_reference(records):
+    """ the json_normalize based transform the flattener replaced """
+    players = pd.json_normalize(records, sep='_')
+    arranged_players = players.reindex(header, axis=1)
+    arranged_players['player_person_currentAge'] = \
+        pd.array(arranged_players.player_person_currentAge, dtype='Int64')
+    arranged_players['player_person_currentTeam_id'] = \
+        pd.array(arranged_players.player_person_currentTeam_id, dtype='Int64')
+    for column, source in time_on_ice_seconds_columns.items():
+        arranged_players[column] = pd.array([None if pd.isna(value) else time_on_ice_seconds(value)
+                                             for value in arranged_players[source]], dtype='Int64')
+    return arranged_players.to_csv(index=False)
+
+
+def test_flattener_matches_pandas(game_2019030314_data):
+    records = Crawler._extract_players(game_2019030314_data.get('teams'))
+
+    assert GAME_FLATTENER.to_csv(records) == pandas_reference(records)
+
+
+def test_flattener_matches_pandas_with_nulls(game_2019030314_data):
+    records = Crawler._extract_players(game_2019030314_data.get('teams'))
+    records[0]['player']['person']['currentAge'] = None
+    del records[1]['player']['person']['currentTeam']
+    del records[2]['player']['person']['weight']
+    records[3]['player']['person']['birthCity'] = 'Windsor, ON'
+    records[4]['player']['person']['rookie'] = None
+
+    assert GAME_FLATTENER.to_csv(records) == pandas_reference(records)
+
+
+def test_flattener_matches_pandas_without_players():
+    assert GAME_FLATTENER.to_csv([]) == pandas_reference([])
+
+
+def test_flattener_rows():
+    flattener = Flattener(['a_b', 'a_c', 'd'])
+
+    result = flattener.rows([{'a': {'b': 1, 'c': {'e': 2}}, 'd': 'x'}, {'a': 'not a dict'}])
+
+    assert result == [[1, None, 'x'], [None, None, None]]
+
+
+def test_flattener_derived_columns():
+    flattener = Flattener(['a_b', 'a_b_seconds'], int_columns=['a_b_seconds'],
+                          derived={'a_b_seconds': ('a_b', time_on_ice_seconds)})
+
+    result = flattener.to_csv([{'a': {'b': '104:02'}}, {'a': {}}])
+
+    assert result == 'a_b,a_b_seconds\n104:02,6242\n,\n'
+
+
+def test_flattener_numeric_columns():
+    flattener = Flattener(['ints', 'floats', 'sparse', 'nullable'], int_columns=['nullable'])
+
+    result = flattener.to_csv([
+        {'ints': 1, 'floats': 1, 'sparse': 1, 'nullable': 1.0},
+        {'ints': 2, 'floats': 2.5, 'nullable': None},
+    ])
+
+    assert result == 'ints,floats,sparse,nullable\n1,1.0,1.0,1\n2,2.5,,\n'
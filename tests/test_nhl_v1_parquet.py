@@ -0,0 +1,51 @@
+import io
+from datetime import date
+
+import pytest
+
+from nhldata.nhl.v1.crawler import Crawler
+from nhldata.nhl.v1.flattener import time_on_ice_seconds
+from nhldata.nhl.v1.header import header
+from nhldata.nhl.v1.parquet import to_parquet
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def test_time_on_ice_seconds():
+    assert time_on_ice_seconds('15:14') == 914
+    assert time_on_ice_seconds('104:02') == 6242
+    assert time_on_ice_seconds(None) is None
+    assert time_on_ice_seconds('') is None
+
+
+def test_to_parquet_typed_columns(game_2019030314_data):
+    records = Crawler._extract_players(game_2019030314_data.get('teams'))
+
+    table = pq.read_table(io.BytesIO(to_parquet(records)))
+    rows = table.to_pylist()
+
+    assert table.column_names == header
+    assert str(table.schema.field('player_jerseyNumber').type) == 'int64'
+    assert str(table.schema.field('player_person_active').type) == 'bool'
+    assert str(table.schema.field('player_stats_skaterStats_assists').type) == 'double'
+    # home players come first, Gourde and Coburn are the first two away players
+    assert rows[3]['player_person_id'] == 8476826
+    assert rows[3]['player_jerseyNumber'] == 37
+    assert rows[3]['player_stats_skaterStats_timeOnIce'] == '15:14'
+    assert str(table.schema.field('player_stats_skaterStats_timeOnIce_seconds').type) == 'int32'
+    assert rows[3]['player_stats_skaterStats_timeOnIce_seconds'] == 914
+    assert rows[3]['player_stats_goalieStats_timeOnIce_seconds'] is None
+    assert rows[3]['player_stats_skaterStats_assists'] == 2.0
+    assert rows[4]['player_stats_skaterStats_assists'] is None
+
+
+def test_to_parquet_writes_statistics(game_2019030314_data):
+    records = [{**record, 'game': {'id': 2019030314, 'date': '2020-09-13'}}
+               for record in Crawler._extract_players(game_2019030314_data.get('teams'))]
+
+    parquet_file = pq.ParquetFile(io.BytesIO(to_parquet(records)))
+
+    assert parquet_file.metadata.num_rows == len(records)
+    assert parquet_file.metadata.row_group(0).column(0).statistics.has_min_max
+    assert parquet_file.read(columns=['game_id', 'game_date']).to_pylist()[0] == \
+        {'game_id': 2019030314, 'game_date': date(2020, 9, 13)}
@@ -0,0 +1,154 @@
+import copy
+import json
+from datetime import date, datetime
+from unittest.mock import Mock, patch
+
+import pytest
+
+from nhldata.nhl.v1.crawler import Crawler
+from nhldata.nhl.v1.planner import SeasonPlanner, candidate_game_ids, seasons_between
+from nhldata.storage import StorageKey
+
+
+@pytest.fixture
+def final_schedule_data(schedule_data):
+    data = copy.deepcopy(schedule_data)
+    for day in data['dates']:
+        for game in day['games']:
+            game['status']['abstractGameState'] = 'Final'
+    yield data
+
+
+def windowed(game_schedule):
+    """ a schedule call that, like the api, only returns the dates it was asked for """
+    def schedule(start_date, end_date):
+        first, last = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+        return {'dates': [day for day in game_schedule['dates'] if first <= day['date'] <= last]}
+    return schedule
+
+
+def test_candidate_game_ids():
+    candidates = candidate_game_ids(2019)
+
+    assert candidates[0] == '2019020001'
+    assert candidates[1311] == '2019021312'
+    # 8 + 4 + 2 + 1 series of up to 7 games
+    assert len(candidates) == 1312 + 15 * 7
+    assert '2019030314' in candidates
+    assert '2019030417' in candidates
+    assert '2019030421' not in candidates
+
+
+@pytest.mark.parametrize('start_date, end_date, expect', [
+    (datetime(2020, 1, 1), datetime(2020, 1, 7), [2019]),
+    (datetime(2020, 9, 13), datetime(2020, 9, 14), [2019, 2020]),
+    (datetime(2020, 11, 1), datetime(2020, 11, 30), [2020]),
+    (datetime(2018, 1, 1), datetime(2020, 1, 1), [2017, 2018, 2019]),
+])
+def test_seasons_between(start_date, end_date, expect):
+    assert seasons_between(start_date, end_date) == expect
+
+
+def test_planner_fills_gaps_from_the_schedule(tmp_path, final_schedule_data):
+    index_path = str(tmp_path / 'seasons.json')
+    api = Mock()
+    api.schedule.return_value = final_schedule_data
+
+    planner = SeasonPlanner(api, index_path)
+    keys = planner.game_keys(datetime(2020, 1, 1), datetime(2020, 9, 13))
+
+    assert keys == [StorageKey('2020', '09', '13', '2019030314')]
+    # september could be the end of the 2019 season or the start of the 2020 one
+    api.schedule.assert_any_call(datetime(2019, 7, 1), datetime(2020, 10, 31))
+    api.schedule.assert_any_call(datetime(2020, 7, 1), datetime(2021, 10, 31))
+    # the seasons are played out, so every candidate is accounted for
+    assert planner.gaps(2019) == []
+    assert planner.gaps(2020) == []
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    assert index['2019']['games']['2019030314'] == '2020-09-13'
+    assert index['2019']['games']['2019020001'] is None
+    assert index['2019']['settled_through'] == '2020-10-31'
+
+
+def test_planner_skips_the_schedule_for_indexed_seasons(tmp_path, final_schedule_data):
+    index_path = str(tmp_path / 'seasons.json')
+    api = Mock()
+    api.schedule.return_value = final_schedule_data
+    SeasonPlanner(api, index_path).game_keys(datetime(2020, 1, 1), datetime(2020, 9, 30))
+
+    api = Mock()
+    keys = SeasonPlanner(api, index_path).game_keys(datetime(2020, 9, 1), datetime(2020, 9, 30), 'parquet')
+
+    assert keys == [StorageKey('2020', '09', '13', '2019030314', 'parquet'),
+                    StorageKey('2020', '09', '14', '2019030325', 'parquet')]
+    api.schedule.assert_not_called()
+    # the season is played out, so its games are Final without a schedule saying so
+    assert set(api.mark_final.call_args.args[0]) == {'2019030314', '2019030325'}
+
+
+def test_planner_keeps_gaps_of_unfinished_seasons(tmp_path, schedule_data):
+    api = Mock()
+    api.schedule.return_value = schedule_data
+
+    planner = SeasonPlanner(api, str(tmp_path / 'seasons.json'))
+    planner.game_keys(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+    # a game of the season isn't Final yet, so the rest of its candidates may still be scheduled
+    assert '2019020001' in planner.gaps(2019)
+    assert planner.settled_through(2019) == date(2020, 9, 13)
+
+
+@patch('nhldata.nhl.v1.planner.date', wraps=date)
+def test_planner_only_fills_dates_past_where_the_season_is_settled(today, tmp_path, schedule_data):
+    today.today.return_value = date(2020, 9, 15)
+    api = Mock()
+    api.schedule.side_effect = windowed(schedule_data)
+    planner = SeasonPlanner(api, str(tmp_path / 'seasons.json'))
+
+    planner.game_keys(datetime(2020, 9, 1), datetime(2020, 9, 13))
+    # the season isn't over, so the schedule is only asked for up to the end of the crawl
+    api.schedule.assert_any_call(datetime(2019, 7, 1), datetime(2020, 9, 13))
+    assert planner.settled_through(2019) == date(2020, 9, 13)
+
+    api.reset_mock()
+    keys = planner.game_keys(datetime(2020, 9, 1), datetime(2020, 9, 13))
+    assert keys == [StorageKey('2020', '09', '13', '2019030314')]
+    api.schedule.assert_not_called()
+    assert set(api.mark_final.call_args.args[0]) == {'2019030314'}
+
+    keys = planner.game_keys(datetime(2020, 9, 14), datetime(2020, 9, 14))
+    assert keys == [StorageKey('2020', '09', '14', '2019030325')]
+    # only the dates past the settled ones are asked for again, for both seasons the day could belong to
+    assert api.schedule.call_args_list[0].args == (datetime(2020, 9, 14), datetime(2020, 9, 14))
+    assert api.schedule.call_count == 2
+    # 2019030325 isn't Final yet, so the season stays settled through the day before it
+    assert planner.settled_through(2019) == date(2020, 9, 13)
+    assert set(api.mark_final.call_args.args[0]) == set()
+
+
+def test_planner_reads_indexes_without_settled_dates(tmp_path, final_schedule_data):
+    index_path = tmp_path / 'seasons.json'
+    api = Mock()
+    api.schedule.return_value = final_schedule_data
+    SeasonPlanner(api, str(index_path)).game_keys(datetime(2020, 1, 1), datetime(2020, 1, 2))
+    index = json.loads(index_path.read_text())
+    index_path.write_text(json.dumps({season: entry['games'] for season, entry in index.items()}))
+
+    api = Mock()
+    planner = SeasonPlanner(api, str(index_path))
+    planner.game_keys(datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+    api.schedule.assert_not_called()
+    assert planner.settled_through(2019) == date(2020, 10, 31)
+
+
+def test_crawler_plans_from_the_season_index(tmp_path, final_schedule_data):
+    api = Mock()
+    api.schedule.return_value = final_schedule_data
+    planner = SeasonPlanner(api, str(tmp_path / 'seasons.json'))
+
+    crawler = Crawler(api, Mock(), planner=planner)
+    keys = list(crawler._scheduled_game_keys(datetime(2020, 9, 14), datetime(2020, 9, 14)))
+
+    assert keys == [StorageKey('2020', '09', '14', '2019030325')]
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from nhldata.pipeline import Pipeline, Stage
+
+
+def test_stage_requires_a_worker():
+    with pytest.raises(ValueError):
+        Stage('foo', str, workers=0)
+
+
+def test_pipeline_requires_a_stage():
+    with pytest.raises(ValueError):
+        Pipeline([])
+
+
+def test_pipeline_runs_every_item_through_every_stage():
+    results = []
+    pipeline = Pipeline([
+        Stage('double', lambda x: x * 2, workers=3),
+        Stage('increment', lambda x: x + 1, workers=2),
+        Stage('collect', results.append),
+    ])
+
+    stats = pipeline.run(range(100))
+
+    assert sorted(results) == [x * 2 + 1 for x in range(100)]
+    assert [s.name for s in stats] == ['double', 'increment', 'collect']
+    assert all(s.processed == 100 for s in stats)
+
+
+def test_pipeline_preserves_order_with_single_workers():
+    results = []
+    pipeline = Pipeline([Stage('identity', lambda x: x), Stage('collect', results.append)])
+
+    pipeline.run(range(50))
+
+    assert results == list(range(50))
+
+
+def test_pipeline_runs_stage_in_executor():
+    results = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pipeline = Pipeline([Stage('negate', lambda x: -x, workers=2, executor=executor),
+                             Stage('collect', results.append)])
+        pipeline.run(range(10))
+
+    assert sorted(results) == sorted(-x for x in range(10))
+
+
+def test_pipeline_raises_first_error():
+    def explode(x):
+        if x == 5:
+            raise ValueError('boom')
+        return x
+
+    pipeline = Pipeline([Stage('explode', explode, workers=2), Stage('identity', lambda x: x)], queue_size=1)
+
+    with pytest.raises(ValueError):
+        pipeline.run(range(1000))
+
+
+def test_pipeline_applies_backpressure():
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def produce(x):
+        with lock:
+            in_flight.append(x)
+            peak.append(len(in_flight))
+        return x
+
+    def consume(x):
+        release.wait(0.001)
+        with lock:
+            in_flight.remove(x)
+
+    Pipeline([Stage('produce', produce), Stage('consume', consume)], queue_size=2).run(range(200))
+
+    # produced but not yet consumed items are bounded by the queue, plus one in each worker's hands
+    assert max(peak) <= 4
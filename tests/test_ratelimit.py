@@ -0,0 +1,120 @@
+import asyncio
+import fcntl
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from nhldata.ratelimit import FileTokenBucket, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    async def async_sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    fake = FakeClock()
+    with patch('nhldata.ratelimit.time.time', fake.time), patch('nhldata.ratelimit.time.sleep', fake.sleep), \
+            patch('nhldata.ratelimit.asyncio.sleep', fake.async_sleep):
+        yield fake
+
+
+def test_token_bucket_rejects_invalid_settings():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+    with pytest.raises(ValueError):
+        TokenBucket(1, burst=0)
+
+
+def test_token_bucket_allows_burst_then_spaces_requests(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+
+    waits = [bucket.acquire() for _ in range(5)]
+
+    assert waits == [0.0, 0.0, 0.0, 0.5, 0.5]
+
+
+def test_token_bucket_acquire_async(clock):
+    bucket = TokenBucket(rate=2, burst=1)
+
+    async def acquire_all():
+        return [await bucket.acquire_async() for _ in range(3)]
+
+    assert asyncio.run(acquire_all()) == [0.0, 0.5, 0.5]
+
+
+def test_token_bucket_refills_while_idle(clock):
+    bucket = TokenBucket(rate=1, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+    clock.sleep(10)
+
+    waits = [bucket.acquire() for _ in range(3)]
+
+    assert waits == [0.0, 0.0, 1.0]
+
+
+def test_token_bucket_pause_stops_everybody(clock):
+    bucket = TokenBucket(rate=10, burst=10)
+    bucket.pause(30)
+
+    waited = bucket.acquire()
+
+    assert waited == pytest.approx(30.0)
+
+
+def test_file_token_bucket_shares_state(clock, tmp_path):
+    path = str(tmp_path / 'bucket')
+    first = FileTokenBucket(path, rate=1, burst=2)
+    second = FileTokenBucket(path, rate=1, burst=2)
+
+    waits = [first.acquire(), second.acquire(), first.acquire()]
+
+    assert waits == [0.0, 0.0, 1.0]
+
+
+def test_file_token_bucket_pause_is_shared(clock, tmp_path):
+    path = str(tmp_path / 'bucket')
+    FileTokenBucket(path, rate=10, burst=10).pause(5)
+
+    waited = FileTokenBucket(path, rate=10, burst=10).acquire()
+
+    assert waited == pytest.approx(5.0)
+
+
+def test_token_bucket_pause_async(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+
+    asyncio.run(bucket.pause_async(5))
+
+    assert bucket.acquire() == pytest.approx(5.0)
+
+
+def test_file_token_bucket_acquire_async_does_not_block_the_event_loop(tmp_path):
+    bucket = FileTokenBucket(str(tmp_path / 'bucket'), rate=100, burst=1)
+
+    async def acquire_while_another_process_holds_the_lock():
+        with open(bucket.path, 'a+b') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            release = threading.Timer(0.5, fcntl.flock, (handle, fcntl.LOCK_UN))
+            release.start()
+            acquiring = asyncio.ensure_future(bucket.acquire_async())
+            # had acquire_async taken the lock on the loop, this would only return once the lock is released
+            await asyncio.sleep(0.05)
+            assert not acquiring.done()
+            waited = await acquiring
+            release.join()
+        return waited
+
+    assert asyncio.run(acquire_while_another_process_holds_the_lock()) == 0.0
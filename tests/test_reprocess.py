@@ -0,0 +1,41 @@
+import json
+from datetime import datetime
+
+import boto3
+import pytest
+
+from nhldata.nhl.v1.crawler import render_game
+from nhldata.reprocess import Reprocessor
+from nhldata.storage import Storage, StorageKey
+
+
+@pytest.fixture
+def storage(data_bucket, game_2019030314_data):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+    raw = json.dumps(game_2019030314_data).encode('utf-8')
+    storage.store_raw_game(StorageKey('2020', '09', '13', '2019030314'), raw)
+    storage.store_raw_game(StorageKey('2020', '09', '14', '2019030325'), raw)
+    yield storage
+
+
+def test_reprocessor_rejects_unknown_output_format():
+    with pytest.raises(ValueError):
+        Reprocessor(None, output_format='xml')
+
+
+def test_reprocess_window(storage, game_2019030314_data):
+    count = Reprocessor(storage).run(datetime(2020, 9, 13), datetime(2020, 9, 13))
+
+    assert count == 1
+    assert storage.list_games('2020/') == {'2020/09/13/2019030314.csv'}
+    expected = render_game(StorageKey('2020', '09', '13', '2019030314'), game_2019030314_data, 'csv')
+    assert storage.load_data('2020/09/13/2019030314.csv') == expected.encode('utf-8')
+
+
+def test_reprocess_whole_archive_in_process_pool(storage):
+    gzip_storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'), compression='gzip')
+
+    count = Reprocessor(gzip_storage, processes=2).run()
+
+    assert count == 2
+    assert gzip_storage.list_games('2020/') == {'2020/09/13/2019030314.csv.gz', '2020/09/14/2019030325.csv.gz'}
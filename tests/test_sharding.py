@@ -0,0 +1,24 @@
+import pytest
+
+from nhldata.sharding import Shard
+
+
+def test_every_game_belongs_to_exactly_one_shard():
+    shards = [Shard(index, 3) for index in range(3)]
+    game_ids = [f'20190200{number:02d}' for number in range(1, 100)]
+
+    owners = [[shard for shard in shards if shard.owns(game_id)] for game_id in game_ids]
+
+    assert all(len(owner) == 1 for owner in owners)
+    # the hash spreads the games over every shard
+    assert all(any(owner == [shard] for owner in owners) for shard in shards)
+
+
+@pytest.mark.parametrize('index, count', [(-1, 2), (2, 2), (0, 0)])
+def test_shard_rejects_invalid_index(index, count):
+    with pytest.raises(ValueError):
+        Shard(index, count)
+
+
+def test_shard_name():
+    assert Shard(1, 4).name() == 'shard1of4'
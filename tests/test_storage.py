@@ -1,6 +1,12 @@
+import gzip
+import io
 from unittest.mock import Mock
 
-from nhldata.storage import Storage, StorageKey
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from nhldata.storage import ConditionFailed, Storage, StorageKey, compression_for_key
 
 
 def test_storage_key_returns_key():
@@ -33,3 +39,130 @@ def test_storage_store_job():
 
     assert result is True
     s3_mock.put_object.assert_called_with(Bucket='jobbucket', Key='1/2/3/4.csv', Body='foo bar baz')
+
+
+def test_storage_store_job_if():
+    s3_mock = Mock()
+    s3_mock.put_object.return_value = {'ETag': '"v2"'}
+    storage = Storage('testbucket', 'jobbucket', s3_mock)
+
+    assert storage.store_job_if('leases/a.json', 'new') == '"v2"'
+    s3_mock.put_object.assert_called_with(Bucket='jobbucket', Key='leases/a.json', Body='new', IfNoneMatch='*')
+
+    storage.store_job_if('leases/a.json', 'update', etag='"v1"')
+    s3_mock.put_object.assert_called_with(Bucket='jobbucket', Key='leases/a.json', Body='update', IfMatch='"v1"')
+
+
+@pytest.mark.parametrize('code, raises', [
+    ('PreconditionFailed', ConditionFailed),
+    ('ConditionalRequestConflict', ConditionFailed),
+    ('AccessDenied', ClientError),
+])
+def test_storage_store_job_if_condition_failed(code, raises):
+    s3_mock = Mock()
+    s3_mock.put_object.side_effect = ClientError({'Error': {'Code': code}}, 'PutObject')
+    storage = Storage('testbucket', 'jobbucket', s3_mock)
+
+    with pytest.raises(raises):
+        storage.store_job_if('leases/a.json', 'new')
+
+
+def test_storage_load_and_delete_job(job_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+
+    assert storage.load_job('leases/a.json') == (None, None)
+    etag = storage.store_job_if('leases/a.json', 'body')
+    assert storage.load_job('leases/a.json') == ('body', etag)
+    storage.delete_job('leases/a.json')
+    assert storage.load_job('leases/a.json') == (None, None)
+
+
+def test_storage_key_returns_prefix():
+    key = StorageKey('2020', '01', '01', 'foo')
+
+    assert key.prefix() == '2020/01/01/'
+
+
+def test_storage_list_games(data_bucket):
+    data_bucket.put_object(Key='2020/01/01/foo.csv', Body='foo')
+    data_bucket.put_object(Key='2020/01/01/bar.csv', Body='bar')
+    data_bucket.put_object(Key='2020/01/02/baz.csv', Body='baz')
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+
+    result = storage.list_games('2020/01/01/')
+
+    assert result == {'2020/01/01/foo.csv', '2020/01/01/bar.csv'}
+
+
+def test_storage_list_prefixes(data_bucket):
+    data_bucket.put_object(Key='2020/01/01/foo.csv', Body='foo')
+    data_bucket.put_object(Key='2021/01/01/bar.csv', Body='bar')
+    data_bucket.put_object(Key='raw/2020/01/01/foo.json.gz', Body='foo')
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+
+    assert storage.list_prefixes() == ['2020/', '2021/', 'raw/']
+    assert storage.list_prefixes('2020/') == ['2020/01/']
+
+
+def test_storage_key_with_extension():
+    key = StorageKey('2020', '01', '01', 'foo', 'parquet')
+
+    assert key.key() == '2020/01/01/foo.parquet'
+
+
+def test_storage_rejects_unknown_compression():
+    with pytest.raises(ValueError):
+        Storage('testbucket', 'jobbucket', Mock(), compression='lzma')
+
+
+def test_compression_for_key():
+    assert compression_for_key('a/b/c/d.csv.gz') == 'gzip'
+    assert compression_for_key('a/b/c/d.csv.zst') == 'zstd'
+    assert compression_for_key('a/b/c/d.csv') is None
+
+
+def test_storage_store_game_gzip():
+    s3_mock = Mock()
+    storage = Storage('testbucket', 'jobbucket', s3_mock, compression='gzip')
+    key = StorageKey('a', 'b', 'c', 'd')
+
+    result = storage.store_game(key, 'foo bar baz')
+
+    assert result is True
+    assert storage.object_key(key) == 'a/b/c/d.csv.gz'
+    kwargs = s3_mock.put_object.call_args.kwargs
+    assert kwargs.get('Key') == 'a/b/c/d.csv.gz'
+    assert kwargs.get('ContentEncoding') == 'gzip'
+    assert gzip.decompress(kwargs.get('Body')) == b'foo bar baz'
+
+
+def test_storage_load_data_decompresses(data_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'), compression='gzip')
+    storage.store_game(StorageKey('a', 'b', 'c', 'd'), 'foo bar baz')
+
+    assert storage.load_data('a/b/c/d.csv.gz') == b'foo bar baz'
+
+
+def test_storage_store_stream_compressed(data_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'))
+    spool = io.BytesIO()
+    with storage.compressed_writer(spool, 'big.csv.gz') as writer:
+        writer.write(b'foo bar baz')
+    spool.seek(0)
+
+    result = storage.store_stream('big.csv.gz', spool)
+
+    assert result is True
+    assert storage.load_data('big.csv.gz') == b'foo bar baz'
+    # newer botocore streams uploads with aws-chunked, which S3 strips but moto keeps
+    assert 'gzip' in data_bucket.Object('big.csv.gz').content_encoding.split(',')
+
+
+def test_storage_raw_game_archive(data_bucket):
+    storage = Storage('testdatabucket', 'testjobbucket', boto3.client('s3'), compression='zstd')
+    key = StorageKey('2020', '09', '13', '2019030314', 'csv')
+
+    assert storage.raw_key(key) == 'raw/2020/09/13/2019030314.json.gz'
+    assert storage.store_raw_game(key, b'{"teams": {}}') is True
+    assert gzip.decompress(storage.load_object('raw/2020/09/13/2019030314.json.gz')) == b'{"teams": {}}'
+    assert storage.load_data('raw/2020/09/13/2019030314.json.gz') == b'{"teams": {}}'
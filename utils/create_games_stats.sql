@@ -1,6 +1,24 @@
-DROP TABLE IF EXISTS game_stats;
-CREATE TABLE game_stats (
-player_person_id int,
+-- A game_stats from before rows were tagged with their game is a plain table without game_id, loaded_at or the primary
+-- key the load merges on, and a table can't be altered into a partitioned one.  Its rows can't be given the game they
+-- came from in place either, so it's dropped along with its load watermark: the next `nhldata load` reloads every
+-- game from the bucket (`nhldata reprocess` first rewrites games crawled before they carried game_id), and
+-- `make dbt_full_refresh` rebuilds the models on top of it.
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('game_stats')) = 'r' THEN
+        DROP TABLE game_stats;
+        IF to_regclass('load_watermarks') IS NOT NULL THEN
+            DELETE FROM load_watermarks WHERE source = 'game_stats';
+        END IF;
+        RAISE NOTICE 'Dropped the unpartitioned game_stats, run nhldata load to reload it';
+    END IF;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS game_stats (
+game_id bigint NOT NULL,
+game_date date NOT NULL,
+player_person_id int NOT NULL,
 player_jerseyNumber int,
 player_person_active bool,
 player_person_alternateCaptain bool,
@@ -69,5 +87,34 @@ player_stats_skaterStats_shortHandedTimeOnIce varchar(50),
 player_stats_skaterStats_shots float8,
 player_stats_skaterStats_takeaways float8,
 player_stats_skaterStats_timeOnIce varchar(50),
-side varchar(50)
-)
+side varchar(50),
+loaded_at timestamptz NOT NULL DEFAULT now(),
+PRIMARY KEY (game_id, player_person_id)
+) PARTITION BY RANGE (game_id);
+
+-- the time on ice columns as a number of seconds, a partitioned game_stats created before the crawler wrote them
+-- doesn't have them yet
+ALTER TABLE game_stats
+ADD COLUMN IF NOT EXISTS player_stats_goalieStats_timeOnIce_seconds int,
+ADD COLUMN IF NOT EXISTS player_stats_skaterStats_evenTimeOnIce_seconds int,
+ADD COLUMN IF NOT EXISTS player_stats_skaterStats_powerPlayTimeOnIce_seconds int,
+ADD COLUMN IF NOT EXISTS player_stats_skaterStats_shortHandedTimeOnIce_seconds int,
+ADD COLUMN IF NOT EXISTS player_stats_skaterStats_timeOnIce_seconds int;
+
+-- rows loaded before then are backfilled from the mm:ss columns, nhldata load does the same for the rows of objects
+-- written before then
+UPDATE game_stats SET player_stats_goalieStats_timeOnIce_seconds = split_part(player_stats_goalieStats_timeOnIce, ':', 1)::int * 60 + split_part(player_stats_goalieStats_timeOnIce, ':', 2)::int
+WHERE player_stats_goalieStats_timeOnIce_seconds IS NULL AND player_stats_goalieStats_timeOnIce ~ '^[0-9]+:[0-9]{2}$';
+UPDATE game_stats SET player_stats_skaterStats_evenTimeOnIce_seconds = split_part(player_stats_skaterStats_evenTimeOnIce, ':', 1)::int * 60 + split_part(player_stats_skaterStats_evenTimeOnIce, ':', 2)::int
+WHERE player_stats_skaterStats_evenTimeOnIce_seconds IS NULL AND player_stats_skaterStats_evenTimeOnIce ~ '^[0-9]+:[0-9]{2}$';
+UPDATE game_stats SET player_stats_skaterStats_powerPlayTimeOnIce_seconds = split_part(player_stats_skaterStats_powerPlayTimeOnIce, ':', 1)::int * 60 + split_part(player_stats_skaterStats_powerPlayTimeOnIce, ':', 2)::int
+WHERE player_stats_skaterStats_powerPlayTimeOnIce_seconds IS NULL AND player_stats_skaterStats_powerPlayTimeOnIce ~ '^[0-9]+:[0-9]{2}$';
+UPDATE game_stats SET player_stats_skaterStats_shortHandedTimeOnIce_seconds = split_part(player_stats_skaterStats_shortHandedTimeOnIce, ':', 1)::int * 60 + split_part(player_stats_skaterStats_shortHandedTimeOnIce, ':', 2)::int
+WHERE player_stats_skaterStats_shortHandedTimeOnIce_seconds IS NULL AND player_stats_skaterStats_shortHandedTimeOnIce ~ '^[0-9]+:[0-9]{2}$';
+UPDATE game_stats SET player_stats_skaterStats_timeOnIce_seconds = split_part(player_stats_skaterStats_timeOnIce, ':', 1)::int * 60 + split_part(player_stats_skaterStats_timeOnIce, ':', 2)::int
+WHERE player_stats_skaterStats_timeOnIce_seconds IS NULL AND player_stats_skaterStats_timeOnIce ~ '^[0-9]+:[0-9]{2}$';
+
+-- one partition per season, gamePks start with the season's year: game_stats_2019 holds 2019000000 to 2020000000.
+-- nhldata load creates them as the seasons arrive, indexes on game_stats are created on every partition
+CREATE INDEX IF NOT EXISTS game_stats_player_idx ON game_stats (player_person_id, game_id);
+CREATE INDEX IF NOT EXISTS game_stats_game_date_brin ON game_stats USING brin (game_date);
@@ -1,11 +1,11 @@
-DROP TABLE IF EXISTS job_stats;
-CREATE TABLE job_stats (
-id varchar(50),
+CREATE TABLE IF NOT EXISTS job_stats (
+id varchar(50) PRIMARY KEY,
 app_version varchar(50),
 execution_date date,
 execution_ts timestamp,
 query_start_date date,
 query_stop_date date,
 job_successful bool,
-job_exception text
-)
+job_exception text,
+circuit_breaker_state varchar(50)
+);
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS load_watermarks (
+source varchar(200) PRIMARY KEY,
+watermark timestamptz NOT NULL,
+loaded_at timestamptz NOT NULL DEFAULT now()
+);